@@ -0,0 +1,306 @@
+"""Benchmark suite for the workloads CyDifflib is used for.
+
+Every case is run with cydifflib and, for comparison, with difflib.  The
+best time per call and the peak memory of a call are written as JSON:
+
+    python bench/suite.py run -o results.json
+    python bench/suite.py run -k unified_diff -i cydifflib --scale 0.1
+
+Two runs can be compared to find regressions.  The exit code is 1 if a
+case got slower or uses more memory than the threshold allows:
+
+    python bench/suite.py compare baseline.json results.json --threshold 0.1
+
+The peak memory is measured in a separate process per case as the growth
+of the resident set size while calling the case once, so memory allocated
+by the C++ code is included.  It is not available on Windows.
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import json
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+import timeit
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+IMPLEMENTATIONS = ("cydifflib", "difflib")
+
+
+def _random_string(rng, length, alphabet=string.ascii_letters + string.digits + " "):
+    return "".join(rng.choices(alphabet, k=length))
+
+
+def _edit_lines(rng, lines, fraction, make_line):
+    lines = list(lines)
+    for _ in range(max(1, int(len(lines) * fraction))):
+        i = rng.randrange(len(lines))
+        op = rng.random()
+        if op < 0.4:
+            lines[i] = make_line()
+        elif op < 0.7:
+            lines.insert(i, make_line())
+        else:
+            del lines[i]
+    return lines
+
+
+def _source_lines(rng, count):
+    # looks enough like source code to produce popular lines
+    common = ["\n", "}\n", "    return NULL;\n", "        break;\n", "    {\n"]
+    return [
+        rng.choice(common) if rng.random() < 0.3 else f"    x{rng.randrange(10**6)} = f({rng.randrange(100)});\n"
+        for _ in range(count)
+    ]
+
+
+# Each case gets the module under test, a random generator and the scale
+# and returns a function to time.  Inputs are created before timing.
+
+
+def matching_blocks_long_strings(mod, rng, scale):
+    n = int(20000 * scale)
+    a = _random_string(rng, n, "acgt")
+    b = "".join(c if rng.random() < 0.9 else rng.choice("acgt") for c in a)
+    return lambda: mod.SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks()
+
+
+def ratio_long_strings(mod, rng, scale):
+    n = int(20000 * scale)
+    a = _random_string(rng, n)
+    b = "".join(c if rng.random() < 0.95 else rng.choice(string.ascii_letters) for c in a)
+    return lambda: mod.SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def matching_blocks_lines(mod, rng, scale):
+    a = [_random_string(rng, 40) + "\n" for _ in range(int(20000 * scale))]
+    b = _edit_lines(rng, a, 0.05, lambda: _random_string(rng, 40) + "\n")
+    return lambda: mod.SequenceMatcher(None, a, b).get_matching_blocks()
+
+
+def matching_blocks_junk(mod, rng, scale):
+    n = int(20000 * scale)
+    a = "".join(rng.choice("ab  \t ") for _ in range(n))
+    b = "".join(rng.choice("ab  \t ") for _ in range(n))
+    return lambda: mod.SequenceMatcher(lambda c: c in " \t", a, b).get_matching_blocks()
+
+
+def matching_blocks_autojunk(mod, rng, scale):
+    a = _source_lines(rng, int(20000 * scale))
+    b = _edit_lines(rng, a, 0.05, lambda: _source_lines(rng, 1)[0])
+    return lambda: mod.SequenceMatcher(None, a, b).get_matching_blocks()
+
+
+def close_matches(mod, rng, scale):
+    words = [_random_string(rng, rng.randrange(4, 12), string.ascii_lowercase) for _ in range(int(50000 * scale))]
+    queries = [rng.choice(words)[::-1] for _ in range(20)]
+    return lambda: [mod.get_close_matches(query, words) for query in queries]
+
+
+def ndiff_replace_heavy(mod, rng, scale):
+    a = [_random_string(rng, 60) + "\n" for _ in range(int(2000 * scale))]
+    b = ["".join(c if rng.random() < 0.9 else rng.choice(string.ascii_letters) for c in line) for line in a]
+    return lambda: list(mod.ndiff(a, b))
+
+
+def unified_diff_large(mod, rng, scale):
+    a = _source_lines(rng, int(200000 * scale))
+    b = _edit_lines(rng, a, 0.01, lambda: _source_lines(rng, 1)[0])
+    return lambda: list(mod.unified_diff(a, b, "a", "b"))
+
+
+def html_make_file(mod, rng, scale):
+    a = [_random_string(rng, 60) + "\n" for _ in range(int(2000 * scale))]
+    b = _edit_lines(rng, a, 0.05, lambda: _random_string(rng, 60) + "\n")
+    return lambda: mod.HtmlDiff().make_file(a, b, context=True)
+
+
+CASES = {
+    func.__name__: func
+    for func in (
+        matching_blocks_long_strings,
+        ratio_long_strings,
+        matching_blocks_lines,
+        matching_blocks_junk,
+        matching_blocks_autojunk,
+        close_matches,
+        ndiff_replace_heavy,
+        unified_diff_large,
+        html_make_file,
+    )
+}
+
+
+def _make(case, implementation, scale):
+    mod = importlib.import_module(implementation)
+    return CASES[case](mod, random.Random(18), scale)
+
+
+def measure_time(case, implementation, scale, repeat):
+    func = _make(case, implementation, scale)
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return [t / number for t in timer.repeat(repeat, number)]
+
+
+def measure_memory(case, implementation, scale):
+    """Peak memory of one call in bytes, measured in a new process"""
+    if resource is None:
+        return None
+    out = subprocess.run(
+        [sys.executable, __file__, "_memory", case, implementation, str(scale)],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return int(out.stdout)
+
+
+def _proc_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def _reset_peak():
+    # Linux can reset the peak RSS, so the memory used to create the inputs
+    # doesn't hide the peak of the call
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def _memory_child(case, implementation, scale):
+    func = _make(case, implementation, scale)
+    if _reset_peak():
+        before = _proc_status("VmRSS")
+        func()
+        print(_proc_status("VmHWM") - before)
+        return
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB everywhere else
+    unit = 1 if sys.platform == "darwin" else 1024
+    print((after - before) * unit)
+
+
+def _metadata():
+    import cydifflib
+
+    return {
+        "cydifflib": cydifflib.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run(args):
+    cases = [name for name in CASES if not args.k or any(k in name for k in args.k)]
+    results = []
+    for case in cases:
+        for implementation in args.implementations:
+            times = measure_time(case, implementation, args.scale, args.repeat)
+            memory = None if args.no_memory else measure_memory(case, implementation, args.scale)
+            results.append(
+                {"case": case, "implementation": implementation, "time": min(times), "times": times, "memory": memory}
+            )
+            memory_text = "-" if memory is None else f"{memory / 2**20:.1f} MiB"
+            print(f"{case:32} {implementation:10} {min(times) * 1000:10.3f} ms {memory_text:>12}", file=sys.stderr)
+
+    report = {"metadata": _metadata(), "scale": args.scale, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get("scale") != current.get("scale"):
+        print("warning: the runs use different scales", file=sys.stderr)
+
+    old = {(r["case"], r["implementation"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"{'case':32} {'implementation':14} {'time':>8} {'memory':>8}")
+    for result in current["results"]:
+        key = (result["case"], result["implementation"])
+        if key not in old:
+            continue
+        time_ratio = result["time"] / old[key]["time"]
+        memory_ratio = None
+        if result["memory"] is not None and old[key]["memory"] is not None:
+            # changes of less than 1 MiB are noise
+            memory_ratio = (result["memory"] + 2**20) / (old[key]["memory"] + 2**20)
+        flags = []
+        if time_ratio > 1 + args.threshold:
+            flags.append("slower")
+        if memory_ratio is not None and memory_ratio > 1 + args.threshold:
+            flags.append("more memory")
+        regressions += bool(flags)
+        memory_text = "-" if memory_ratio is None else f"{memory_ratio:.2f}x"
+        print(f"{key[0]:32} {key[1]:14} {time_ratio:7.2f}x {memory_text:>8}  {', '.join(flags)}")
+
+    if regressions:
+        print(f"{regressions} regression(s) above {args.threshold:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", help="JSON file to write, stdout by default")
+    run_parser.add_argument("-k", action="append", help="only run cases containing this string")
+    run_parser.add_argument(
+        "-i", "--implementations", nargs="+", choices=IMPLEMENTATIONS, default=list(IMPLEMENTATIONS)
+    )
+    run_parser.add_argument("--scale", type=float, default=1.0, help="multiply the input sizes")
+    run_parser.add_argument("--repeat", type=int, default=5, help="number of timings per case")
+    run_parser.add_argument("--no-memory", action="store_true", help="skip measuring the peak memory")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative increase")
+    compare_parser.set_defaults(func=compare)
+
+    memory_parser = subparsers.add_parser("_memory")
+    memory_parser.add_argument("case")
+    memory_parser.add_argument("implementation")
+    memory_parser.add_argument("scale", type=float)
+    memory_parser.set_defaults(func=lambda args: _memory_child(args.case, args.implementation, args.scale))
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
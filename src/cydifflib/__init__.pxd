@@ -0,0 +1,47 @@
+# distutils: language=c++
+# cython: language_level=3
+"""C API of cydifflib for other Cython extensions.
+
+The functions compare sequences of int64_t keys (e.g. token ids or hashes)
+without the GIL and write their results into arrays of the caller:
+
+    from libc.stdint cimport int64_t
+    from cydifflib cimport CMatch, DiffIndex, diff_index_new, diff_index_free, diff_matching_blocks
+
+    cdef DiffIndex* index = diff_index_new(b, lb, NULL, NULL, True)
+    cdef CMatch blocks[64]
+    cdef Py_ssize_t count = diff_matching_blocks(index, a, la, blocks, 64)
+    diff_index_free(index)
+
+The extension has to be compiled as C++ and cydifflib has to be imported
+before these functions are used, which the cimport does automatically.
+
+diff_index_new(b, lb, isjunk, context, autojunk)
+    Index b[:lb] as second sequence, the same as SequenceMatcher(isjunk, a,
+    b, autojunk) does.  isjunk(key, context) is called once per distinct
+    key of b and may be NULL.  The index is freed with diff_index_free()
+    and is never modified, so it can be used from multiple threads.
+
+diff_matching_blocks(index, a, la, out, size)
+diff_opcodes(index, a, la, out, size)
+    Compute get_matching_blocks() or get_opcodes() of a[:la] and the
+    indexed sequence.  At most size results are written to out and the
+    number of results is returned, so if it is larger than size the call
+    has to be repeated with a larger array.  A negative size raises
+    ValueError.  The tag of an opcode is one
+    of TAG_REPLACE, TAG_DELETE, TAG_INSERT and TAG_EQUAL.
+
+diff_ratio(index, a, la, score_cutoff)
+    Compute ratio() of a[:la] and the indexed sequence.  Like
+    SequenceMatcher.ratio(score_cutoff), 0.0 is returned as soon as the
+    ratio can't reach score_cutoff.
+
+All functions return -1 (or NULL) with an exception set if they run out
+of memory or get invalid arguments.
+"""
+
+from cydifflib._initialize cimport (
+    CMatch, COpcode, OpcodeTag, TAG_REPLACE, TAG_DELETE, TAG_INSERT, TAG_EQUAL,
+    DiffIndex, diff_isjunk_t, diff_index_new, diff_index_free,
+    diff_matching_blocks, diff_opcodes, diff_ratio,
+)
@@ -0,0 +1,74 @@
+# distutils: language=c++
+# cython: language_level=3
+
+# C level declarations of cydifflib._initialize.  The public part is
+# re-exported by cydifflib/__init__.pxd, see there.
+
+from libc.stdint cimport int64_t
+from libcpp.vector cimport vector
+from libcpp.unordered_map cimport unordered_map
+
+ctypedef struct CMatch:
+    Py_ssize_t a
+    Py_ssize_t b
+    Py_ssize_t size
+
+cdef enum OpcodeTag:
+    TAG_REPLACE
+    TAG_DELETE
+    TAG_INSERT
+    TAG_EQUAL
+
+ctypedef struct COpcode:
+    Py_ssize_t tag
+    Py_ssize_t i1
+    Py_ssize_t i2
+    Py_ssize_t j1
+    Py_ssize_t j2
+
+# Read-only view on the index of the second sequence.  Both sequences are
+# mapped to dense integer codes (every distinct element of b gets a code in
+# range(nkeys), elements of a which do not occur in b get the code -1), so
+# the matching code never has to touch a Python object.  For each code x,
+# positions[offsets[x]:offsets[x+1]] are the indices into b at which x
+# appears (in increasing order); junk and popular elements have an empty
+# range, which is the CSR equivalent of not appearing in b2j.
+ctypedef struct BIndexView:
+    Py_ssize_t lb
+    Py_ssize_t nkeys
+    const Py_ssize_t* b
+    const Py_ssize_t* counts
+    const Py_ssize_t* offsets
+    const Py_ssize_t* positions
+    const char* junk
+
+# mapping of the raw keys of a natively indexed sequence to codes
+ctypedef struct KeyMap:
+    # codes of the keys in range(256) or -1
+    vector[Py_ssize_t] small
+    unordered_map[int64_t, Py_ssize_t] large
+    # code -> key
+    vector[int64_t] values
+
+# isjunk of diff_index_new()
+ctypedef bint (*diff_isjunk_t)(int64_t key, void* context) noexcept nogil
+
+# index of a sequence of int64_t keys built by diff_index_new()
+cdef cppclass DiffIndex:
+    KeyMap keymap
+    vector[Py_ssize_t] codes
+    vector[Py_ssize_t] counts
+    vector[Py_ssize_t] offsets
+    vector[Py_ssize_t] positions
+    vector[char] junk
+    BIndexView view
+
+cdef DiffIndex* diff_index_new(const int64_t* b, Py_ssize_t lb, diff_isjunk_t isjunk, void* context,
+                               bint autojunk) except NULL nogil
+cdef void diff_index_free(DiffIndex* index) noexcept nogil
+cdef Py_ssize_t diff_matching_blocks(const DiffIndex* index, const int64_t* a, Py_ssize_t la,
+                                     CMatch* out, Py_ssize_t size) except -1 nogil
+cdef Py_ssize_t diff_opcodes(const DiffIndex* index, const int64_t* a, Py_ssize_t la,
+                             COpcode* out, Py_ssize_t size) except -1 nogil
+cdef double diff_ratio(const DiffIndex* index, const int64_t* a, Py_ssize_t la,
+                       double score_cutoff) except -1 nogil
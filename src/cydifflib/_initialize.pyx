@@ -1,25 +1,58 @@
 # distutils: language=c++
-# cython: language_level=3, binding=True, linetrace=True
+# cython: language_level=3, binding=True
 
 __all__ = ['get_close_matches', 'ndiff', 'restore', 'SequenceMatcher',
            'Differ','IS_CHARACTER_JUNK', 'IS_LINE_JUNK', 'context_diff',
-           'unified_diff', 'diff_bytes', 'HtmlDiff', 'Match']
+           'unified_diff', 'diff_bytes', 'HtmlDiff', 'Match', 'MatchingBlocks',
+           'Opcodes', 'CloseMatcher', 'cdist', 'side_by_side',
+           'unified_diff_files', 'context_diff_files', 'PreparedSequence',
+           'diff_many', 'enable_stats', 'disable_stats', 'get_stats', 'reset_stats',
+           'set_intraline_cache_size', 'intraline_cache_info', 'intraline_cache_clear',
+           'format_unified_diff', 'format_context_diff', 'apply_unified_diff',
+           'revert_unified_diff']
 
 from heapq import nlargest as _nlargest
+from pickle import PickleBuffer as _PickleBuffer
+from os import cpu_count as _cpu_count
+from collections import deque as _deque, OrderedDict as _OrderedDict
+from tempfile import SpooledTemporaryFile as _SpooledTemporaryFile
 from collections import namedtuple as _namedtuple
+from os import fstat as _fstat
+from mmap import mmap as _mmap, ACCESS_READ as _ACCESS_READ
+from codecs import lookup as _lookup_codec, getincrementaldecoder as _getincrementaldecoder
 # todo add this once it is supported in all Python versions
 #from types import GenericAlias
 
 cimport cython
+from cython.operator cimport dereference as deref
+from cpython.buffer cimport (PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release,
+                             PyBUF_FORMAT, PyBUF_STRIDES, PyBUF_WRITABLE,
+                             PyBUF_SIMPLE)
+from cpython.unicode cimport (PyUnicode_KIND, PyUnicode_DATA, PyUnicode_GET_LENGTH,
+                              PyUnicode_1BYTE_KIND, PyUnicode_2BYTE_KIND, PyUnicode_4BYTE_KIND,
+                              PyUnicode_FromKindAndData, PyUnicode_Decode,
+                              PyUnicode_New, PyUnicode_CopyCharacters, PyUnicode_WRITE)
+from libc.stdint cimport (int8_t, uint8_t, int16_t, uint16_t, int32_t, uint32_t,
+                          int64_t, uint64_t, INT64_MAX)
 from libcpp.vector cimport vector
-from libcpp.algorithm cimport fill, sort as cpp_sort
+from libcpp.algorithm cimport sort as cpp_sort, lower_bound
+from libcpp.queue cimport priority_queue
+from libcpp.utility cimport pair
+from libcpp.atomic cimport atomic, memory_order_relaxed
 from libc.stdlib cimport malloc, free
+from libc.string cimport memchr, memcmp, memcpy
+from cpython cimport array as cpython_array
+from cpython.pyport cimport PY_SSIZE_T_MAX
+from cpython.ref cimport PyObject
+from cpython.list cimport PyList_GET_ITEM
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING, PyBytes_GET_SIZE
+from cpython.bytearray cimport PyByteArray_AS_STRING, PyByteArray_GET_SIZE
 from libcpp.unordered_map cimport unordered_map
 
-Match = _namedtuple('Match', 'a b size')
+Match = _namedtuple('Match', 'a b size', module=__name__)
 
 @cython.cdivision(True)
-cdef double _calculate_ratio(Py_ssize_t matches, Py_ssize_t length) except -1.0:
+cdef double _calculate_ratio(Py_ssize_t matches, Py_ssize_t length) noexcept nogil:
     if length:
         return 2.0 * matches / length
     return 1.0
@@ -30,18 +63,2161 @@ ctypedef struct MatchingBlockQueueElem:
     Py_ssize_t blo
     Py_ssize_t bhi
 
-ctypedef struct CMatch:
-    Py_ssize_t a
-    Py_ssize_t b
+# Node of the search of _get_matching_blocks.  The nodes are stored in the
+# order they are searched, so the nodes below a node directly follow it.
+ctypedef struct MatchNode:
+    Py_ssize_t alo
+    Py_ssize_t ahi
+    Py_ssize_t blo
+    Py_ssize_t bhi
+    # longest junk-free match of the range and the same match extended by
+    # junk, which is the matching block of the range
+    CMatch core
+    CMatch match
+    # index of the parent node or -1 and the number of nodes in the subtree
+    Py_ssize_t parent
     Py_ssize_t size
 
-cdef int CMatch_sorter(const CMatch& lhs, const CMatch& rhs):
+cdef int CMatch_sorter(const CMatch& lhs, const CMatch& rhs) noexcept nogil:
     if lhs.a != rhs.a:
         return lhs.a < rhs.a
     if lhs.b != rhs.b:
         return lhs.b < rhs.b
     return lhs.size < rhs.size
 
+# the tags as returned by get_opcodes, indexed by OpcodeTag
+_tag_names = ('replace', 'delete', 'insert', 'equal')
+
+cdef int _get_opcodes(const vector[CMatch]& matching_blocks, vector[COpcode]& answer) except -1 nogil:
+    cdef Py_ssize_t i = 0, j = 0
+    cdef Py_ssize_t ai, bj, size
+    cdef Py_ssize_t tag
+    cdef size_t k
+    answer.clear()
+    for k in range(matching_blocks.size()):
+        ai, bj, size = matching_blocks[k].a, matching_blocks[k].b, matching_blocks[k].size
+        # invariant:  we've pumped out correct diffs to change
+        # a[:i] into b[:j], and the next matching block is
+        # a[ai:ai+size] == b[bj:bj+size].  So we need to pump
+        # out a diff to change a[i:ai] into b[j:bj], pump out
+        # the matching block, and move (i,j) beyond the match
+        tag = -1
+        if i < ai and j < bj:
+            tag = TAG_REPLACE
+        elif i < ai:
+            tag = TAG_DELETE
+        elif j < bj:
+            tag = TAG_INSERT
+        if tag >= 0:
+            answer.push_back(COpcode(tag, i, ai, j, bj))
+        i, j = ai+size, bj+size
+        # the list of matching blocks is terminated by a
+        # sentinel with size 0
+        if size:
+            answer.push_back(COpcode(TAG_EQUAL, ai, i, bj, j))
+    return 0
+
+cdef class _ResultArray:
+    """Common base of MatchingBlocks and Opcodes.
+
+    The results are stored as array of Py_ssize_t records and are only
+    converted to Python tuples when they are accessed.  The array is
+    exposed read-only through the buffer protocol as a 2-D array of
+    Py_ssize_t.
+
+    budget_exceeded is True if the work budget of the SequenceMatcher
+    was used up, so the results may be less minimal than usual.
+    """
+
+    cdef Py_ssize_t shape[2]
+    cdef Py_ssize_t strides[2]
+    # number of buffers exported by __getbuffer__, which point into the
+    # records, so they must not be reallocated meanwhile
+    cdef int exports
+    cdef readonly bint budget_exceeded
+
+    cdef Py_ssize_t _size(self):
+        return 0
+
+    cdef const Py_ssize_t* _data(self):
+        return NULL
+
+    cdef Py_ssize_t _fields(self):
+        return 0
+
+    cdef object _item(self, Py_ssize_t index):
+        return None
+
+    cdef int _check_writable(self) except -1:
+        if self.exports:
+            raise BufferError(f"cannot modify {type(self).__name__} while its buffer is exported")
+        return 0
+
+    def __len__(self):
+        return self._size()
+
+    def __getitem__(self, index):
+        cdef Py_ssize_t i
+        cdef Py_ssize_t size = self._size()
+        if isinstance(index, slice):
+            return [self._item(i) for i in range(*index.indices(size))]
+        i = index
+        if i < 0:
+            i += size
+        if i < 0 or i >= size:
+            raise IndexError(f"{type(self).__name__} index out of range")
+        return self._item(i)
+
+    def __iter__(self):
+        cdef Py_ssize_t i
+        for i in range(self._size()):
+            yield self._item(i)
+
+    def __reversed__(self):
+        cdef Py_ssize_t i
+        for i in reversed(range(self._size())):
+            yield self._item(i)
+
+    def __eq__(self, other):
+        if isinstance(other, _ResultArray):
+            return type(self) is type(other) and list(self) == list(other)
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"{type(self).__name__}({list(self)!r})"
+
+    def __reduce__(self):
+        # the records are pickled as raw bytes instead of one tuple each
+        return (_restore_results, (type(self), bytes(memoryview(self).cast("B")), self.budget_exceeded))
+
+    def __getbuffer__(self, Py_buffer* buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError(f"{type(self).__name__} is read-only")
+        self.shape[0] = self._size()
+        self.shape[1] = self._fields()
+        self.strides[0] = self._fields() * sizeof(Py_ssize_t)
+        self.strides[1] = sizeof(Py_ssize_t)
+        buffer.buf = <void*>self._data()
+        buffer.obj = self
+        buffer.len = self.shape[0] * self.strides[0]
+        buffer.readonly = 1
+        buffer.itemsize = sizeof(Py_ssize_t)
+        buffer.format = NULL
+        if flags & PyBUF_FORMAT:
+            buffer.format = b"n"
+        buffer.ndim = 2
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+        self.exports += 1
+
+    def __releasebuffer__(self, Py_buffer* buffer):
+        self.exports -= 1
+
+    def as_numpy(self):
+        """Return the results as 2-D numpy array without copying them."""
+        import numpy as np
+        return np.asarray(self)
+
+
+def _restore_results(cls, bytes data, bint budget_exceeded):
+    """Unpickle a MatchingBlocks or Opcodes, see _ResultArray.__reduce__()"""
+    cdef _ResultArray self
+    cdef Py_ssize_t record, size
+    cdef Py_ssize_t* records
+    if cls is not MatchingBlocks and cls is not Opcodes:
+        raise TypeError(f"cannot restore {cls!r}")
+    self = cls()
+    record = self._fields() * sizeof(Py_ssize_t)
+    if len(data) % record:
+        raise ValueError(f"invalid {cls.__name__} data")
+    if data:
+        size = len(data) // record
+        if cls is MatchingBlocks:
+            records = (<MatchingBlocks>self)._resize(size)
+        else:
+            records = (<Opcodes>self)._resize(size)
+        memcpy(records, <const char*>data, len(data))
+    self.budget_exceeded = budget_exceeded
+    return self
+
+
+@cython.final
+cdef class MatchingBlocks(_ResultArray):
+    """Sequence of Match triples as returned by get_matching_blocks().
+
+    As numpy array every row holds the fields (a, b, size).
+
+    >>> s = SequenceMatcher(None, "abxcd", "abcd")
+    >>> blocks = s.get_matching_blocks()
+    >>> blocks[1]
+    Match(a=3, b=2, size=2)
+    >>> memoryview(blocks).tolist()
+    [[0, 0, 2], [3, 2, 2], [5, 4, 0]]
+    """
+
+    cdef vector[CMatch] blocks
+    # nodes of the search which found the blocks, used by replace_a() and
+    # replace_b() of SequenceMatcher; empty if not known
+    cdef vector[MatchNode] nodes
+
+    def __init__(self, blocks=()):
+        self._check_writable()
+        self.blocks.clear()
+        self.nodes.clear()
+        for a, b, size in blocks:
+            self.blocks.push_back(CMatch(a, b, size))
+
+    cdef Py_ssize_t _size(self):
+        return self.blocks.size()
+
+    cdef const Py_ssize_t* _data(self):
+        return <const Py_ssize_t*>self.blocks.data()
+
+    cdef Py_ssize_t* _resize(self, Py_ssize_t size) except NULL:
+        self._check_writable()
+        self.blocks.resize(size)
+        return <Py_ssize_t*>self.blocks.data()
+
+    cdef Py_ssize_t _fields(self):
+        return 3
+
+    cdef object _item(self, Py_ssize_t index):
+        cdef CMatch* match = &self.blocks[index]
+        return Match(match.a, match.b, match.size)
+
+
+@cython.final
+cdef class Opcodes(_ResultArray):
+    """Sequence of (tag, i1, i2, j1, j2) tuples as returned by get_opcodes().
+
+    As numpy array every row holds the fields (tag, i1, i2, j1, j2), where
+    tag is the index of the tag in Opcodes.tags.
+
+    >>> s = SequenceMatcher(None, "qabxcd", "abycdf")
+    >>> opcodes = s.get_opcodes()
+    >>> opcodes[0]
+    ('delete', 0, 1, 0, 0)
+    >>> memoryview(opcodes).tolist()[0]
+    [1, 0, 1, 0, 0]
+    >>> Opcodes.tags[1]
+    'delete'
+    """
+
+    tags = _tag_names
+
+    cdef vector[COpcode] opcodes
+
+    def __init__(self, opcodes=()):
+        self._check_writable()
+        self.opcodes.clear()
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.opcodes.push_back(COpcode(_tag_names.index(tag), i1, i2, j1, j2))
+
+    cdef Py_ssize_t _size(self):
+        return self.opcodes.size()
+
+    cdef const Py_ssize_t* _data(self):
+        return <const Py_ssize_t*>self.opcodes.data()
+
+    cdef Py_ssize_t* _resize(self, Py_ssize_t size) except NULL:
+        self._check_writable()
+        self.opcodes.resize(size)
+        return <Py_ssize_t*>self.opcodes.data()
+
+    cdef Py_ssize_t _fields(self):
+        return 5
+
+    cdef object _item(self, Py_ssize_t index):
+        cdef COpcode* op = &self.opcodes[index]
+        return (_tag_names[op.tag], op.i1, op.i2, op.j1, op.j2)
+
+
+cdef enum Algorithm:
+    ALGORITHM_GESTALT
+    ALGORITHM_MYERS
+    ALGORITHM_HISTOGRAM
+
+_algorithms = {'gestalt': ALGORITHM_GESTALT, 'myers': ALGORITHM_MYERS, 'histogram': ALGORITHM_HISTOGRAM}
+
+cdef Algorithm _get_algorithm(algorithm) except *:
+    try:
+        return _algorithms[algorithm]
+    except (KeyError, TypeError):
+        raise ValueError("algorithm must be one of %s: %r"
+                         % (", ".join(map(repr, _algorithms)), algorithm)) from None
+
+cdef int _get_budget(max_cost, timeout, Py_ssize_t* c_max_cost, double* c_timeout) except -1:
+    # None stands for no limit, which is PY_SSIZE_T_MAX steps or a
+    # negative timeout
+    c_max_cost[0] = PY_SSIZE_T_MAX
+    c_timeout[0] = -1
+    if max_cost is not None:
+        if max_cost < 0:
+            raise ValueError("max_cost must be None or >= 0: %r" % (max_cost,))
+        c_max_cost[0] = min(max_cost, PY_SSIZE_T_MAX)
+    if timeout is not None:
+        if not timeout >= 0:
+            raise ValueError("timeout must be None or >= 0: %r" % (timeout,))
+        c_timeout[0] = timeout
+    return 0
+
+cdef extern from *:
+    """
+    #include <chrono>
+    static inline double cydifflib_monotonic(void) {
+        return std::chrono::duration<double>(std::chrono::steady_clock::now().time_since_epoch()).count();
+    }
+    """
+    double _monotonic "cydifflib_monotonic"() noexcept nogil
+
+cdef enum:
+    # steps of the matching code between two looks at the clock
+    BUDGET_CLOCK_INTERVAL = 4096
+
+# Work budget of the matching code.  cost counts the steps of the inner
+# loops.  Once it reaches max_cost, the deadline passed or the search was
+# cancelled, the remaining regions are only matched at their ends and
+# exceeded is set.
+ctypedef struct Budget:
+    Py_ssize_t cost
+    Py_ssize_t max_cost
+    # cost at which the budget is checked the next time
+    Py_ssize_t next_check
+    # deadline on the clock of _monotonic() or -1
+    double deadline
+    # set by another thread to cancel the search or NULL
+    atomic[bint]* cancelled
+    bint exceeded
+
+cdef void _init_budget(Budget* budget, Py_ssize_t max_cost, double timeout,
+                       atomic[bint]* cancelled) noexcept nogil:
+    budget.cost = 0
+    budget.max_cost = max_cost
+    budget.exceeded = False
+    budget.deadline = -1
+    budget.cancelled = cancelled
+    budget.next_check = max_cost
+    if timeout >= 0:
+        budget.deadline = _monotonic() + timeout
+    if timeout >= 0 or cancelled != NULL:
+        budget.next_check = 0
+
+cdef bint _update_budget(Budget* budget) noexcept nogil:
+    if not budget.exceeded:
+        if budget.cost >= budget.max_cost:
+            budget.exceeded = True
+        elif budget.cancelled != NULL and budget.cancelled.load(memory_order_relaxed):
+            budget.exceeded = True
+        elif budget.deadline >= 0 and _monotonic() >= budget.deadline:
+            budget.exceeded = True
+        elif budget.deadline >= 0 or budget.cancelled != NULL:
+            budget.next_check = min(budget.cost + BUDGET_CLOCK_INTERVAL, budget.max_cost)
+        else:
+            budget.next_check = budget.max_cost
+    if budget.exceeded:
+        budget.next_check = 0
+    return budget.exceeded
+
+cdef inline bint _budget_exceeded(Budget* budget) noexcept nogil:
+    """Returns True once the budget is used up; budget may be NULL"""
+    if budget == NULL or budget.cost < budget.next_check:
+        return False
+    return _update_budget(budget)
+
+cdef void _match_ends(const Py_ssize_t* a, Py_ssize_t alo, Py_ssize_t ahi,
+                      const Py_ssize_t* b, Py_ssize_t blo, Py_ssize_t bhi,
+                      vector[CMatch]& matching_blocks) noexcept nogil:
+    # Fallback once the budget is used up: only the equal elements at the
+    # start and at the end of the range are matched
+    cdef Py_ssize_t k = 0
+    while alo + k < ahi and blo + k < bhi and a[alo + k] == b[blo + k]:
+        k += 1
+    if k:
+        matching_blocks.push_back(CMatch(alo, blo, k))
+        alo += k
+        blo += k
+    k = 0
+    while ahi - k > alo and bhi - k > blo and a[ahi - k - 1] == b[bhi - k - 1]:
+        k += 1
+    if k:
+        matching_blocks.push_back(CMatch(ahi - k, bhi - k, k))
+
+# Counters of the matching code, which are only collected while
+# enable_stats() is active
+ctypedef struct MatchStats:
+    # calls of _find_longest_core
+    Py_ssize_t find_longest_match_calls
+    # positions of b visited by the inner loop of _find_longest_core
+    Py_ssize_t candidates
+    # maximum number of regions in the queue of _get_matching_blocks
+    Py_ssize_t max_queue
+
+# Scratch space of the matching code.  This is allocated per call, so a
+# SequenceMatcher can be used from multiple threads at the same time.
+ctypedef struct MatchScratch:
+    Py_ssize_t* j2len
+    Py_ssize_t* newj2len
+    Py_ssize_t* touched
+    Py_ssize_t* newtouched
+    # work budget of the search or NULL
+    Budget* budget
+    # counters or NULL
+    MatchStats* stats
+
+cdef int _init_scratch(MatchScratch* scratch, vector[Py_ssize_t]& buffer, Py_ssize_t lb) except -1 nogil:
+    # j2len and newj2len are zero filled arrays of size lb + 1, which are
+    # zero filled again when _find_longest_match returns.  touched and
+    # newtouched are arrays of size lb, which keep track of the entries
+    # set in j2len, so they can be reset without clearing the whole b
+    # range for every element of a
+    buffer.assign(<size_t>(4 * lb + 2), 0)
+    scratch.j2len = buffer.data()
+    scratch.newj2len = scratch.j2len + lb + 1
+    scratch.touched = scratch.newj2len + lb + 1
+    scratch.newtouched = scratch.touched + lb
+    scratch.budget = NULL
+    scratch.stats = NULL
+    return 0
+
+# totals of enable_stats() or None while it is not active
+cdef dict _stats = None
+cdef object _stats_callback = None
+
+def enable_stats(callback=None):
+    """Start collecting statistics about the work of SequenceMatcher.
+
+    While enabled, every index built for a second sequence and every
+    search for matching blocks (get_matching_blocks() and ratio()) is
+    recorded in a dict, which is added to the totals returned by
+    get_stats() and passed to callback if it is not None.  The dict of an
+    index has the items
+
+    - 'event': 'index'
+    - 'length': len(b)
+    - 'junk', 'popular': number of elements of b purged as junk or popular
+    - 'time': seconds spent building the index
+
+    and the dict of a search the items
+
+    - 'event': 'match'
+    - 'algorithm': the algorithm of the SequenceMatcher
+    - 'la', 'lb': the lengths of the sequences
+    - 'find_longest_match_calls': number of searches for a longest match
+    - 'candidates': positions of b visited by these searches
+    - 'max_queue': maximum number of regions waiting to be searched
+    - 'time': seconds spent searching
+
+    The last three counters are only collected by the 'gestalt'
+    algorithm.  The matching code is not instrumented while statistics
+    are disabled, so this costs nothing unless it is used.
+
+    >>> enable_stats()
+    >>> SequenceMatcher(None, "abxcd", "abcd").ratio()
+    0.8888888888888888
+    >>> stats = get_stats()
+    >>> stats['index_calls'], stats['match_calls'], stats['find_longest_match_calls']
+    (1, 1, 2)
+    >>> disable_stats()
+    """
+    global _stats, _stats_callback
+    if _stats is None:
+        _stats = {}
+        reset_stats()
+    _stats_callback = callback
+
+def disable_stats():
+    """Stop collecting statistics, see enable_stats()"""
+    global _stats, _stats_callback
+    _stats = _stats_callback = None
+
+def get_stats():
+    """Return the totals collected since enable_stats() or reset_stats().
+
+    The dict has the items 'index_calls', 'index_time', 'junk' and
+    'popular' summed over all indexes and the items 'match_calls',
+    'match_time', 'find_longest_match_calls' and 'candidates' summed over
+    all searches, while 'max_queue' is the maximum of all searches.
+    Returns None if statistics are disabled.
+    """
+    return None if _stats is None else dict(_stats)
+
+def reset_stats():
+    """Set the totals returned by get_stats() back to zero"""
+    if _stats is not None:
+        _stats.update(index_calls=0, index_time=0.0, junk=0, popular=0, match_calls=0, match_time=0.0,
+                      find_longest_match_calls=0, candidates=0, max_queue=0)
+
+cdef int _record_stats(dict record) except -1:
+    cdef dict totals = _stats
+    if totals is None:
+        return 0
+    if record['event'] == 'index':
+        totals['index_calls'] += 1
+        totals['index_time'] += record['time']
+        totals['junk'] += record['junk']
+        totals['popular'] += record['popular']
+    else:
+        totals['match_calls'] += 1
+        totals['match_time'] += record['time']
+        totals['find_longest_match_calls'] += record['find_longest_match_calls']
+        totals['candidates'] += record['candidates']
+        totals['max_queue'] = max(totals['max_queue'], record['max_queue'])
+    if _stats_callback is not None:
+        _stats_callback(record)
+    return 0
+
+cdef inline const Py_ssize_t* _lower_bound(const Py_ssize_t* first, const Py_ssize_t* last,
+                                           Py_ssize_t value) noexcept nogil:
+    cdef const Py_ssize_t* it
+    cdef Py_ssize_t count = last - first
+    cdef Py_ssize_t step
+    while count > 0:
+        step = count // 2
+        it = first + step
+        if it[0] < value:
+            first = it + 1
+            count -= step + 1
+        else:
+            count = step
+    return first
+
+cdef CMatch _find_longest_core(const BIndexView* bidx, const Py_ssize_t* a,
+                               Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi,
+                               MatchScratch* scratch) noexcept nogil:
+    # Longest junk-free match in a[alo:ahi] and b[blo:bhi].  Of several
+    # longest matches the one ending first in a and then in b is returned.
+    cdef Py_ssize_t* j2len = scratch.j2len
+    cdef Py_ssize_t* newj2len = scratch.newj2len
+    cdef Py_ssize_t* touched = scratch.touched
+    cdef Py_ssize_t* newtouched = scratch.newtouched
+    cdef Budget* budget = scratch.budget
+    cdef MatchStats* stats = scratch.stats
+    cdef const Py_ssize_t* it
+    cdef const Py_ssize_t* first
+    cdef const Py_ssize_t* last
+    cdef Py_ssize_t* tmp
+    cdef Py_ssize_t besti = alo, bestj = blo, bestsize = 0
+    cdef Py_ssize_t i, j, k, code, x
+    cdef Py_ssize_t ntouched = 0, nnewtouched = 0
+
+    if stats != NULL:
+        stats.find_longest_match_calls += 1
+
+    # CAUTION:  stripping common prefix or suffix would be incorrect.
+    # E.g.,
+    #    ab
+    #    acab
+    # Longest matching block is "ab", but if common prefix is
+    # stripped, it's "a" (tied with "b").  UNIX(tm) diff does so
+    # strip, so ends up claiming that ab is changed to acab by
+    # inserting "ca" in the middle.  That's minimal but unintuitive:
+    # "it's obvious" that someone inserted "ac" at the front.
+    # Windiff ends up at the same place as diff, but by pairing up
+    # the unique 'b's and then matching the first two 'a's.
+
+    # find longest junk-free match
+    # during an iteration of the loop, j2len[j+1] = length of longest
+    # junk-free match ending with a[i-1] and b[j]
+    for i in range(alo, ahi):
+        # once the budget is used up, the best match found so far is
+        # returned (which is still a valid match)
+        if _budget_exceeded(budget):
+            break
+        # look at all instances of a[i] in b; note that because
+        # junk and popular elements have no positions, the loop is
+        # skipped if a[i] is junk
+        code = a[i]
+        nnewtouched = 0
+        if code >= 0:
+            last = bidx.positions + bidx.offsets[code + 1]
+            first = it = _lower_bound(bidx.positions + bidx.offsets[code], last, blo)
+            while it != last:
+                # a[i] matches b[j]
+                j = it[0]
+                if j >= bhi:
+                    break
+                k = j2len[j] + 1
+                newj2len[j + 1] = k
+                newtouched[nnewtouched] = j + 1
+                nnewtouched += 1
+                if k > bestsize:
+                    besti = i-k+1
+                    bestj = j-k+1
+                    bestsize = k
+                it += 1
+            if budget != NULL:
+                budget.cost += it - first
+            if stats != NULL:
+                stats.candidates += it - first
+        if budget != NULL:
+            budget.cost += 1
+
+        for x in range(ntouched):
+            j2len[touched[x]] = 0
+        tmp = j2len
+        j2len = newj2len
+        newj2len = tmp
+        tmp = touched
+        touched = newtouched
+        newtouched = tmp
+        ntouched = nnewtouched
+
+    for x in range(ntouched):
+        j2len[touched[x]] = 0
+    return CMatch(besti, bestj, bestsize)
+
+cdef CMatch _extend_match(const BIndexView* bidx, const Py_ssize_t* a,
+                          Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi,
+                          CMatch core) noexcept nogil:
+    cdef const Py_ssize_t* b = bidx.b
+    cdef const char* isbjunk = bidx.junk
+    cdef Py_ssize_t besti = core.a, bestj = core.b, bestsize = core.size
+
+    # Extend the best by non-junk elements on each end.  In particular,
+    # "popular" non-junk elements aren't in b2j, which greatly speeds
+    # the inner loop above, but also means "the best" match so far
+    # doesn't contain any junk *or* popular non-junk elements.
+    while besti > alo and bestj > blo and \
+          not isbjunk[b[bestj-1]] and \
+          a[besti-1] == b[bestj-1]:
+        besti, bestj, bestsize = besti-1, bestj-1, bestsize+1
+    while besti+bestsize < ahi and bestj+bestsize < bhi and \
+          not isbjunk[b[bestj+bestsize]] and \
+          a[besti+bestsize] == b[bestj+bestsize]:
+        bestsize += 1
+
+    # Now that we have a wholly interesting match (albeit possibly
+    # empty!), we may as well suck up the matching junk on each
+    # side of it too.  Can't think of a good reason not to, and it
+    # saves post-processing the (possibly considerable) expense of
+    # figuring out what to do with it.  In the case of an empty
+    # interesting match, this is clearly the right thing to do,
+    # because no other kind of match is possible in the regions.
+    while besti > alo and bestj > blo and \
+          isbjunk[b[bestj-1]] and \
+          a[besti-1] == b[bestj-1]:
+        besti, bestj, bestsize = besti-1, bestj-1, bestsize+1
+    while besti+bestsize < ahi and bestj+bestsize < bhi and \
+          isbjunk[b[bestj+bestsize]] and \
+          a[besti+bestsize] == b[bestj+bestsize]:
+        bestsize = bestsize + 1
+
+    return CMatch(besti, bestj, bestsize)
+
+cdef inline CMatch _find_longest_match(const BIndexView* bidx, const Py_ssize_t* a,
+                                       Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi,
+                                       MatchScratch* scratch) noexcept nogil:
+    return _extend_match(bidx, a, alo, ahi, blo, bhi,
+                         _find_longest_core(bidx, a, alo, ahi, blo, bhi, scratch))
+
+cdef void _count_subtrees(vector[MatchNode]& nodes) noexcept nogil:
+    cdef Py_ssize_t i
+    for i in range(<Py_ssize_t>nodes.size()):
+        nodes[i].size = 1
+    # children are always stored after their parent
+    for i in range(<Py_ssize_t>nodes.size() - 1, 0, -1):
+        nodes[nodes[i].parent].size += nodes[i].size
+
+cdef int _get_matching_blocks(const BIndexView* bidx, const Py_ssize_t* a, Py_ssize_t la,
+                              MatchScratch* scratch, vector[CMatch]& non_adjacent,
+                              vector[MatchNode]* nodes) except -1 nogil:
+    # nodes receives the nodes of the search unless it is NULL
+    cdef Py_ssize_t i, j, k, i1, j1, k1, i2, j2, k2
+    cdef Py_ssize_t alo, ahi, blo, bhi
+    cdef Py_ssize_t parent = -1
+    cdef vector[MatchingBlockQueueElem] queue
+    cdef vector[Py_ssize_t] parents
+    cdef vector[CMatch] matching_blocks
+    cdef MatchingBlockQueueElem elem
+    cdef CMatch core, x
+
+    # This is most naturally expressed as a recursive algorithm, but
+    # at least one user bumped into extreme use cases that exceeded
+    # the recursion limit on their box.  So, now we maintain a list
+    # ('queue`) of blocks we still need to look at, and append partial
+    # results to `matching_blocks` in a loop; the matches are sorted
+    # at the end.
+    queue.push_back(MatchingBlockQueueElem(0, la, 0, bidx.lb))
+    parents.push_back(-1)
+    while not queue.empty():
+        if scratch.stats != NULL and <Py_ssize_t>queue.size() > scratch.stats.max_queue:
+            scratch.stats.max_queue = queue.size()
+        elem = queue.back()
+        alo, ahi, blo, bhi = elem.alo, elem.ahi, elem.blo, elem.bhi
+        queue.pop_back()
+        parent = parents.back()
+        parents.pop_back()
+        if _budget_exceeded(scratch.budget):
+            _match_ends(a, alo, ahi, bidx.b, blo, bhi, matching_blocks)
+            continue
+        core = _find_longest_core(bidx, a, alo, ahi, blo, bhi, scratch)
+        x = _extend_match(bidx, a, alo, ahi, blo, bhi, core)
+        if nodes != NULL:
+            nodes.push_back(MatchNode(alo, ahi, blo, bhi, core, x, parent, 1))
+            parent = nodes.size() - 1
+        i, j, k = x.a, x.b, x.size
+        # a[alo:i] vs b[blo:j] unknown
+        # a[i:i+k] same as b[j:j+k]
+        # a[i+k:ahi] vs b[j+k:bhi] unknown
+        if k:   # if k is 0, there was no matching block
+            matching_blocks.push_back(x)
+            if alo < i and blo < j:
+                queue.push_back(MatchingBlockQueueElem(alo, i, blo, j))
+                parents.push_back(parent)
+            if i+k < ahi and j+k < bhi:
+                queue.push_back(MatchingBlockQueueElem(i+k, ahi, j+k, bhi))
+                parents.push_back(parent)
+    if nodes != NULL:
+        _count_subtrees(deref(nodes))
+    return _collapse_matching_blocks(matching_blocks, la, bidx.lb, non_adjacent)
+
+# An edit of one of the sequences: a[lo:hi] (or b[lo:hi] if on_b) was
+# replaced by size new elements.
+ctypedef struct SeqEdit:
+    bint on_b
+    Py_ssize_t lo
+    Py_ssize_t hi
+    Py_ssize_t size
+
+cdef enum:
+    # ranges containing an edit of at most this many elements are only
+    # searched around the edit if possible
+    REMATCH_SCAN_LIMIT = 16
+
+cdef inline uint64_t _range_hash(Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi) noexcept nogil:
+    cdef uint64_t h = <uint64_t>alo
+    h = h * 0x9E3779B97F4A7C15ULL + <uint64_t>ahi
+    h = h * 0x9E3779B97F4A7C15ULL + <uint64_t>blo
+    h = h * 0x9E3779B97F4A7C15ULL + <uint64_t>bhi
+    return h
+
+cdef inline bint _is_indexed(const BIndexView* bidx, Py_ssize_t code) noexcept nogil:
+    """True if the element with this code has positions (is neither junk nor popular)"""
+    return bidx.offsets[code] != bidx.offsets[code + 1]
+
+cdef inline bint _touches_edit(CMatch match, const SeqEdit* edit) noexcept nogil:
+    """True if match contains an element inside or next to the edit"""
+    cdef Py_ssize_t start = match.b if edit.on_b else match.a
+    return match.size > 0 and start <= edit.hi and start + match.size >= edit.lo
+
+cdef CMatch _core_at(const BIndexView* bidx, const Py_ssize_t* a,
+                     Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi,
+                     Py_ssize_t i, Py_ssize_t j) noexcept nogil:
+    # the junk-free match of the range that contains a[i] == b[j]
+    cdef const Py_ssize_t* b = bidx.b
+    cdef Py_ssize_t i2 = i + 1, j2 = j + 1
+    while i > alo and j > blo and a[i-1] == b[j-1] and _is_indexed(bidx, b[j-1]):
+        i, j = i-1, j-1
+    while i2 < ahi and j2 < bhi and a[i2] == b[j2] and _is_indexed(bidx, b[j2]):
+        i2, j2 = i2+1, j2+1
+    return CMatch(i, j, i2 - i)
+
+cdef inline bint _is_better_core(CMatch x, CMatch best) noexcept nogil:
+    # of several longest matches _find_longest_core returns the one ending
+    # first in a and then in b
+    if x.size != best.size:
+        return x.size > best.size
+    return x.a < best.a or (x.a == best.a and x.b < best.b)
+
+cdef CMatch _scan_edit(const BIndexView* bidx, const Py_ssize_t* a,
+                       Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi,
+                       const SeqEdit* edit, CMatch best) noexcept nogil:
+    # Result of _find_longest_core for a range containing the edit, when
+    # best is the longest junk-free match which does not touch the edit.
+    # Every other candidate contains an element inside or next to the edit.
+    cdef const Py_ssize_t* b = bidx.b
+    cdef const Py_ssize_t* it
+    cdef const Py_ssize_t* last
+    cdef Py_ssize_t i, j, code, wlo, whi
+    cdef CMatch x
+
+    if edit.on_b:
+        wlo = max(blo, edit.lo - 1)
+        whi = min(bhi, edit.lo + edit.size + 1)
+        for j in range(wlo, whi):
+            code = b[j]
+            if not _is_indexed(bidx, code):
+                continue
+            for i in range(alo, ahi):
+                # matches are only searched from their first element
+                # inside the window
+                if a[i] != code or (j > wlo and i > alo and a[i-1] == b[j-1] and _is_indexed(bidx, b[j-1])):
+                    continue
+                x = _core_at(bidx, a, alo, ahi, blo, bhi, i, j)
+                if _is_better_core(x, best):
+                    best = x
+    else:
+        wlo = max(alo, edit.lo - 1)
+        whi = min(ahi, edit.lo + edit.size + 1)
+        for i in range(wlo, whi):
+            code = a[i]
+            if code < 0 or not _is_indexed(bidx, code):
+                continue
+            last = bidx.positions + bidx.offsets[code + 1]
+            it = _lower_bound(bidx.positions + bidx.offsets[code], last, blo)
+            while it != last and it[0] < bhi:
+                j = it[0]
+                it += 1
+                if i > wlo and j > blo and a[i-1] == b[j-1] and _is_indexed(bidx, b[j-1]):
+                    continue
+                x = _core_at(bidx, a, alo, ahi, blo, bhi, i, j)
+                if _is_better_core(x, best):
+                    best = x
+    return best
+
+cdef int _rematch_blocks(const BIndexView* bidx, const Py_ssize_t* a, Py_ssize_t la,
+                         const vector[MatchNode]& old, const SeqEdit* edit, MatchScratch* scratch,
+                         vector[CMatch]& non_adjacent, vector[MatchNode]& nodes) except -1 nogil:
+    # Same as _get_matching_blocks after an edit of one of the sequences,
+    # where old are the nodes of the search before the edit.  The result of
+    # a range only depends on its elements, so ranges which do not contain
+    # the edit and were searched before reuse their subtree of nodes.  For
+    # ranges containing a small edit only the matches around the edit have
+    # to be compared against the match found before, unless that match
+    # touches the edit.
+    cdef unordered_map[uint64_t, Py_ssize_t] index
+    cdef unordered_map[uint64_t, Py_ssize_t].iterator found
+    cdef vector[MatchingBlockQueueElem] queue
+    cdef vector[Py_ssize_t] parents
+    cdef vector[CMatch] matching_blocks
+    cdef MatchingBlockQueueElem elem
+    cdef MatchNode node
+    cdef CMatch core, x
+    cdef Py_ssize_t delta = edit.size - (edit.hi - edit.lo)
+    cdef Py_ssize_t alo, ahi, blo, bhi, oalo, oahi, oblo, obhi, lo, hi, i, j, k
+    cdef Py_ssize_t n, first, parent, shift, prev
+    cdef bint unchanged
+
+    for n in range(<Py_ssize_t>old.size()):
+        index[_range_hash(old[n].alo, old[n].ahi, old[n].blo, old[n].bhi)] = n
+
+    queue.push_back(MatchingBlockQueueElem(0, la, 0, bidx.lb))
+    parents.push_back(-1)
+    while not queue.empty():
+        if scratch.stats != NULL and <Py_ssize_t>queue.size() > scratch.stats.max_queue:
+            scratch.stats.max_queue = queue.size()
+        elem = queue.back()
+        alo, ahi, blo, bhi = elem.alo, elem.ahi, elem.blo, elem.bhi
+        queue.pop_back()
+        parent = parents.back()
+        parents.pop_back()
+
+        # the same range before the edit and its shift since then
+        if edit.on_b:
+            lo, hi = blo, bhi
+        else:
+            lo, hi = alo, ahi
+        shift = 0
+        unchanged = True
+        if hi <= edit.lo:
+            pass
+        elif lo >= edit.lo + edit.size:
+            shift = delta
+        elif lo <= edit.lo and hi >= edit.lo + edit.size:
+            unchanged = False
+            hi -= delta
+        else:
+            # the range starts or ends inside the edit
+            lo = -1
+        if unchanged:
+            lo -= shift
+            hi -= shift
+        oalo, oahi, oblo, obhi = alo, ahi, blo, bhi
+        if edit.on_b:
+            oblo, obhi = lo, hi
+        else:
+            oalo, oahi = lo, hi
+        prev = -1
+        if lo >= 0:
+            found = index.find(_range_hash(oalo, oahi, oblo, obhi))
+            if found != index.end():
+                prev = deref(found).second
+                if (old[prev].alo != oalo or old[prev].ahi != oahi or
+                        old[prev].blo != oblo or old[prev].bhi != obhi):
+                    prev = -1
+
+        if prev >= 0 and unchanged:
+            first = nodes.size()
+            for n in range(prev, prev + old[prev].size):
+                node = old[n]
+                if edit.on_b:
+                    node.blo += shift
+                    node.bhi += shift
+                    node.core.b += shift
+                    node.match.b += shift
+                else:
+                    node.alo += shift
+                    node.ahi += shift
+                    node.core.a += shift
+                    node.match.a += shift
+                node.parent = parent if n == prev else node.parent - prev + first
+                nodes.push_back(node)
+            continue
+
+        if prev >= 0 and edit.size <= REMATCH_SCAN_LIMIT and not _touches_edit(old[prev].core, edit):
+            core = old[prev].core
+            if core.size == 0:
+                core = CMatch(alo, blo, 0)
+            elif edit.on_b and core.b > edit.lo:
+                core.b += delta
+            elif not edit.on_b and core.a > edit.lo:
+                core.a += delta
+            core = _scan_edit(bidx, a, alo, ahi, blo, bhi, edit, core)
+        else:
+            core = _find_longest_core(bidx, a, alo, ahi, blo, bhi, scratch)
+        x = _extend_match(bidx, a, alo, ahi, blo, bhi, core)
+        nodes.push_back(MatchNode(alo, ahi, blo, bhi, core, x, parent, 1))
+        parent = nodes.size() - 1
+        i, j, k = x.a, x.b, x.size
+        if k:
+            if alo < i and blo < j:
+                queue.push_back(MatchingBlockQueueElem(alo, i, blo, j))
+                parents.push_back(parent)
+            if i+k < ahi and j+k < bhi:
+                queue.push_back(MatchingBlockQueueElem(i+k, ahi, j+k, bhi))
+                parents.push_back(parent)
+
+    _count_subtrees(nodes)
+    for n in range(<Py_ssize_t>nodes.size()):
+        if nodes[n].match.size:
+            matching_blocks.push_back(nodes[n].match)
+    return _collapse_matching_blocks(matching_blocks, la, bidx.lb, non_adjacent)
+
+cdef Py_ssize_t _count_matches(const BIndexView* bidx, const Py_ssize_t* a, Py_ssize_t la,
+                               MatchScratch* scratch, double score_cutoff) except -1 nogil:
+    """Number of elements in the matching blocks of _get_matching_blocks.
+
+    upper_bound is the number of matches found so far plus the size of the
+    shorter side of every region still in the queue.  The search stops as
+    soon as this bound can't reach score_cutoff, in which case the returned
+    count is too low and its ratio is below score_cutoff.
+    """
+    cdef Py_ssize_t i, j, k, alo, ahi, blo, bhi
+    cdef Py_ssize_t matches = 0, upper_bound
+    cdef Py_ssize_t length = la + bidx.lb
+    cdef vector[MatchingBlockQueueElem] queue
+    cdef MatchingBlockQueueElem elem
+    cdef CMatch x
+
+    upper_bound = min(la, bidx.lb)
+    queue.push_back(MatchingBlockQueueElem(0, la, 0, bidx.lb))
+    while not queue.empty():
+        if _calculate_ratio(upper_bound, length) < score_cutoff:
+            break
+        if scratch.stats != NULL and <Py_ssize_t>queue.size() > scratch.stats.max_queue:
+            scratch.stats.max_queue = queue.size()
+        elem = queue.back()
+        alo, ahi, blo, bhi = elem.alo, elem.ahi, elem.blo, elem.bhi
+        queue.pop_back()
+        upper_bound -= min(ahi - alo, bhi - blo)
+        x = _find_longest_match(bidx, a, alo, ahi, blo, bhi, scratch)
+        i, j, k = x.a, x.b, x.size
+        if k:
+            matches += k
+            upper_bound += k
+            if alo < i and blo < j:
+                queue.push_back(MatchingBlockQueueElem(alo, i, blo, j))
+                upper_bound += min(i - alo, j - blo)
+            if i+k < ahi and j+k < bhi:
+                queue.push_back(MatchingBlockQueueElem(i+k, ahi, j+k, bhi))
+                upper_bound += min(ahi - i - k, bhi - j - k)
+    return matches
+
+cdef Py_ssize_t _count_quick_matches(const BIndexView* bidx, const Py_ssize_t* a, Py_ssize_t la,
+                                     double score_cutoff) except -1 nogil:
+    """Cardinality of the intersection of a and b viewed as multisets.
+
+    Like _count_matches the count stops early, once the remaining elements
+    of a can't reach score_cutoff.
+    """
+    cdef Py_ssize_t i, code, used
+    cdef Py_ssize_t matches = 0
+    cdef Py_ssize_t length = la + bidx.lb
+    cdef vector[Py_ssize_t] avail
+    cdef unordered_map[Py_ssize_t, Py_ssize_t] seen
+    cdef unordered_map[Py_ssize_t, Py_ssize_t].iterator it
+
+    # avail[code] is the number of times code appears in b less the number
+    # of times we've seen it in a so far.  Small alphabets (e.g. bytes and
+    # latin-1 strings) use a plain array, larger ones a hash table which
+    # counts the codes seen in a
+    if bidx.nkeys <= 256 or bidx.nkeys <= la:
+        avail.resize(<size_t>bidx.nkeys)
+        for code in range(bidx.nkeys):
+            avail[code] = bidx.counts[code]
+        for i in range(la):
+            if _calculate_ratio(matches + la - i, length) < score_cutoff:
+                break
+            code = a[i]
+            if code >= 0 and avail[code] > 0:
+                avail[code] -= 1
+                matches += 1
+    else:
+        for i in range(la):
+            if _calculate_ratio(matches + la - i, length) < score_cutoff:
+                break
+            code = a[i]
+            if code < 0:
+                continue
+            it = seen.find(code)
+            if it == seen.end():
+                used = 0
+                it = seen.insert(pair[Py_ssize_t, Py_ssize_t](code, 0)).first
+            else:
+                used = deref(it).second
+            if used < bidx.counts[code]:
+                deref(it).second = used + 1
+                matches += 1
+    return matches
+
+cdef int _collapse_matching_blocks(vector[CMatch]& matching_blocks, Py_ssize_t la, Py_ssize_t lb,
+                                   vector[CMatch]& non_adjacent) except -1 nogil:
+    cdef Py_ssize_t i1, j1, k1, i2, j2, k2
+    cpp_sort(matching_blocks.begin(), matching_blocks.end(), &CMatch_sorter)
+
+    # It's possible that we have adjacent equal blocks in the
+    # matching_blocks list now.  Starting with 2.5, this code was added
+    # to collapse them.
+    i1 = j1 = k1 = 0
+    non_adjacent.clear()
+    for x in matching_blocks:
+        i2, j2, k2 = x.a, x.b, x.size
+        # Is this block adjacent to i1, j1, k1?
+        if i1 + k1 == i2 and j1 + k1 == j2:
+            # Yes, so collapse them -- this just increases the length of
+            # the first block by the length of the second, and the first
+            # block so lengthened remains the block to compare against.
+            k1 += k2
+        else:
+            # Not adjacent.  Remember the first block (k1==0 means it's
+            # the dummy we started with), and make the second block the
+            # new block to compare against.
+            if k1:
+                non_adjacent.push_back(CMatch(i1, j1, k1))
+            i1, j1, k1 = i2, j2, k2
+    if k1:
+        non_adjacent.push_back(CMatch(i1, j1, k1))
+
+    non_adjacent.push_back(CMatch(la, lb, 0))
+    return 0
+
+cdef bint _myers_split(const Py_ssize_t* a, Py_ssize_t alo, Py_ssize_t ahi,
+                       const Py_ssize_t* b, Py_ssize_t blo, Py_ssize_t bhi,
+                       Py_ssize_t* v1, Py_ssize_t* v2, Py_ssize_t* x, Py_ssize_t* y,
+                       Budget* budget) noexcept nogil:
+    # Find the middle snake of an optimal edit path between a[alo:ahi] and
+    # b[blo:bhi] by walking it from both ends at the same time, and store
+    # the split point in x and y.  This is the linear space variant from
+    # "An O(ND) Difference Algorithm and Its Variations" (Myers, 1986).
+    # v1 and v2 need room for la + lb + 3 elements.  Returns False if the
+    # two ranges have nothing in common or the budget is used up.
+    cdef Py_ssize_t len1 = ahi - alo, len2 = bhi - blo
+    cdef Py_ssize_t max_d = (len1 + len2 + 1) // 2
+    cdef Py_ssize_t v_offset = max_d, v_length = 2 * max_d + 2
+    cdef Py_ssize_t delta = len1 - len2
+    cdef bint front = delta % 2 != 0
+    cdef Py_ssize_t k1start = 0, k1end = 0, k2start = 0, k2end = 0
+    cdef Py_ssize_t d, k1, k2, k1_offset, k2_offset, x1, y1, x2, y2
+    for d in range(v_length):
+        v1[d] = -1
+        v2[d] = -1
+    v1[v_offset + 1] = 0
+    v2[v_offset + 1] = 0
+
+    for d in range(max_d):
+        if _budget_exceeded(budget):
+            return False
+        if budget != NULL:
+            budget.cost += 2 * d + 2
+        # walk the front path one step
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < len1 and y1 < len2 and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > len1:
+                # ran off the right of the graph
+                k1end += 2
+            elif y1 > len2:
+                # ran off the bottom of the graph
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    # mirror x2 onto top-left coordinate system
+                    x2 = len1 - v2[k2_offset]
+                    if x1 >= x2:
+                        x[0] = alo + x1
+                        y[0] = blo + y1
+                        return True
+
+        # walk the reverse path one step
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < len1 and y2 < len2 and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > len1:
+                # ran off the left of the graph
+                k2end += 2
+            elif y2 > len2:
+                # ran off the top of the graph
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    # mirror x2 onto top-left coordinate system
+                    x2 = len1 - x2
+                    if x1 >= x2:
+                        x[0] = alo + x1
+                        y[0] = blo + y1
+                        return True
+    return False
+
+cdef int _myers_matching_blocks(const Py_ssize_t* a, const Py_ssize_t* b,
+                                Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi,
+                                vector[Py_ssize_t]& v, vector[CMatch]& matching_blocks,
+                                Budget* budget) except -1 nogil:
+    # Append the matching blocks of a minimal edit script between a[alo:ahi]
+    # and b[blo:bhi] to matching_blocks.  The blocks are not sorted.  Once
+    # the budget is used up, the ranges are only matched at their ends.
+    cdef vector[MatchingBlockQueueElem] queue
+    cdef MatchingBlockQueueElem elem
+    cdef Py_ssize_t k, x, y
+    v.resize(<size_t>(2 * (ahi - alo + bhi - blo + 3)))
+
+    queue.push_back(MatchingBlockQueueElem(alo, ahi, blo, bhi))
+    while not queue.empty():
+        elem = queue.back()
+        alo, ahi, blo, bhi = elem.alo, elem.ahi, elem.blo, elem.bhi
+        queue.pop_back()
+
+        # equal elements at the start or end of the range always belong
+        # to an optimal edit script
+        k = 0
+        while alo + k < ahi and blo + k < bhi and a[alo + k] == b[blo + k]:
+            k += 1
+        if k:
+            matching_blocks.push_back(CMatch(alo, blo, k))
+            alo += k
+            blo += k
+        k = 0
+        while ahi - k > alo and bhi - k > blo and a[ahi - k - 1] == b[bhi - k - 1]:
+            k += 1
+        if k:
+            matching_blocks.push_back(CMatch(ahi - k, bhi - k, k))
+            ahi -= k
+            bhi -= k
+
+        if alo == ahi or blo == bhi:
+            continue
+        if _myers_split(a, alo, ahi, b, blo, bhi, v.data(), v.data() + v.size() // 2, &x, &y, budget):
+            queue.push_back(MatchingBlockQueueElem(x, ahi, y, bhi))
+            queue.push_back(MatchingBlockQueueElem(alo, x, blo, y))
+    return 0
+
+cdef enum:
+    # elements occurring more often than this in a range of a are not
+    # used as anchor by the histogram algorithm
+    HISTOGRAM_MAX_CHAIN = 64
+
+cdef int _histogram_matching_blocks(const BIndexView* bidx, const Py_ssize_t* a, Py_ssize_t la,
+                                    vector[CMatch]& matching_blocks, Budget* budget) except -1 nogil:
+    # Histogram diff as used by git and JGit: in every range the longest
+    # common run anchored on the least frequent element of a is used as
+    # matching block, and the ranges before and after it are handled the
+    # same way.  Ranges whose common elements are all too frequent fall
+    # back to Myers' algorithm.
+    cdef const Py_ssize_t* b = bidx.b
+    cdef vector[MatchingBlockQueueElem] queue
+    cdef MatchingBlockQueueElem elem
+    cdef vector[Py_ssize_t] count, head, next_a, v
+    cdef Py_ssize_t alo, ahi, blo, bhi, i, j, code, rc, cnt, next_j
+    cdef Py_ssize_t as_, bs, ae, be, best_a, best_b, best_size
+    cdef bint has_common
+
+    count.assign(<size_t>bidx.nkeys, 0)
+    head.assign(<size_t>bidx.nkeys, -1)
+    next_a.resize(<size_t>la)
+
+    queue.push_back(MatchingBlockQueueElem(0, la, 0, bidx.lb))
+    while not queue.empty():
+        elem = queue.back()
+        alo, ahi, blo, bhi = elem.alo, elem.ahi, elem.blo, elem.bhi
+        queue.pop_back()
+        if alo == ahi or blo == bhi:
+            continue
+        if _budget_exceeded(budget):
+            _match_ends(a, alo, ahi, b, blo, bhi, matching_blocks)
+            continue
+        if budget != NULL:
+            budget.cost += ahi - alo + bhi - blo
+
+        # histogram of a[alo:ahi]; head[code] is the first index of code
+        # and next_a links to the following index of the same code
+        for i in range(ahi - 1, alo - 1, -1):
+            code = a[i]
+            if code >= 0:
+                next_a[i] = head[code]
+                head[code] = i
+                count[code] += 1
+
+        best_a = best_b = best_size = 0
+        cnt = HISTOGRAM_MAX_CHAIN + 1
+        has_common = False
+        j = blo
+        while j < bhi:
+            code = b[j]
+            next_j = j + 1
+            if count[code]:
+                has_common = True
+            if 0 < count[code] <= cnt:
+                i = head[code]
+                while i != -1:
+                    as_, bs, ae, be = i, j, i + 1, j + 1
+                    rc = count[code]
+                    while as_ > alo and bs > blo and a[as_ - 1] == b[bs - 1]:
+                        as_ -= 1
+                        bs -= 1
+                        if rc > 1 and count[a[as_]] < rc:
+                            rc = count[a[as_]]
+                    while ae < ahi and be < bhi and a[ae] == b[be]:
+                        if rc > 1 and count[a[ae]] < rc:
+                            rc = count[a[ae]]
+                        ae += 1
+                        be += 1
+                    if next_j < be:
+                        next_j = be
+                    if best_size < ae - as_ or rc < cnt:
+                        best_a, best_b, best_size = as_, bs, ae - as_
+                        cnt = rc
+                    if budget != NULL:
+                        budget.cost += ae - as_
+                    # occurrences inside this run can only find a part of it
+                    i = next_a[i]
+                    while i != -1 and i < ae:
+                        i = next_a[i]
+            j = next_j
+
+        for i in range(alo, ahi):
+            code = a[i]
+            if code >= 0:
+                head[code] = -1
+                count[code] = 0
+
+        if best_size:
+            matching_blocks.push_back(CMatch(best_a, best_b, best_size))
+            queue.push_back(MatchingBlockQueueElem(best_a + best_size, ahi, best_b + best_size, bhi))
+            queue.push_back(MatchingBlockQueueElem(alo, best_a, blo, best_b))
+        elif has_common:
+            _myers_matching_blocks(a, b, alo, ahi, blo, bhi, v, matching_blocks, budget)
+    return 0
+
+
+# Sequences of these kinds are read straight from their buffer, without
+# creating a Python object per element.  A sequence of one kind is only
+# compared natively against a sequence of the same kind, since e.g. the
+# elements of a str never compare equal to the elements of a bytes object.
+cdef enum ElementKind:
+    KIND_OBJECT
+    # code points of a str
+    KIND_UNICODE
+    # integers of a bytes like object or a 1-D integer buffer
+    KIND_INTEGER
+
+cdef enum RawType:
+    RAW_UINT8
+    RAW_INT8
+    RAW_UINT16
+    RAW_INT16
+    RAW_UINT32
+    RAW_INT32
+    RAW_UINT64
+    RAW_INT64
+
+ctypedef fused raw_t:
+    uint8_t
+    int8_t
+    uint16_t
+    int16_t
+    uint32_t
+    int32_t
+    uint64_t
+    int64_t
+
+ctypedef struct RawSequence:
+    ElementKind kind
+    RawType type
+    const void* data
+    Py_ssize_t length
+    bint has_view
+    Py_buffer view
+
+cdef bint _is_native_byteorder(char c) noexcept:
+    cdef int one = 1
+    cdef bint little_endian = (<char*>&one)[0] == 1
+    if c == b'@' or c == b'=':
+        return True
+    if c == b'<':
+        return little_endian
+    if c == b'>' or c == b'!':
+        return not little_endian
+    return False
+
+cdef int _get_raw_type(const Py_buffer* view, RawType* type) noexcept:
+    """get the type of a 1-D integer buffer; returns 0 for any other buffer"""
+    cdef const char* fmt = view.format
+    if fmt == NULL:
+        fmt = b"B"
+    elif _is_native_byteorder(fmt[0]):
+        fmt += 1
+    if fmt[0] == 0 or fmt[1] != 0 or view.ndim != 1:
+        return 0
+    if fmt[0] in b"bhilqn":
+        if view.itemsize == 1:
+            type[0] = RAW_INT8
+        elif view.itemsize == 2:
+            type[0] = RAW_INT16
+        elif view.itemsize == 4:
+            type[0] = RAW_INT32
+        elif view.itemsize == 8:
+            type[0] = RAW_INT64
+        else:
+            return 0
+    elif fmt[0] in b"BHILQN":
+        if view.itemsize == 1:
+            type[0] = RAW_UINT8
+        elif view.itemsize == 2:
+            type[0] = RAW_UINT16
+        elif view.itemsize == 4:
+            type[0] = RAW_UINT32
+        elif view.itemsize == 8:
+            type[0] = RAW_UINT64
+        else:
+            return 0
+    else:
+        return 0
+    return 1
+
+cdef int _get_raw(seq, RawSequence* raw) except -1:
+    """get the raw data of seq; raw.kind is KIND_OBJECT if this is not supported"""
+    cdef unsigned int unicode_kind
+    cdef const uint64_t* data
+    cdef Py_ssize_t i
+    raw.kind = KIND_OBJECT
+    raw.has_view = False
+    if isinstance(seq, str):
+        unicode_kind = PyUnicode_KIND(seq)
+        if unicode_kind == PyUnicode_1BYTE_KIND:
+            raw.type = RAW_UINT8
+        elif unicode_kind == PyUnicode_2BYTE_KIND:
+            raw.type = RAW_UINT16
+        else:
+            raw.type = RAW_UINT32
+        raw.kind = KIND_UNICODE
+        raw.data = PyUnicode_DATA(seq)
+        raw.length = PyUnicode_GET_LENGTH(seq)
+    elif PyObject_CheckBuffer(seq):
+        try:
+            PyObject_GetBuffer(seq, &raw.view, PyBUF_FORMAT | PyBUF_STRIDES)
+        except BufferError:
+            return 0
+        raw.has_view = True
+        if not _get_raw_type(&raw.view, &raw.type):
+            return 0
+        # strided views are compared as objects
+        if raw.view.suboffsets != NULL or raw.view.strides[0] != raw.view.itemsize:
+            return 0
+        raw.data = raw.view.buf
+        raw.length = raw.view.shape[0]
+        # keys are stored as int64_t, so larger values are compared as objects
+        if raw.type == RAW_UINT64:
+            data = <const uint64_t*>raw.data
+            for i in range(raw.length):
+                if data[i] > <uint64_t>INT64_MAX:
+                    return 0
+        raw.kind = KIND_INTEGER
+    return 0
+
+cdef void _release_raw(RawSequence* raw) noexcept:
+    if raw.has_view:
+        PyBuffer_Release(&raw.view)
+        raw.has_view = False
+
+cdef inline Py_ssize_t _lookup_key(const KeyMap* keymap, int64_t key) noexcept nogil:
+    cdef unordered_map[int64_t, Py_ssize_t].const_iterator it
+    if 0 <= key < 256:
+        return keymap.small[key]
+    it = keymap.large.find(key)
+    if it == keymap.large.end():
+        return -1
+    return deref(it).second
+
+cdef inline Py_ssize_t _insert_key(KeyMap* keymap, int64_t key) except -1 nogil:
+    cdef Py_ssize_t code = _lookup_key(keymap, key)
+    if code >= 0:
+        return code
+    code = keymap.values.size()
+    keymap.values.push_back(key)
+    if 0 <= key < 256:
+        keymap.small[key] = code
+    else:
+        keymap.large[key] = code
+    return code
+
+cdef int _build_keys_impl(const raw_t* data, Py_ssize_t length, KeyMap* keymap,
+                          Py_ssize_t* codes) except -1 nogil:
+    cdef Py_ssize_t i
+    for i in range(length):
+        codes[i] = _insert_key(keymap, data[i])
+    return 0
+
+cdef void _lookup_keys_impl(const raw_t* data, Py_ssize_t length, const KeyMap* keymap,
+                            Py_ssize_t* codes) noexcept nogil:
+    cdef Py_ssize_t i
+    for i in range(length):
+        codes[i] = _lookup_key(keymap, data[i])
+
+cdef int _build_keys(const RawSequence* raw, KeyMap* keymap, Py_ssize_t* codes) except -1 nogil:
+    keymap.small.assign(256, -1)
+    return _insert_keys(raw, keymap, codes)
+
+cdef int _insert_keys(const RawSequence* raw, KeyMap* keymap, Py_ssize_t* codes) except -1 nogil:
+    if raw.type == RAW_UINT8:
+        return _build_keys_impl(<const uint8_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_INT8:
+        return _build_keys_impl(<const int8_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_UINT16:
+        return _build_keys_impl(<const uint16_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_INT16:
+        return _build_keys_impl(<const int16_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_UINT32:
+        return _build_keys_impl(<const uint32_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_INT32:
+        return _build_keys_impl(<const int32_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_UINT64:
+        return _build_keys_impl(<const uint64_t*>raw.data, raw.length, keymap, codes)
+    else:
+        return _build_keys_impl(<const int64_t*>raw.data, raw.length, keymap, codes)
+
+cdef void _lookup_keys(const RawSequence* raw, const KeyMap* keymap, Py_ssize_t* codes) noexcept nogil:
+    if raw.type == RAW_UINT8:
+        _lookup_keys_impl(<const uint8_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_INT8:
+        _lookup_keys_impl(<const int8_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_UINT16:
+        _lookup_keys_impl(<const uint16_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_INT16:
+        _lookup_keys_impl(<const int16_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_UINT32:
+        _lookup_keys_impl(<const uint32_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_INT32:
+        _lookup_keys_impl(<const int32_t*>raw.data, raw.length, keymap, codes)
+    elif raw.type == RAW_UINT64:
+        _lookup_keys_impl(<const uint64_t*>raw.data, raw.length, keymap, codes)
+    else:
+        _lookup_keys_impl(<const int64_t*>raw.data, raw.length, keymap, codes)
+
+
+@cython.final
+cdef class _CodedSequence:
+    """First sequence mapped to the codes of a PreparedSequence.
+
+    Like the index this is never modified after creation, so the matching
+    code can keep using it after releasing the GIL.
+    """
+
+    cdef vector[Py_ssize_t] codes
+
+
+cdef int _find_popular_codes(const vector[Py_ssize_t]& counts, const vector[char]& junk, Py_ssize_t n,
+                             bint autojunk, vector[char]& popular) except -1 nogil:
+    cdef Py_ssize_t code, ntest
+    cdef Py_ssize_t nkeys = counts.size()
+    popular.assign(<size_t>nkeys, 0)
+    if autojunk and n >= 200:
+        ntest = n // 100 + 1
+        for code in range(nkeys):
+            if counts[code] > ntest and not junk[code]:
+                popular[code] = 1
+    return 0
+
+cdef int _layout_index(const vector[Py_ssize_t]& codes, const vector[Py_ssize_t]& counts_,
+                       const vector[char]& junk, const vector[char]& popular,
+                       vector[Py_ssize_t]& offsets, vector[Py_ssize_t]& positions,
+                       BIndexView* view) except -1 nogil:
+    # lay out the positions of the elements that are neither junk nor
+    # popular as CSR array
+    cdef Py_ssize_t i, code
+    cdef Py_ssize_t n = codes.size()
+    cdef Py_ssize_t nkeys = counts_.size()
+    cdef vector[Py_ssize_t] counts = counts_
+    offsets.assign(<size_t>nkeys + 1, 0)
+    for code in range(nkeys):
+        offsets[code + 1] = offsets[code]
+        if not junk[code] and not popular[code]:
+            offsets[code + 1] += counts[code]
+
+    positions.resize(<size_t>offsets[nkeys])
+    for code in range(nkeys):
+        counts[code] = offsets[code]
+    for i in range(n):
+        code = codes[i]
+        if counts[code] < offsets[code + 1]:
+            positions[counts[code]] = i
+            counts[code] += 1
+
+    _set_view(codes, counts_, junk, offsets, positions, view)
+    return 0
+
+cdef int _patch_layout(const BIndexView* old, Py_ssize_t lo, Py_ssize_t hi, const vector[Py_ssize_t]& codes,
+                       const vector[Py_ssize_t]& counts, const vector[char]& junk, const vector[char]& popular,
+                       vector[Py_ssize_t]& offsets, vector[Py_ssize_t]& positions,
+                       BIndexView* view) except -1 nogil:
+    # same as _layout_index() for codes which are the codes of old with
+    # [lo:hi] replaced, when no element became popular or unpopular: the
+    # positions of every code are copied from old in one pass, dropping
+    # the replaced ones and shifting the ones after the edit
+    cdef Py_ssize_t i, k, end, pos, code, t = 0, j = 0
+    cdef Py_ssize_t n = codes.size()
+    cdef Py_ssize_t nkeys = counts.size()
+    cdef Py_ssize_t size = n - old.lb + hi - lo
+    cdef Py_ssize_t delta = size - (hi - lo)
+    cdef vector[pair[Py_ssize_t, Py_ssize_t]] items
+    for i in range(lo, lo + size):
+        items.push_back(pair[Py_ssize_t, Py_ssize_t](codes[i], i))
+    cpp_sort(items.begin(), items.end())
+
+    offsets.resize(<size_t>nkeys + 1)
+    positions.resize(<size_t>(old.offsets[old.nkeys] + size))
+    for code in range(nkeys):
+        offsets[code] = j
+        if junk[code] or popular[code]:
+            while t < <Py_ssize_t>items.size() and items[t].first == code:
+                t += 1
+            continue
+        k = end = 0
+        if code < old.nkeys:
+            k, end = old.offsets[code], old.offsets[code + 1]
+        while k < end and old.positions[k] < lo:
+            positions[j] = old.positions[k]
+            j += 1
+            k += 1
+        while t < <Py_ssize_t>items.size() and items[t].first == code:
+            positions[j] = items[t].second
+            j += 1
+            t += 1
+        while k < end:
+            pos = old.positions[k]
+            if pos >= hi:
+                positions[j] = pos + delta
+                j += 1
+            k += 1
+    offsets[nkeys] = j
+    positions.resize(<size_t>j)
+
+    _set_view(codes, counts, junk, offsets, positions, view)
+    return 0
+
+cdef void _set_view(const vector[Py_ssize_t]& codes, const vector[Py_ssize_t]& counts, const vector[char]& junk,
+                    const vector[Py_ssize_t]& offsets, const vector[Py_ssize_t]& positions,
+                    BIndexView* view) noexcept nogil:
+    view.lb = codes.size()
+    view.nkeys = counts.size()
+    view.b = codes.data()
+    view.counts = counts.data()
+    view.offsets = offsets.data()
+    view.positions = positions.data()
+    view.junk = junk.data()
+
+# C API for other Cython extensions, see cydifflib/__init__.pxd
+
+cdef DiffIndex* diff_index_new(const int64_t* b, Py_ssize_t lb, diff_isjunk_t isjunk, void* context,
+                               bint autojunk) except NULL nogil:
+    cdef DiffIndex* index = new DiffIndex()
+    cdef vector[char] popular
+    cdef Py_ssize_t i, code, nkeys
+    cdef bint done = False
+    try:
+        index.codes.resize(<size_t>lb)
+        index.keymap.small.assign(256, -1)
+        _build_keys_impl(b, lb, &index.keymap, index.codes.data())
+        nkeys = index.keymap.values.size()
+        index.counts.assign(<size_t>nkeys, 0)
+        for i in range(lb):
+            index.counts[index.codes[i]] += 1
+        index.junk.assign(<size_t>nkeys, 0)
+        if isjunk != NULL:
+            for code in range(nkeys):
+                index.junk[code] = isjunk(index.keymap.values[code], context)
+        _find_popular_codes(index.counts, index.junk, lb, autojunk, popular)
+        _layout_index(index.codes, index.counts, index.junk, popular, index.offsets, index.positions,
+                      &index.view)
+        done = True
+    finally:
+        if not done:
+            del index
+    return index
+
+cdef void diff_index_free(DiffIndex* index) noexcept nogil:
+    del index
+
+cdef int _diff_blocks(const DiffIndex* index, const int64_t* a, Py_ssize_t la,
+                      vector[CMatch]& blocks) except -1 nogil:
+    cdef vector[Py_ssize_t] codes
+    cdef vector[Py_ssize_t] buffer
+    cdef MatchScratch scratch
+    codes.resize(<size_t>la)
+    _lookup_keys_impl(a, la, &index.keymap, codes.data())
+    _init_scratch(&scratch, buffer, index.view.lb)
+    return _get_matching_blocks(&index.view, codes.data(), la, &scratch, blocks, NULL)
+
+cdef int _check_size(Py_ssize_t size) except -1 nogil:
+    if size < 0:
+        with gil:
+            raise ValueError("size must be >= 0: %d" % size)
+    return 0
+
+cdef Py_ssize_t diff_matching_blocks(const DiffIndex* index, const int64_t* a, Py_ssize_t la,
+                                     CMatch* out, Py_ssize_t size) except -1 nogil:
+    cdef vector[CMatch] blocks
+    _check_size(size)
+    _diff_blocks(index, a, la, blocks)
+    memcpy(out, blocks.data(), min(size, <Py_ssize_t>blocks.size()) * sizeof(CMatch))
+    return blocks.size()
+
+cdef Py_ssize_t diff_opcodes(const DiffIndex* index, const int64_t* a, Py_ssize_t la,
+                             COpcode* out, Py_ssize_t size) except -1 nogil:
+    cdef vector[CMatch] blocks
+    cdef vector[COpcode] opcodes
+    _check_size(size)
+    _diff_blocks(index, a, la, blocks)
+    _get_opcodes(blocks, opcodes)
+    memcpy(out, opcodes.data(), min(size, <Py_ssize_t>opcodes.size()) * sizeof(COpcode))
+    return opcodes.size()
+
+cdef double diff_ratio(const DiffIndex* index, const int64_t* a, Py_ssize_t la,
+                       double score_cutoff) except -1 nogil:
+    cdef vector[Py_ssize_t] codes
+    cdef vector[Py_ssize_t] buffer
+    cdef MatchScratch scratch
+    cdef double score
+    codes.resize(<size_t>la)
+    _lookup_keys_impl(a, la, &index.keymap, codes.data())
+    _init_scratch(&scratch, buffer, index.view.lb)
+    score = _calculate_ratio(_count_matches(&index.view, codes.data(), la, &scratch, score_cutoff),
+                             la + index.view.lb)
+    return score if score >= score_cutoff else 0.0
+
+
+cdef class PreparedSequence:
+    """Index of the second sequence of a SequenceMatcher.
+
+    The index is only built once per second sequence and is never modified
+    afterwards.  It maps every distinct element of b to a dense integer code
+    and stores b2j as a flat CSR array, so the matching code can run without
+    touching Python objects.  str sequences and 1-D integer buffers (bytes,
+    array.array, numpy.ndarray, ...) are read straight from their buffer.
+
+    isjunk and autojunk are the same as for SequenceMatcher.  A prepared
+    sequence can be passed as b to a SequenceMatcher, which then uses its
+    index as is instead of building its own:
+
+    >>> prepared = PreparedSequence("abcd")
+    >>> SequenceMatcher(None, "bcde", prepared).ratio()
+    0.75
+
+    Prepared sequences are picklable.  The arrays of the index are pickled
+    as one flat buffer, which an unpickled index uses without copying it.
+    With pickle protocol 5 the buffer can be passed out-of-band, e.g. in
+    a multiprocessing.shared_memory block, so a pool of worker processes
+    can share one index.  Only the distinct elements of str sequences and
+    other sequences which are not integer buffers have to be hashed again.
+    isjunk is not pickled, so SequenceMatcher.replace_b() raises ValueError
+    when it adds new elements to an unpickled index built with isjunk.
+    """
+
+    cdef readonly object seq
+    cdef readonly set bjunk
+    cdef readonly set bpopular
+    cdef ElementKind kind
+    # element -> code; codes are assigned in order of first appearance in b.
+    # For str sequences and integer buffers this is only built when needed
+    # and keymap is used instead.  For other sequences keys_ and elements_
+    # (code -> element) are shared with the indexes derived by replace(),
+    # which append their new elements, so codes >= view.nkeys are unknown
+    # to this index
+    cdef dict keys_
+    cdef list elements_
+    cdef KeyMap keymap
+    cdef dict b2j_
+    cdef dict fullbcount_
+    cdef vector[Py_ssize_t] codes
+    # number of times each code appears in b, including junk
+    cdef vector[Py_ssize_t] counts
+    cdef vector[Py_ssize_t] offsets
+    cdef vector[Py_ssize_t] positions
+    cdef vector[char] junk
+    cdef BIndexView view
+    # an unpickled index keeps its arrays in the pickled buffer instead of
+    # the vectors above, so they must only be read through view
+    cdef Py_buffer buffer
+    cdef bint has_buffer
+    # isjunk and autojunk the index was built with, which replace() applies
+    # to the edited sequence.  isjunk_unknown is set for an unpickled index
+    # which was built with an isjunk function
+    cdef object isjunk
+    cdef bint autojunk
+    cdef bint isjunk_unknown
+
+    def __init__(self, b, isjunk=None, autojunk=True):
+        cdef double start
+        cdef Py_ssize_t code, njunk = 0, npopular = 0
+        self.seq = b
+        self.isjunk = isjunk
+        self.autojunk = autojunk
+        self.keys_ = self.b2j_ = self.fullbcount_ = None
+        if _stats is None:
+            self.__chain_b(isjunk, autojunk)
+            return
+
+        start = _monotonic()
+        self.__chain_b(isjunk, autojunk)
+        for code in range(self.view.nkeys):
+            if self.view.junk[code]:
+                njunk += self.view.counts[code]
+            elif not _is_indexed(&self.view, code):
+                npopular += self.view.counts[code]
+        _record_stats({'event': 'index', 'length': self.view.lb, 'junk': njunk, 'popular': npopular,
+                       'time': _monotonic() - start})
+
+    def __dealloc__(self):
+        if self.has_buffer:
+            PyBuffer_Release(&self.buffer)
+
+    def __len__(self):
+        return self.view.lb
+
+    def __reduce_ex__(self, protocol):
+        cdef Py_ssize_t lb = self.view.lb
+        cdef Py_ssize_t nkeys = self.view.nkeys
+        cdef Py_ssize_t npositions = self.view.offsets[nkeys]
+        cdef Py_ssize_t nvalues = nkeys if self.kind != KIND_OBJECT else 0
+        cdef bytearray data = bytearray(_prepared_size(lb, nkeys, npositions, nvalues))
+        cdef Py_ssize_t* words = <Py_ssize_t*><char*>data
+        words[0] = PREPARED_FORMAT
+        words[1] = lb
+        words[2] = nkeys
+        words[3] = npositions
+        words += PREPARED_HEADER
+        memcpy(words, self.view.b, lb * sizeof(Py_ssize_t))
+        words += lb
+        memcpy(words, self.view.counts, nkeys * sizeof(Py_ssize_t))
+        words += nkeys
+        memcpy(words, self.view.offsets, (nkeys + 1) * sizeof(Py_ssize_t))
+        words += nkeys + 1
+        memcpy(words, self.view.positions, npositions * sizeof(Py_ssize_t))
+        words += npositions
+        if nvalues:
+            memcpy(words, self.keymap.values.data(), nvalues * sizeof(int64_t))
+            words += nvalues
+        memcpy(words, self.view.junk, nkeys)
+        elements = self._elements() if self.kind == KIND_OBJECT else None
+        # older protocols cannot pickle the buffer out-of-band
+        return (_restore_prepared, (self.seq, <int>self.kind, elements, self.bjunk, self.bpopular,
+                                    _PickleBuffer(data) if protocol >= 5 else data, self.autojunk,
+                                    self.isjunk is not None or self.isjunk_unknown))
+
+    # For each element x in b, set b2j[x] to a list of the indices in
+    # b where x appears; the indices are in increasing order; note that
+    # the number of times x appears in b is len(b2j[x]) ...
+    # when self.isjunk is defined, junk elements don't show up in this
+    # map at all, which stops the central find_longest_match method
+    # from starting any matching block at a junk element ...
+    # b2j also does not contain entries for "popular" elements, meaning
+    # elements that account for more than 1 + 1% of the total elements, and
+    # when the sequence is reasonably large (>= 200 elements); this can
+    # be viewed as an adaptive notion of semi-junk, and yields an enormous
+    # speedup when, e.g., comparing program files with hundreds of
+    # instances of "return NULL;" ...
+    # note that this is only called when b changes; so for cross-product
+    # kinds of matches, it's best to call set_seq2 once, then set_seq1
+    # repeatedly
+
+    cdef __chain_b(self, isjunk, autojunk):
+        cdef Py_ssize_t i, code, n
+        cdef Py_ssize_t nkeys = 0
+        cdef vector[char] popular_
+        cdef RawSequence raw
+        cdef dict keys
+        b = self.seq
+
+        # The first trick is to build the index ignoring the possibility
+        # of junk.  I.e., we don't call isjunk at all yet.  Throwing
+        # out the junk later is much cheaper than building b2j "right"
+        # from the start.
+        n = len(b)
+        self.codes.resize(<size_t>n)
+        _get_raw(b, &raw)
+        try:
+            self.kind = raw.kind
+            if raw.kind != KIND_OBJECT:
+                with nogil:
+                    _build_keys(&raw, &self.keymap, self.codes.data())
+                nkeys = self.keymap.values.size()
+        finally:
+            _release_raw(&raw)
+
+        if self.kind == KIND_OBJECT:
+            self.keys_ = keys = {}
+            i = 0
+            for elt in b:
+                code = keys.setdefault(elt, len(keys))
+                self.codes[i] = code
+                i += 1
+            nkeys = len(keys)
+            self.elements_ = list(keys)
+
+        self.counts.resize(<size_t>nkeys)
+        for i in range(n):
+            self.counts[self.codes[i]] += 1
+
+        # Because isjunk is a user-defined (not C) function, and we test
+        # for junk a LOT, it's important to minimize the number of calls.
+        # Before the tricks described here, __chain_b was by far the most
+        # time-consuming routine in the whole module!  If anyone sees
+        # Jim Roskind, thank him again for profile.py -- I never would
+        # have guessed that.
+        # Purge junk elements
+        self.bjunk = junk = set()
+        self.junk.assign(<size_t>nkeys, 0)
+        if isjunk:
+            for code in range(nkeys):
+                elt = self._element(code)
+                if isjunk(elt):
+                    junk.add(elt)
+                    self.junk[code] = 1
+
+        # Purge popular elements that are not junk
+        self.bpopular = popular = set()
+        self._find_popular(autojunk, popular_)
+        for code in range(nkeys):
+            if popular_[code]:
+                popular.add(self._element(code))
+        self._layout(popular_)
+
+    cdef int _find_popular(self, autojunk, vector[char]& popular) except -1:
+        return _find_popular_codes(self.counts, self.junk, self.codes.size(), autojunk, popular)
+
+    cdef int _layout(self, const vector[char]& popular_) except -1:
+        return _layout_index(self.codes, self.counts, self.junk, popular_, self.offsets, self.positions,
+                             &self.view)
+
+    cdef object _element(self, Py_ssize_t code):
+        """element of b with the given code"""
+        cdef int64_t key
+        if self.kind == KIND_OBJECT:
+            return self.elements_[code]
+        key = self.keymap.values[code]
+        if self.kind == KIND_UNICODE:
+            return <Py_UCS4>key
+        return key
+
+    cdef list _elements(self):
+        """distinct elements of b ordered by their code"""
+        if self.kind == KIND_OBJECT:
+            return self.elements_[:self.view.nkeys]
+        return [self._element(code) for code in range(<Py_ssize_t>self.keymap.values.size())]
+
+    cdef dict _keys(self):
+        if self.keys_ is None:
+            self.keys_ = {elt: code for code, elt in enumerate(self._elements())}
+        return self.keys_
+
+    cdef _CodedSequence encode(self, a):
+        """map the elements of a to the codes of b; unknown elements are -1"""
+        cdef _CodedSequence coded = _CodedSequence.__new__(_CodedSequence)
+        cdef RawSequence raw
+        cdef dict keys
+        cdef Py_ssize_t i = 0, code
+        cdef Py_ssize_t nkeys = self.view.nkeys
+        coded.codes.resize(<size_t>len(a))
+        if self.kind != KIND_OBJECT:
+            _get_raw(a, &raw)
+            try:
+                if raw.kind == self.kind:
+                    with nogil:
+                        _lookup_keys(&raw, &self.keymap, coded.codes.data())
+                    return coded
+            finally:
+                _release_raw(&raw)
+
+        keys = self._keys()
+        for elt in a:
+            code = keys.get(elt, -1)
+            coded.codes[i] = code if code < nkeys else -1
+            i += 1
+        return coded
+
+    cdef _CodedSequence update_codes(self, a, _CodedSequence coded):
+        """codes of a in this index, when coded are the codes of a in an
+        index this one was derived from with replace()"""
+        cdef _CodedSequence updated
+        cdef dict keys
+        cdef Py_ssize_t i, code
+        cdef Py_ssize_t nkeys = self.view.nkeys
+        if self.kind != KIND_OBJECT:
+            return self.encode(a)
+        # only elements of a which were unknown before can have new codes
+        updated = _CodedSequence.__new__(_CodedSequence)
+        updated.codes = coded.codes
+        keys = self.keys_
+        for i in range(<Py_ssize_t>updated.codes.size()):
+            if updated.codes[i] < 0:
+                code = keys.get(a[i], -1)
+                updated.codes[i] = code if code < nkeys else -1
+        return updated
+
+    cdef int _check_isjunk(self) except -1:
+        if self.isjunk_unknown:
+            raise ValueError("isjunk of an unpickled PreparedSequence is unknown, "
+                             "so it can't index new elements")
+        return 0
+
+    cdef PreparedSequence rebuild(self, seq):
+        """Index of seq built with the isjunk and autojunk of this index"""
+        self._check_isjunk()
+        return PreparedSequence(seq, self.isjunk, self.autojunk)
+
+    cdef PreparedSequence replace(self, Py_ssize_t lo, Py_ssize_t hi, seq, bint* same_popular):
+        """Index of seq, which is the indexed sequence with [lo:hi] replaced.
+
+        Only the new elements of seq are hashed and isjunk is only called
+        for elements which are new to the index, the rest is copied from
+        this index.  The index keeps the isjunk and autojunk it was built
+        with.  Elements which no longer occur in seq keep their code.
+        same_popular is set if no element became popular or unpopular.
+        Returns None if seq can't be indexed like the indexed sequence.
+
+        The arrays of the index are still copied, so this takes time linear
+        in the length of seq, but without hashing its elements.  Unless an
+        element became popular or unpopular, the positions of b2j are
+        copied in one pass instead of being sorted again.
+        """
+        cdef PreparedSequence other = PreparedSequence.__new__(PreparedSequence)
+        cdef Py_ssize_t n = len(seq)
+        cdef Py_ssize_t lb = self.view.lb
+        cdef Py_ssize_t nkeys = self.view.nkeys
+        cdef Py_ssize_t size = n - lb + hi - lo
+        cdef Py_ssize_t i, code
+        cdef vector[char] popular_
+        cdef RawSequence raw
+        cdef dict keys
+        cdef list elements
+        cdef bint junk_changed = False, popular_changed = False, was_popular
+
+        other.seq = seq
+        other.kind = self.kind
+        other.isjunk = isjunk = self.isjunk
+        other.autojunk = self.autojunk
+        other.isjunk_unknown = self.isjunk_unknown
+        other.keys_ = other.b2j_ = other.fullbcount_ = None
+        other.codes.resize(<size_t>n)
+        memcpy(other.codes.data(), self.view.b, lo * sizeof(Py_ssize_t))
+        memcpy(other.codes.data() + lo + size, self.view.b + hi, (lb - hi) * sizeof(Py_ssize_t))
+        items = seq[lo:lo + size]
+        if self.kind != KIND_OBJECT:
+            _get_raw(items, &raw)
+            try:
+                if raw.kind != self.kind:
+                    return None
+                other.keymap = self.keymap
+                with nogil:
+                    _insert_keys(&raw, &other.keymap, other.codes.data() + lo)
+            finally:
+                _release_raw(&raw)
+        else:
+            # the elements are shared instead of copied, see keys_
+            other.keys_ = keys = self.keys_
+            other.elements_ = elements = self.elements_
+            i = lo
+            for elt in items:
+                code = keys.setdefault(elt, len(elements))
+                if code == len(elements):
+                    elements.append(elt)
+                other.codes[i] = code
+                i += 1
+
+        other.counts.assign(self.view.counts, self.view.counts + nkeys)
+        if self.kind != KIND_OBJECT:
+            other.counts.resize(other.keymap.values.size(), 0)
+        else:
+            other.counts.resize(len(other.elements_), 0)
+        other.junk.assign(self.view.junk, self.view.junk + nkeys)
+        other.junk.resize(other.counts.size(), 0)
+        for i in range(lo, hi):
+            other.counts[self.view.b[i]] -= 1
+        for i in range(lo, lo + size):
+            other.counts[other.codes[i]] += 1
+
+        if <Py_ssize_t>other.counts.size() > nkeys:
+            self._check_isjunk()
+
+        # junk elements which were removed or added
+        if isjunk:
+            for code in range(nkeys, <Py_ssize_t>other.counts.size()):
+                if isjunk(other._element(code)):
+                    other.junk[code] = 1
+        for i in range(lo, hi):
+            code = self.view.b[i]
+            if other.junk[code] and not other.counts[code]:
+                junk_changed = True
+        for i in range(lo, lo + size):
+            code = other.codes[i]
+            if other.junk[code] and (code >= nkeys or not self.view.counts[code]):
+                junk_changed = True
+        if junk_changed:
+            other.bjunk = {other._element(code) for code in range(<Py_ssize_t>other.counts.size())
+                           if other.junk[code] and other.counts[code]}
+        else:
+            other.bjunk = self.bjunk
+
+        # popular elements of the old index have no positions
+        other._find_popular(self.autojunk, popular_)
+        for code in range(<Py_ssize_t>other.counts.size()):
+            was_popular = (code < nkeys and not self.view.junk[code] and self.view.counts[code] > 0 and
+                           self.view.offsets[code] == self.view.offsets[code + 1])
+            if was_popular != (popular_[code] != 0):
+                popular_changed = True
+        if popular_changed:
+            other.bpopular = {other._element(code) for code in range(<Py_ssize_t>other.counts.size())
+                              if popular_[code]}
+            other._layout(popular_)
+        else:
+            other.bpopular = self.bpopular
+            _patch_layout(&self.view, lo, hi, other.codes, other.counts, other.junk, popular_, other.offsets,
+                          other.positions, &other.view)
+        same_popular[0] = not popular_changed
+        return other
+
+    @property
+    def b2j(self):
+        cdef Py_ssize_t code, pos
+        if self.b2j_ is None:
+            b2j = {}
+            for code, elt in enumerate(self._elements()):
+                if self.view.offsets[code] != self.view.offsets[code + 1]:
+                    b2j[elt] = [self.view.positions[pos]
+                                for pos in range(self.view.offsets[code], self.view.offsets[code + 1])]
+            self.b2j_ = b2j
+        return self.b2j_
+
+    @property
+    def fullbcount(self):
+        if self.fullbcount_ is None:
+            self.fullbcount_ = {elt: self.view.counts[code] for code, elt in enumerate(self._elements())
+                                if self.view.counts[code]}
+        return self.fullbcount_
+
+
+cdef enum:
+    # first word of a pickled index, which changes with its layout
+    PREPARED_FORMAT = 1
+    PREPARED_HEADER = 4
+
+cdef Py_ssize_t _prepared_size(Py_ssize_t lb, Py_ssize_t nkeys, Py_ssize_t npositions,
+                               Py_ssize_t nvalues) noexcept:
+    # header, codes, counts, offsets, positions and keys as words followed
+    # by the junk flags as bytes
+    return (PREPARED_HEADER + lb + 2 * nkeys + 1 + npositions + nvalues) * sizeof(Py_ssize_t) + nkeys
+
+def _restore_prepared(seq, int kind, elements, set bjunk, set bpopular, data, bint autojunk,
+                      bint isjunk_unknown):
+    """Unpickle a PreparedSequence, see PreparedSequence.__reduce_ex__()"""
+    cdef PreparedSequence self = PreparedSequence.__new__(PreparedSequence)
+    cdef const Py_ssize_t* words
+    cdef Py_ssize_t lb, nkeys, npositions, nvalues, code
+    self.seq = seq
+    self.autojunk = autojunk
+    self.isjunk_unknown = isjunk_unknown
+    self.kind = <ElementKind>kind
+    self.bjunk = bjunk
+    self.bpopular = bpopular
+    self.keys_ = self.b2j_ = self.fullbcount_ = None
+
+    PyObject_GetBuffer(data, &self.buffer, PyBUF_SIMPLE)
+    self.has_buffer = True
+    if <size_t>self.buffer.buf % sizeof(Py_ssize_t):
+        # out-of-band buffers may be unaligned
+        PyBuffer_Release(&self.buffer)
+        self.has_buffer = False
+        PyObject_GetBuffer(bytes(data), &self.buffer, PyBUF_SIMPLE)
+        self.has_buffer = True
+    words = <const Py_ssize_t*>self.buffer.buf
+    if self.buffer.len < <Py_ssize_t>(PREPARED_HEADER * sizeof(Py_ssize_t)) or words[0] != PREPARED_FORMAT:
+        raise ValueError("invalid PreparedSequence data")
+    lb, nkeys, npositions = words[1], words[2], words[3]
+    nvalues = nkeys if self.kind != KIND_OBJECT else 0
+    if (lb != len(seq) or nkeys < 0 or npositions < 0 or
+            self.buffer.len != _prepared_size(lb, nkeys, npositions, nvalues)):
+        raise ValueError("invalid PreparedSequence data")
+
+    words += PREPARED_HEADER
+    self.view.lb = lb
+    self.view.nkeys = nkeys
+    self.view.b = words
+    words += lb
+    self.view.counts = words
+    words += nkeys
+    self.view.offsets = words
+    words += nkeys + 1
+    self.view.positions = words
+    words += npositions
+    if self.kind != KIND_OBJECT:
+        self.keymap.small.assign(256, -1)
+        for code in range(nkeys):
+            _insert_key(&self.keymap, (<const int64_t*>words)[code])
+        words += nvalues
+    else:
+        self.keys_ = {elt: code for code, elt in enumerate(elements)}
+        self.elements_ = list(elements)
+        if len(self.keys_) != nkeys:
+            raise ValueError("invalid PreparedSequence data")
+    self.view.junk = <const char*>words
+    return self
+
+cdef object _replace_items(seq, Py_ssize_t lo, Py_ssize_t hi, items):
+    """seq[:lo] + items + seq[hi:] for replace_a() and replace_b()"""
+    if lo < 0 or hi < lo or hi > len(seq):
+        raise IndexError("range out of bounds")
+    if isinstance(seq, list):
+        # one copy instead of concatenating two slices
+        seq = list(seq)
+        seq[lo:hi] = items
+        return seq
+    if isinstance(seq, (tuple, str, bytes, bytearray, cpython_array.array)):
+        return seq[:lo] + items + seq[hi:]
+    raise TypeError("can't replace items of %s" % type(seq).__name__)
+
+
 cdef class SequenceMatcher:
 
     """
@@ -116,28 +2292,41 @@ cdef class SequenceMatcher:
     case.  SequenceMatcher is quadratic time for the worst case and has
     expected-case behavior dependent in a complicated way on how many
     elements the sequences have in common; best case time is linear.
+
+    Threads:  The GIL is released while searching for matching blocks, and
+    the information cached about the second sequence is never modified.
+    To compare many sequences against one second sequence S from multiple
+    threads, call .set_seq2(S) once and give every thread a copy.copy() of
+    the SequenceMatcher, which shares the cached information about S.
     """
 
     cdef public object a
     cdef public object b
-    cdef public dict b2j
-    cdef public dict fullbcount
-    cdef public list matching_blocks
-    cdef public list opcodes
+    cdef public MatchingBlocks matching_blocks
+    cdef public Opcodes opcodes
     cdef public object isjunk
     cdef public set bjunk
     cdef public set bpopular
     cdef public object autojunk
-
-    # todo this is not threadsafe, which could be an problem in the long run
-    cdef vector[Py_ssize_t] j2len_
-    cdef vector[Py_ssize_t] newj2len_
-    cdef Py_hash_t* a_
+    cdef readonly str algorithm
+    cdef Algorithm algorithm_
+    cdef readonly object max_cost
+    cdef readonly object timeout
+    cdef Py_ssize_t max_cost_
+    cdef double timeout_
+    # set by cancel(), which may be called from another thread while a
+    # search reads it without the GIL, and reset when a sequence changes
+    cdef atomic[bint] cancelled_
+
+    # the index of b and a mapped to its codes.  Both are immutable and
+    # only ever replaced, so they can be used without holding the GIL
+    cdef PreparedSequence bindex
+    cdef _CodedSequence a_
     cdef Py_ssize_t la
-    cdef Py_hash_t* b_
     cdef Py_ssize_t lb
 
-    def __init__(self, isjunk=None, a='', b='', autojunk=True):
+    def __init__(self, isjunk=None, a='', b='', autojunk=True, *, algorithm='gestalt',
+                 max_cost=None, timeout=None):
         """Construct a SequenceMatcher.
 
         Optional arg isjunk is None (the default), or a one-argument
@@ -159,6 +2348,38 @@ cdef class SequenceMatcher:
         Optional arg autojunk should be set to False to disable the
         "automatic junk heuristic" that treats popular elements as junk
         (see module documentation for more information).
+
+        Optional keyword arg algorithm selects the algorithm used to find
+        the matching blocks:
+            'gestalt'    the Ratcliff/Obershelp style algorithm described
+                         above (the default)
+            'myers'      Myers' O(ND) algorithm, which finds a minimal
+                         edit script in linear space
+            'histogram'  the histogram algorithm known from git, which
+                         anchors on rare elements and falls back to
+                         'myers' when all elements are frequent
+        isjunk and autojunk only affect the 'gestalt' algorithm, and
+        find_longest_match() always uses it.  'myers' and 'histogram'
+        avoid the quadratic worst case of 'gestalt' on large, similar
+        sequences.
+
+        Optional keyword args max_cost and timeout bound the work spent on
+        a search for the matching blocks: max_cost in steps of the inner
+        loops, timeout in seconds.  Once the budget is used up, the
+        remaining parts of the sequences are only matched at their start
+        and end.  The result is still a valid (but less minimal) diff and
+        its budget_exceeded attribute is set:
+
+        >>> s = SequenceMatcher(None, "abcdefgh" * 3, "abxdefgh" * 3, max_cost=0)
+        >>> s.get_opcodes()
+        Opcodes([('equal', 0, 2, 0, 2), ('replace', 2, 19, 2, 19), ('equal', 19, 24, 19, 24)])
+        >>> s.get_opcodes().budget_exceeded
+        True
+
+        str sequences and objects exposing a 1-D integer buffer (bytes,
+        array.array, numpy.ndarray, memoryview, ...) are read straight
+        from their buffer, without creating a Python object per element.
+        Their elements compare equal to the Python ints they contain.
         """
 
         # Members:
@@ -169,18 +2390,20 @@ cdef class SequenceMatcher:
         #      we need to do to 'a' to change it into 'b'?"
         # b2j
         #      for x in b, b2j[x] is a list of the indices (into b)
-        #      at which x appears; junk and popular elements do not appear
+        #      at which x appears; junk and popular elements do not appear.
+        #      This is only a view on the integer coded index used by the
+        #      matching code and is built on first access
         # fullbcount
         #      for x in b, fullbcount[x] == the number of times x
-        #      appears in b; only materialized if really needed (used
-        #      only for computing quick_ratio())
+        #      appears in b.  quick_ratio() uses the counts of the integer
+        #      coded index, so this is only built on first access
         # matching_blocks
-        #      a list of (i, j, k) triples, where a[i:i+k] == b[j:j+k];
-        #      ascending & non-overlapping in i and in j; terminated by
-        #      a dummy (len(a), len(b), 0) sentinel
+        #      a MatchingBlocks sequence of (i, j, k) triples, where
+        #      a[i:i+k] == b[j:j+k]; ascending & non-overlapping in i and
+        #      in j; terminated by a dummy (len(a), len(b), 0) sentinel
         # opcodes
-        #      a list of (tag, i1, i2, j1, j2) tuples, where tag is
-        #      one of
+        #      an Opcodes sequence of (tag, i1, i2, j1, j2) tuples, where
+        #      tag is one of
         #          'replace'   a[i1:i2] should be replaced by b[j1:j2]
         #          'delete'    a[i1:i2] should be deleted
         #          'insert'    b[j1:j2] should be inserted
@@ -199,6 +2422,11 @@ cdef class SequenceMatcher:
         self.isjunk = isjunk
         self.a = self.b = None
         self.autojunk = autojunk
+        self.algorithm_ = _get_algorithm(algorithm)
+        self.algorithm = algorithm
+        _get_budget(max_cost, timeout, &self.max_cost_, &self.timeout_)
+        self.max_cost = max_cost
+        self.timeout = timeout
         self.set_seqs(a, b)
 
     cpdef set_seqs(self, a, b):
@@ -237,7 +2465,9 @@ cdef class SequenceMatcher:
         if a is self.a:
             return
         self.a = a
+        self.a_ = None
         self.matching_blocks = self.opcodes = None
+        self.cancelled_.store(False, memory_order_relaxed)
         self.la = len(a)
 
     cpdef set_seq2(self, b):
@@ -258,151 +2488,156 @@ cdef class SequenceMatcher:
         many sequences, use .set_seq2(S) once and call .set_seq1(x)
         repeatedly for each of the other sequences.
 
+        b can also be a PreparedSequence, whose index is then used as is.
+        Its junk and popular elements were chosen when it was created, so
+        isjunk and autojunk of the SequenceMatcher are ignored for it.
+
         See also set_seqs() and set_seq1().
         """
 
-        if b is self.b:
+        if b is self.b or b is self.bindex:
             return
-        self.b = b
-        self.j2len_.resize(<size_t>len(b) + 1)
-        self.newj2len_.resize(<size_t>len(b) + 1)
         self.matching_blocks = self.opcodes = None
-        self.fullbcount = None
+        self.cancelled_.store(False, memory_order_relaxed)
+        if isinstance(b, PreparedSequence):
+            self.bindex = b
+            b = self.bindex.seq
+        else:
+            self.bindex = PreparedSequence(b, self.isjunk, self.autojunk)
+        self.b = b
         self.lb = len(b)
-        self.__chain_b()
+        self.bjunk = self.bindex.bjunk
+        self.bpopular = self.bindex.bpopular
+        self.a_ = None
 
-    # For each element x in b, set b2j[x] to a list of the indices in
-    # b where x appears; the indices are in increasing order; note that
-    # the number of times x appears in b is len(b2j[x]) ...
-    # when self.isjunk is defined, junk elements don't show up in this
-    # map at all, which stops the central find_longest_match method
-    # from starting any matching block at a junk element ...
-    # b2j also does not contain entries for "popular" elements, meaning
-    # elements that account for more than 1 + 1% of the total elements, and
-    # when the sequence is reasonably large (>= 200 elements); this can
-    # be viewed as an adaptive notion of semi-junk, and yields an enormous
-    # speedup when, e.g., comparing program files with hundreds of
-    # instances of "return NULL;" ...
-    # note that this is only called when b changes; so for cross-product
-    # kinds of matches, it's best to call set_seq2 once, then set_seq1
-    # repeatedly
+    def replace_a(self, lo, hi, items):
+        """Replace a[lo:hi] by items.
 
-    cdef __chain_b(self):
-        # Because isjunk is a user-defined (not C) function, and we test
-        # for junk a LOT, it's important to minimize the number of calls.
-        # Before the tricks described here, __chain_b was by far the most
-        # time-consuming routine in the whole module!  If anyone sees
-        # Jim Roskind, thank him again for profile.py -- I never would
-        # have guessed that.
-        # The first trick is to build b2j ignoring the possibility
-        # of junk.  I.e., we don't call isjunk at all yet.  Throwing
-        # out the junk later is much cheaper than building b2j "right"
-        # from the start.
-        b = self.b
-        self.b2j = b2j = {}
+        This is the same as set_seq1(a[:lo] + items + a[hi:]), but cached
+        matching blocks are updated instead of being discarded: with the
+        'gestalt' algorithm only the parts of the search affected by the
+        edit are repeated.  The results are the same as after set_seq1().
+        a has to be a list, tuple, str, bytes, bytearray or array.array and
+        is replaced by a new object of the same type.
 
-        for i, elt in enumerate(b):
-            indices = b2j.setdefault(elt, [])
-            indices.append(i)
+        The new sequence and the codes of its elements are still copied, so
+        an edit takes time linear in the length of the sequences, but it
+        doesn't hash the unchanged elements or search their matches again.
 
-        # Purge junk elements
-        self.bjunk = junk = set()
-        isjunk = self.isjunk
-        if isjunk:
-            for elt in b2j.keys():
-                if isjunk(elt):
-                    junk.add(elt)
-            for elt in junk: # separate loop avoids separate list of keys
-                del b2j[elt]
+        >>> s = SequenceMatcher(None, "abxcd", "abcd")
+        >>> s.get_matching_blocks()[0]
+        Match(a=0, b=0, size=2)
+        >>> s.replace_a(2, 3, "")
+        >>> s.a
+        'abcd'
+        >>> s.ratio()
+        1.0
+        """
 
-        # Purge popular elements that are not junk
-        self.bpopular = popular = set()
-        n = len(b)
-        if self.autojunk and n >= 200:
-            ntest = n // 100 + 1
-            for elt, idxs in b2j.items():
-                if len(idxs) > ntest:
-                    popular.add(elt)
-            for elt in popular: # ditto; as fast for 1% deletion
-                del b2j[elt]
-
-    cdef CMatch __find_longest_match(self, Py_ssize_t alo, Py_ssize_t ahi, Py_ssize_t blo, Py_ssize_t bhi) except *:
-        cdef list indexes
-        cdef Py_ssize_t besti, bestj, bestsize
-        cdef Py_ssize_t i, j, k
-        cdef Py_ssize_t index_len, pos, next_val
-        cdef int found
-
-        # CAUTION:  stripping common prefix or suffix would be incorrect.
-        # E.g.,
-        #    ab
-        #    acab
-        # Longest matching block is "ab", but if common prefix is
-        # stripped, it's "a" (tied with "b").  UNIX(tm) diff does so
-        # strip, so ends up claiming that ab is changed to acab by
-        # inserting "ca" in the middle.  That's minimal but unintuitive:
-        # "it's obvious" that someone inserted "ac" at the front.
-        # Windiff ends up at the same place as diff, but by pairing up
-        # the unique 'b's and then matching the first two 'a's.
-
-        a, b, b2j, isbjunk = self.a, self.b, self.b2j, self.bjunk.__contains__
-        isjunk = self.isjunk
-        besti, bestj, bestsize = alo, blo, 0
-        # find longest junk-free match
-        # during an iteration of the loop, j2len[j] = length of longest
-        # junk-free match ending with a[i-1] and b[j]
-        nothing = []
-        for i in range(alo, ahi):
-            # look at all instances of a[i] in b; note that because
-            # b2j has no junk keys, the loop is skipped if a[i] is junk
-            for j in <list>b2j.get(a[i], nothing):
-                # a[i] matches b[j]
-                if j < blo:
-                    continue
-                if j >= bhi:
-                    break
-                k = self.j2len_[j] + 1
-                self.newj2len_[j + 1] = k
-                if k > bestsize:
-                   besti = i-k+1
-                   bestj = j-k+1
-                   bestsize = k
-
-            self.j2len_.swap(self.newj2len_)
-            fill(self.newj2len_.begin() + blo, self.newj2len_.begin() + bhi + 1, 0)
-
-        fill(self.j2len_.begin() + blo, self.j2len_.begin() + bhi + 1, 0)
-
-        # Extend the best by non-junk elements on each end.  In particular,
-        # "popular" non-junk elements aren't in b2j, which greatly speeds
-        # the inner loop above, but also means "the best" match so far
-        # doesn't contain any junk *or* popular non-junk elements.
-        while besti > alo and bestj > blo and \
-              not isbjunk(b[bestj-1]) and \
-              a[besti-1] == b[bestj-1]:
-            besti, bestj, bestsize = besti-1, bestj-1, bestsize+1
-        while besti+bestsize < ahi and bestj+bestsize < bhi and \
-              not isbjunk(b[bestj+bestsize]) and \
-              a[besti+bestsize] == b[bestj+bestsize]:
-            bestsize += 1
-
-        # Now that we have a wholly interesting match (albeit possibly
-        # empty!), we may as well suck up the matching junk on each
-        # side of it too.  Can't think of a good reason not to, and it
-        # saves post-processing the (possibly considerable) expense of
-        # figuring out what to do with it.  In the case of an empty
-        # interesting match, this is clearly the right thing to do,
-        # because no other kind of match is possible in the regions.
-        while besti > alo and bestj > blo and \
-              isbjunk(b[bestj-1]) and \
-              a[besti-1] == b[bestj-1]:
-            besti, bestj, bestsize = besti-1, bestj-1, bestsize+1
-        while besti+bestsize < ahi and bestj+bestsize < bhi and \
-              isbjunk(b[bestj+bestsize]) and \
-              a[besti+bestsize] == b[bestj+bestsize]:
-            bestsize = bestsize + 1
-
-        return CMatch(besti, bestj, bestsize)
+        cdef Py_ssize_t lo_ = lo, hi_ = hi
+        cdef SeqEdit edit
+        cdef _CodedSequence a_ = self.a_
+        cdef _CodedSequence items_
+        cdef MatchingBlocks old = self.matching_blocks
+        a = _replace_items(self.a, lo_, hi_, items)
+        edit = SeqEdit(False, lo_, hi_, len(a) - self.la + hi_ - lo_)
+        self.cancelled_.store(False, memory_order_relaxed)
+        if a_ is not None:
+            items_ = self.bindex.encode(a[lo_:lo_ + edit.size])
+            a_ = _CodedSequence.__new__(_CodedSequence)
+            a_.codes.assign(self.a_.codes.begin(), self.a_.codes.begin() + lo_)
+            a_.codes.insert(a_.codes.end(), items_.codes.begin(), items_.codes.end())
+            a_.codes.insert(a_.codes.end(), self.a_.codes.begin() + hi_, self.a_.codes.end())
+        self.a = a
+        self.la = len(a)
+        self.a_ = a_
+        self._rematch(old, &edit)
+
+    def replace_b(self, lo, hi, items):
+        """Replace b[lo:hi] by items.
+
+        This is the same as set_seq2(b[:lo] + items + b[hi:]), but the
+        information cached about b is updated instead of being rebuilt: only
+        the new items are hashed and isjunk is only called for elements
+        new to b.  Cached matching blocks are updated like by replace_a().
+        b has to be of one of the types supported by replace_a().  If b was
+        set as a PreparedSequence, its isjunk and autojunk are used instead
+        of the ones of the SequenceMatcher, like by set_seq2().
+
+        Like for replace_a(), the arrays of the index are copied, so an
+        edit takes time linear in the length of b.
+
+        >>> s = SequenceMatcher(None, "abcd", "abxcd")
+        >>> s.ratio()
+        0.8888888888888888
+        >>> s.replace_b(2, 3, "")
+        >>> s.get_opcodes()
+        Opcodes([('equal', 0, 4, 0, 4)])
+        """
+
+        cdef Py_ssize_t lo_ = lo, hi_ = hi
+        cdef SeqEdit edit
+        cdef bint same_popular = False
+        cdef PreparedSequence bindex
+        cdef _CodedSequence a_ = self.a_
+        cdef MatchingBlocks old = self.matching_blocks
+        b = _replace_items(self.b, lo_, hi_, items)
+        edit = SeqEdit(True, lo_, hi_, len(b) - self.lb + hi_ - lo_)
+        self.cancelled_.store(False, memory_order_relaxed)
+        bindex = self.bindex.replace(lo_, hi_, b, &same_popular)
+        if bindex is None:
+            self.set_seq2(self.bindex.rebuild(b))
+            return
+        if a_ is not None and bindex.view.nkeys != self.bindex.view.nkeys:
+            a_ = bindex.update_codes(self.a, a_)
+        self.b = b
+        self.lb = len(b)
+        self.bindex = bindex
+        self.bjunk = bindex.bjunk
+        self.bpopular = bindex.bpopular
+        self.a_ = a_
+        # the matching blocks depend on the popular elements of b
+        self._rematch(old if same_popular else None, &edit)
+
+    cdef _rematch(self, MatchingBlocks old, const SeqEdit* edit):
+        """update the matching blocks old after edit"""
+        cdef PreparedSequence bindex = self.bindex
+        cdef _CodedSequence a_
+        cdef vector[Py_ssize_t] buffer
+        cdef MatchScratch scratch
+        cdef MatchingBlocks matching_blocks
+        self.matching_blocks = self.opcodes = None
+        if (old is None or old.nodes.empty() or self.algorithm_ != ALGORITHM_GESTALT
+                or self.max_cost_ != PY_SSIZE_T_MAX or self.timeout_ >= 0):
+            return
+        a_ = self._encode_a()
+        matching_blocks = MatchingBlocks.__new__(MatchingBlocks)
+        with nogil:
+            _init_scratch(&scratch, buffer, bindex.view.lb)
+            _rematch_blocks(&bindex.view, a_.codes.data(), a_.codes.size(), old.nodes, edit, &scratch,
+                            matching_blocks.blocks, matching_blocks.nodes)
+        self.matching_blocks = matching_blocks
+
+    @property
+    def b2j(self):
+        return self.bindex.b2j
+
+    @property
+    def fullbcount(self):
+        return self.bindex.fullbcount
+
+    cdef int _record_match(self, const MatchStats* stats, double start) except -1:
+        return _record_stats({'event': 'match', 'algorithm': self.algorithm, 'la': self.la, 'lb': self.lb,
+                              'find_longest_match_calls': stats.find_longest_match_calls,
+                              'candidates': stats.candidates, 'max_queue': stats.max_queue,
+                              'time': _monotonic() - start})
+
+    cdef _CodedSequence _encode_a(self):
+        cdef _CodedSequence a_ = self.a_
+        if a_ is None:
+            a_ = self.bindex.encode(self.a)
+            self.a_ = a_
+        return a_
 
     def find_longest_match(self, alo=0, ahi=None, blo=0, bhi=None):
         """Find longest matching block in a[alo:ahi] and b[blo:bhi].
@@ -449,14 +2684,26 @@ cdef class SequenceMatcher:
         >>> s.find_longest_match(0, 2, 0, 1)
         Match(a=0, b=0, size=0)
         """
-        cdef Py_ssize_t ahi_ = ahi if ahi is not None else len(self.a)
-        cdef Py_ssize_t bhi_ = bhi if bhi is not None else len(self.b)
-        match = self.__find_longest_match(alo, ahi_, blo, bhi_)
+        cdef Py_ssize_t alo_ = alo
+        cdef Py_ssize_t blo_ = blo
+        cdef Py_ssize_t ahi_ = ahi if ahi is not None else self.la
+        cdef Py_ssize_t bhi_ = bhi if bhi is not None else self.lb
+        cdef PreparedSequence bindex = self.bindex
+        cdef _CodedSequence a_ = self._encode_a()
+        cdef vector[Py_ssize_t] buffer
+        cdef MatchScratch scratch
+        cdef CMatch match
+        if alo_ < 0 or ahi_ > self.la or blo_ < 0 or bhi_ > self.lb:
+            raise IndexError("range out of bounds")
+
+        with nogil:
+            _init_scratch(&scratch, buffer, bindex.view.lb)
+            match = _find_longest_match(&bindex.view, a_.codes.data(), alo_, ahi_, blo_, bhi_, &scratch)
 
         return Match(match.a, match.b, match.size)
 
-    cpdef get_matching_blocks(self):
-        """Return list of triples describing matching subsequences.
+    cpdef MatchingBlocks get_matching_blocks(self):
+        """Return sequence of triples describing matching subsequences.
 
         Each triple is of the form (i, j, n), and means that
         a[i:i+n] == b[j:j+n].  The triples are monotonically increasing in
@@ -469,72 +2716,65 @@ cdef class SequenceMatcher:
         The last triple is a dummy, (len(a), len(b), 0), and is the only
         triple with n==0.
 
+        The triples are returned as MatchingBlocks sequence, which only
+        creates the Match tuples when they are accessed.
+
         >>> s = SequenceMatcher(None, "abxcd", "abcd")
         >>> list(s.get_matching_blocks())
         [Match(a=0, b=0, size=2), Match(a=3, b=2, size=2), Match(a=5, b=4, size=0)]
         """
-        cdef Py_ssize_t i, j, k, i1, j1, k1, i2, j2, k2
-        cdef Py_ssize_t alo, ahi, blo, bhi
-        cdef size_t queue_head
-        cdef vector[MatchingBlockQueueElem] queue
-        cdef vector[CMatch] matching_blocks_
+        cdef PreparedSequence bindex
+        cdef _CodedSequence a_
+        cdef vector[Py_ssize_t] buffer
+        cdef MatchScratch scratch
+        cdef vector[CMatch] raw_blocks
+        cdef MatchingBlocks matching_blocks
+        cdef Budget budget
+        cdef Budget* pbudget = NULL
+        cdef MatchStats stats = MatchStats(0, 0, 0)
+        cdef bint collect_stats = _stats is not None
+        cdef double start = 0.0
 
         if self.matching_blocks is not None:
             return self.matching_blocks
 
-        # This is most naturally expressed as a recursive algorithm, but
-        # at least one user bumped into extreme use cases that exceeded
-        # the recursion limit on their box.  So, now we maintain a list
-        # ('queue`) of blocks we still need to look at, and append partial
-        # results to `matching_blocks` in a loop; the matches are sorted
-        # at the end.
-        queue.push_back(MatchingBlockQueueElem(0, self.la, 0, self.lb))
-        while not queue.empty():
-            elem = queue.back()
-            alo, ahi, blo, bhi = elem.alo, elem.ahi, elem.blo, elem.bhi
-            queue.pop_back()
-            x = self.__find_longest_match(alo, ahi, blo, bhi)
-            i, j, k = x.a, x.b, x.size
-            # a[alo:i] vs b[blo:j] unknown
-            # a[i:i+k] same as b[j:j+k]
-            # a[i+k:ahi] vs b[j+k:bhi] unknown
-            if k:   # if k is 0, there was no matching block
-                matching_blocks_.push_back(x)
-                if alo < i and blo < j:
-                    queue.push_back(MatchingBlockQueueElem(alo, i, blo, j))
-                if i+k < ahi and j+k < bhi:
-                    queue.push_back(MatchingBlockQueueElem(i+k, ahi, j+k, bhi))
-        cpp_sort(matching_blocks_.begin(), matching_blocks_.end(), &CMatch_sorter)
-
-        # It's possible that we have adjacent equal blocks in the
-        # matching_blocks list now.  Starting with 2.5, this code was added
-        # to collapse them.
-        i1 = j1 = k1 = 0
-        non_adjacent = []
-        for match in matching_blocks_:
-            i2, j2, k2 = match.a, match.b, match.size
-            # Is this block adjacent to i1, j1, k1?
-            if i1 + k1 == i2 and j1 + k1 == j2:
-                # Yes, so collapse them -- this just increases the length of
-                # the first block by the length of the second, and the first
-                # block so lengthened remains the block to compare against.
-                k1 += k2
+        if collect_stats:
+            start = _monotonic()
+        # the scratch space is allocated per call and the index and codes
+        # are never modified, so the GIL can be released while searching
+        bindex = self.bindex
+        a_ = self._encode_a()
+        matching_blocks = MatchingBlocks.__new__(MatchingBlocks)
+        with nogil:
+            if self.max_cost_ != PY_SSIZE_T_MAX or self.timeout_ >= 0:
+                _init_budget(&budget, self.max_cost_, self.timeout_, &self.cancelled_)
+                pbudget = &budget
+            if self.algorithm_ == ALGORITHM_GESTALT:
+                _init_scratch(&scratch, buffer, bindex.view.lb)
+                scratch.budget = pbudget
+                if collect_stats:
+                    scratch.stats = &stats
+                _get_matching_blocks(&bindex.view, a_.codes.data(), a_.codes.size(), &scratch,
+                                     matching_blocks.blocks, &matching_blocks.nodes)
             else:
-                # Not adjacent.  Remember the first block (k1==0 means it's
-                # the dummy we started with), and make the second block the
-                # new block to compare against.
-                if k1:
-                    non_adjacent.append(Match(i1, j1, k1))
-                i1, j1, k1 = i2, j2, k2
-        if k1:
-            non_adjacent.append(Match(i1, j1, k1))
-
-        non_adjacent.append(Match(self.la, self.lb, 0))
-        self.matching_blocks = non_adjacent
+                if self.algorithm_ == ALGORITHM_MYERS:
+                    _myers_matching_blocks(a_.codes.data(), bindex.view.b, 0, a_.codes.size(), 0, bindex.view.lb,
+                                           buffer, raw_blocks, pbudget)
+                else:
+                    _histogram_matching_blocks(&bindex.view, a_.codes.data(), a_.codes.size(), raw_blocks,
+                                               pbudget)
+                _collapse_matching_blocks(raw_blocks, a_.codes.size(), bindex.view.lb, matching_blocks.blocks)
+        matching_blocks.budget_exceeded = pbudget != NULL and budget.exceeded
+        if matching_blocks.budget_exceeded:
+            matching_blocks.nodes.clear()
+        if collect_stats:
+            self._record_match(&stats, start)
+
+        self.matching_blocks = matching_blocks
         return self.matching_blocks
 
-    def get_opcodes(self):
-        """Return list of 5-tuples describing how to turn a into b.
+    cpdef Opcodes get_opcodes(self):
+        """Return sequence of 5-tuples describing how to turn a into b.
 
         Each tuple is of the form (tag, i1, i2, j1, j2).  The first tuple
         has i1 == j1 == 0, and remaining tuples have i1 == the i2 from the
@@ -549,6 +2789,9 @@ cdef class SequenceMatcher:
                     Note that i1==i2 in this case.
         'equal':    a[i1:i2] == b[j1:j2]
 
+        The tuples are returned as Opcodes sequence, which only creates
+        the tuples when they are accessed.
+
         >>> a = "qabxcd"
         >>> b = "abycdf"
         >>> s = SequenceMatcher(None, a, b)
@@ -561,32 +2804,17 @@ cdef class SequenceMatcher:
           equal a[4:6] (cd) b[3:5] (cd)
          insert a[6:6] () b[5:6] (f)
         """
+        cdef MatchingBlocks matching_blocks
+        cdef Opcodes opcodes
 
         if self.opcodes is not None:
             return self.opcodes
-        i = j = 0
-        self.opcodes = answer = []
-        for ai, bj, size in self.get_matching_blocks():
-            # invariant:  we've pumped out correct diffs to change
-            # a[:i] into b[:j], and the next matching block is
-            # a[ai:ai+size] == b[bj:bj+size].  So we need to pump
-            # out a diff to change a[i:ai] into b[j:bj], pump out
-            # the matching block, and move (i,j) beyond the match
-            tag = ''
-            if i < ai and j < bj:
-                tag = 'replace'
-            elif i < ai:
-                tag = 'delete'
-            elif j < bj:
-                tag = 'insert'
-            if tag:
-                answer.append( (tag, i, ai, j, bj) )
-            i, j = ai+size, bj+size
-            # the list of matching blocks is terminated by a
-            # sentinel with size 0
-            if size:
-                answer.append( ('equal', ai, i, bj, j) )
-        return answer
+        matching_blocks = self.get_matching_blocks()
+        opcodes = Opcodes.__new__(Opcodes)
+        _get_opcodes(matching_blocks.blocks, opcodes.opcodes)
+        opcodes.budget_exceeded = matching_blocks.budget_exceeded
+        self.opcodes = opcodes
+        return self.opcodes
 
     def get_grouped_opcodes(self, n=3):
         """ Isolate change clusters by eliminating ranges with no changes.
@@ -613,7 +2841,7 @@ cdef class SequenceMatcher:
           ('equal', 35, 38, 31, 34)]]
         """
 
-        codes = self.get_opcodes()
+        codes = list(self.get_opcodes())
         if not codes:
             codes = [("equal", 0, 1, 0, 1)]
         # Fixup leading and trailing groups if they show no changes.
@@ -638,7 +2866,7 @@ cdef class SequenceMatcher:
         if group and not (len(group)==1 and group[0][0] == 'equal'):
             yield group
 
-    def ratio(self):
+    def ratio(self, score_cutoff=None):
         """Return a measure of the sequences' similarity (float in [0,1]).
 
         Where T is the total number of elements in both sequences, and
@@ -646,6 +2874,11 @@ cdef class SequenceMatcher:
         Note that this is 1 if the sequences are identical, and 0 if
         they have nothing in common.
 
+        Optional arg score_cutoff is a float in [0, 1].  If the ratio is
+        below it, 0.0 is returned instead.  When the matching blocks are
+        not cached yet, the search for them is abandoned as soon as the
+        ratio can't reach score_cutoff anymore.
+
         .ratio() is expensive to compute if you haven't already computed
         .get_matching_blocks() or .get_opcodes(), in which case you may
         want to try .quick_ratio() or .real_quick_ratio() first to get an
@@ -658,39 +2891,67 @@ cdef class SequenceMatcher:
         0.75
         >>> s.real_quick_ratio()
         1.0
+        >>> s.ratio(score_cutoff=0.8)
+        0.0
         """
 
-        matches = sum(triple[-1] for triple in self.get_matching_blocks())
-        return _calculate_ratio(matches, len(self.a) + len(self.b))
+        cdef Py_ssize_t matches = 0
+        cdef double cutoff = 0.0 if score_cutoff is None else score_cutoff
+        cdef double score
+        cdef PreparedSequence bindex
+        cdef _CodedSequence a_
+        cdef vector[Py_ssize_t] buffer
+        cdef MatchScratch scratch
+        cdef MatchStats stats = MatchStats(0, 0, 0)
+        cdef bint collect_stats = _stats is not None
+        cdef double start = 0.0
+
+        if (self.matching_blocks is None and self.algorithm_ == ALGORITHM_GESTALT and cutoff > 0.0
+                and self.max_cost_ == PY_SSIZE_T_MAX and self.timeout_ < 0):
+            # only the number of matches is required, so the matching
+            # blocks are neither collapsed nor cached
+            if collect_stats:
+                start = _monotonic()
+            bindex = self.bindex
+            a_ = self._encode_a()
+            with nogil:
+                _init_scratch(&scratch, buffer, bindex.view.lb)
+                if collect_stats:
+                    scratch.stats = &stats
+                matches = _count_matches(&bindex.view, a_.codes.data(), a_.codes.size(), &scratch, cutoff)
+            if collect_stats:
+                self._record_match(&stats, start)
+        else:
+            for match in self.get_matching_blocks().blocks:
+                matches += match.size
+        score = _calculate_ratio(matches, self.la + self.lb)
+        return score if score >= cutoff else 0.0
 
-    def quick_ratio(self):
+    def quick_ratio(self, score_cutoff=None):
         """Return an upper bound on ratio() relatively quickly.
 
         This isn't defined beyond that it is an upper bound on .ratio(), and
         is faster to compute.
+
+        Optional arg score_cutoff is a float in [0, 1].  If the result is
+        below it, 0.0 is returned instead.
         """
 
+        cdef Py_ssize_t matches
+        cdef double cutoff = 0.0 if score_cutoff is None else score_cutoff
+        cdef double score
+        cdef PreparedSequence bindex = self.bindex
+        cdef _CodedSequence a_ = self._encode_a()
+
         # viewing a and b as multisets, set matches to the cardinality
         # of their intersection; this counts the number of matches
-        # without regard to order, so is clearly an upper bound
-        if self.fullbcount is None:
-            self.fullbcount = fullbcount = {}
-            for elt in self.b:
-                fullbcount[elt] = fullbcount.get(elt, 0) + 1
-        fullbcount = self.fullbcount
-        # avail[x] is the number of times x appears in 'b' less the
-        # number of times we've seen it in 'a' so far ... kinda
-        avail = {}
-        availhas, matches = avail.__contains__, 0
-        for elt in self.a:
-            if availhas(elt):
-                numb = avail[elt]
-            else:
-                numb = fullbcount.get(elt, 0)
-            avail[elt] = numb - 1
-            if numb > 0:
-                matches = matches + 1
-        return _calculate_ratio(matches, len(self.a) + len(self.b))
+        # without regard to order, so is clearly an upper bound.  The
+        # counts of b are part of its index, and a is mapped to the same
+        # codes used by ratio()
+        with nogil:
+            matches = _count_quick_matches(&bindex.view, a_.codes.data(), a_.codes.size(), cutoff)
+        score = _calculate_ratio(matches, self.la + self.lb)
+        return score if score >= cutoff else 0.0
 
     def real_quick_ratio(self):
         """Return an upper bound on ratio() very quickly.
@@ -704,6 +2965,50 @@ cdef class SequenceMatcher:
         # shorter sequence
         return _calculate_ratio(min(la, lb), la + lb)
 
+    def cancel(self):
+        """Cancel the searches for matching blocks of this SequenceMatcher.
+
+        This is meant to be called from another thread while
+        get_matching_blocks() (or a method using it) runs with the GIL
+        released.  The search then stops like a search whose work budget is
+        used up, and so do all later searches of this SequenceMatcher until
+        one of its sequences is changed with set_seqs(), set_seq1(),
+        set_seq2(), replace_a() or replace_b().  Only searches with a budget check for cancellation, so
+        max_cost or timeout has to be set; timeout=float("inf") never runs
+        out.
+
+        >>> s = SequenceMatcher(None, "abxcd", "abcd", timeout=float("inf"))
+        >>> s.cancel()
+        >>> s.get_opcodes().budget_exceeded
+        True
+        >>> s.set_seq1("abcd")
+        >>> s.get_opcodes().budget_exceeded
+        False
+        """
+        self.cancelled_.store(True, memory_order_relaxed)
+
+    def __copy__(self):
+        cdef SequenceMatcher other = type(self).__new__(type(self))
+        other.isjunk = self.isjunk
+        other.autojunk = self.autojunk
+        other.algorithm = self.algorithm
+        other.algorithm_ = self.algorithm_
+        other.max_cost = self.max_cost
+        other.max_cost_ = self.max_cost_
+        other.timeout = self.timeout
+        other.timeout_ = self.timeout_
+        other.a = self.a
+        other.la = self.la
+        other.a_ = self.a_
+        other.b = self.b
+        other.lb = self.lb
+        other.bindex = self.bindex
+        other.bjunk = self.bjunk
+        other.bpopular = self.bpopular
+        other.matching_blocks = self.matching_blocks
+        other.opcodes = self.opcodes
+        return other
+
     # todo add this once it is supported in all Python versions
     #__class_getitem__ = classmethod(GenericAlias)
 
@@ -747,9 +3052,10 @@ def get_close_matches(word, possibilities, n=3, cutoff=0.6):
     for x in possibilities:
         s.set_seq1(x)
         if s.real_quick_ratio() >= cutoff and \
-           s.quick_ratio() >= cutoff and \
-           s.ratio() >= cutoff:
-            result.append((s.ratio(), x))
+           s.quick_ratio(cutoff) >= cutoff:
+            score = s.ratio(cutoff)
+            if score >= cutoff:
+                result.append((score, x))
 
     # Move the best scorers to head of list
     result = _nlargest(n, result)
@@ -757,54 +3063,941 @@ def get_close_matches(word, possibilities, n=3, cutoff=0.6):
     return [x for score, x in result]
 
 
-def _keep_original_ws(s, tag_s):
-    """Replace whitespace with the original whitespace characters in `s`"""
-    return ''.join(
-        c if tag_c == " " and c.isspace() else tag_c
-        for c, tag_c in zip(s, tag_s)
-    )
+cdef void _count_codes(const Py_ssize_t* codes, Py_ssize_t length, vector[Py_ssize_t]& buffer,
+                       vector[Py_ssize_t]& keys, vector[Py_ssize_t]& counts) noexcept nogil:
+    """append the multiset of codes as (code, count) pairs sorted by code; negative codes are skipped"""
+    cdef Py_ssize_t i
+    buffer.assign(codes, codes + length)
+    cpp_sort(buffer.begin(), buffer.end())
+    for i in range(length):
+        if buffer[i] < 0:
+            continue
+        if i and buffer[i] == buffer[i - 1]:
+            counts[counts.size() - 1] += 1
+        else:
+            keys.push_back(buffer[i])
+            counts.push_back(1)
+
+
+cdef Py_ssize_t _count_common(const Py_ssize_t* keys1, const Py_ssize_t* counts1, Py_ssize_t len1,
+                              const Py_ssize_t* keys2, const Py_ssize_t* counts2, Py_ssize_t len2) noexcept nogil:
+    """cardinality of the intersection of two multisets created by _count_codes"""
+    cdef Py_ssize_t i = 0, j = 0, common = 0
+    while i < len1 and j < len2:
+        if keys1[i] < keys2[j]:
+            i += 1
+        elif keys1[i] > keys2[j]:
+            j += 1
+        else:
+            common += min(counts1[i], counts2[j])
+            i += 1
+            j += 1
+    return common
+
+
+@cython.final
+cdef class CloseMatcher:
+    """Index of a fixed list of possibilities for get_close_matches().
+
+    get_close_matches() has to look at every possibility for every word.
+    CloseMatcher maps the elements of all possibilities to integer codes,
+    counts them, sorts the possibilities by length and keeps a posting
+    list of the possibilities containing each element.  A query only
+    visits the possibilities found in the posting lists of its rarest
+    elements, which are the only ones that can share enough elements with
+    the word to reach the cutoff, and within the range of lengths whose
+    real_quick_ratio() reaches it.  Their quick_ratio() upper bound is
+    computed from the precomputed counts, and ratio() is computed in
+    order of this bound until it can't reach the cutoff or the score of
+    the n best matches found so far.
+
+    How many possibilities are visited depends on how selective the
+    elements of the word are.  For words over a small alphabet, like
+    English words with the default cutoff of 0.6, most of the
+    possibilities of similar length share enough characters and queries
+    still take time linear in the number of possibilities, just with a
+    smaller constant.  A cutoff of 0 visits all possibilities.
+
+    The results are identical to get_close_matches(word, possibilities,
+    n, cutoff):
+
+    >>> matcher = CloseMatcher(["ape", "apple", "peach", "puppy"])
+    >>> matcher.get_close_matches("appel")
+    ['apple', 'ape']
+    >>> matcher.get_close_matches("peach", n=1)
+    ['peach']
 
+    The index is never modified after creation and the GIL is released
+    while searching, so a CloseMatcher can be queried from multiple
+    threads at the same time.
+    """
 
+    cdef readonly tuple possibilities
+    # element -> code for all elements of the possibilities
+    cdef dict keys_
+    # the possibilities mapped to their codes, as CSR array
+    cdef vector[Py_ssize_t] seq_offsets
+    cdef vector[Py_ssize_t] seq_codes
+    # multiset of every possibility as (code, count) pairs sorted by code
+    cdef vector[Py_ssize_t] count_offsets
+    cdef vector[Py_ssize_t] count_keys
+    cdef vector[Py_ssize_t] count_values
+    # indices of the possibilities ordered by length, and the distinct
+    # lengths with the start of their bucket in order
+    cdef vector[Py_ssize_t] order
+    cdef vector[Py_ssize_t] bucket_lengths
+    cdef vector[Py_ssize_t] bucket_offsets
+    # for every code the positions in order of the possibilities
+    # containing it, in increasing order (so by length), and how often
+    # they contain it, as CSR array
+    cdef vector[Py_ssize_t] posting_offsets
+    cdef vector[Py_ssize_t] postings
+    cdef vector[Py_ssize_t] posting_counts
+
+    def __init__(self, possibilities):
+        """Construct a CloseMatcher.
+
+        possibilities is an iterable of sequences against which words are
+        matched (typically strings).  The elements of the sequences must
+        be hashable.
+        """
+        cdef Py_ssize_t i, k, idx, start, end
+        cdef vector[Py_ssize_t] buffer
+        cdef vector[pair[Py_ssize_t, Py_ssize_t]] by_length
+        cdef dict keys
+
+        self.possibilities = tuple(possibilities)
+        self.keys_ = keys = {}
+        self.seq_offsets.push_back(0)
+        self.count_offsets.push_back(0)
+        for i, x in enumerate(self.possibilities):
+            for elt in x:
+                self.seq_codes.push_back(keys.setdefault(elt, len(keys)))
+            start = self.seq_offsets.back()
+            end = self.seq_codes.size()
+            self.seq_offsets.push_back(end)
+            _count_codes(self.seq_codes.data() + start, end - start, buffer,
+                         self.count_keys, self.count_values)
+            self.count_offsets.push_back(self.count_keys.size())
+            by_length.push_back(pair[Py_ssize_t, Py_ssize_t](end - start, i))
+
+        cpp_sort(by_length.begin(), by_length.end())
+        for i in range(<Py_ssize_t>by_length.size()):
+            if i == 0 or by_length[i].first != by_length[i - 1].first:
+                self.bucket_lengths.push_back(by_length[i].first)
+                self.bucket_offsets.push_back(i)
+            self.order.push_back(by_length[i].second)
+        self.bucket_offsets.push_back(by_length.size())
+
+        self.posting_offsets.assign(len(keys) + 1, 0)
+        for k in range(<Py_ssize_t>self.count_keys.size()):
+            self.posting_offsets[self.count_keys[k] + 1] += 1
+        for i in range(len(keys)):
+            self.posting_offsets[i + 1] += self.posting_offsets[i]
+        self.postings.resize(self.count_keys.size())
+        self.posting_counts.resize(self.count_keys.size())
+        buffer.assign(self.posting_offsets.begin(), self.posting_offsets.end() - 1)
+        for i in range(<Py_ssize_t>self.order.size()):
+            idx = self.order[i]
+            for k in range(self.count_offsets[idx], self.count_offsets[idx + 1]):
+                self.postings[buffer[self.count_keys[k]]] = i
+                self.posting_counts[buffer[self.count_keys[k]]] = self.count_values[k]
+                buffer[self.count_keys[k]] += 1
+
+    def __len__(self):
+        return len(self.possibilities)
+
+    def get_close_matches(self, word, n=3, cutoff=0.6):
+        """Return list of the best "good enough" matches for word.
+
+        The arguments and the result are the same as for
+        get_close_matches(word, possibilities, n, cutoff).
+        """
+        cdef PreparedSequence bindex
+        cdef unordered_map[Py_ssize_t, Py_ssize_t] translate
+        cdef vector[Py_ssize_t] word_codes, word_keys, word_counts, buffer
+        cdef vector[pair[double, Py_ssize_t]] candidates
+        cdef Py_ssize_t i, code, n_
+        cdef double cutoff_
+        cdef dict keys = self.keys_
+
+        if not n >  0:
+            raise ValueError("n must be > 0: %r" % (n,))
+        if not 0.0 <= cutoff <= 1.0:
+            raise ValueError("cutoff must be in [0.0, 1.0]: %r" % (cutoff,))
+        n_ = min(n, len(self.possibilities) + 1)
+        cutoff_ = cutoff
+
+        # word is the second sequence, just like in get_close_matches, so
+        # the autojunk heuristic applies to it.  translate maps the codes
+        # of the possibilities to the codes of the index of word
+        bindex = PreparedSequence(word, None, True)
+        for i, elt in enumerate(bindex._elements()):
+            code = keys.get(elt, -1)
+            if code != -1:
+                translate[code] = i
+        for elt in word:
+            word_codes.push_back(keys.get(elt, -1))
+        _count_codes(word_codes.data(), word_codes.size(), buffer, word_keys, word_counts)
+
+        with nogil:
+            self._search(&bindex.view, translate, word_keys, word_counts, n_, cutoff_, candidates)
+
+        result = [(candidate.first, self.possibilities[candidate.second]) for candidate in candidates]
+        # Move the best scorers to head of list
+        result = _nlargest(n, result)
+        # Strip scores for the best n matches
+        return [x for score, x in result]
+
+    cdef int _search(self, const BIndexView* bidx, const unordered_map[Py_ssize_t, Py_ssize_t]& translate,
+                     const vector[Py_ssize_t]& word_keys, const vector[Py_ssize_t]& word_counts,
+                     Py_ssize_t n, double cutoff, vector[pair[double, Py_ssize_t]]& candidates) except -1 nogil:
+        """collect (ratio, index) of all possibilities that might be one of the n best matches"""
+        cdef unordered_map[Py_ssize_t, Py_ssize_t].const_iterator it
+        cdef vector[pair[double, Py_ssize_t]] bounds
+        cdef vector[Py_ssize_t] found, common
+        cdef priority_queue[double] best
+        cdef vector[Py_ssize_t] a, buffer
+        cdef MatchScratch scratch
+        cdef Py_ssize_t lb = bidx.lb
+        cdef Py_ssize_t bucket, pos, end, idx, la, i, first = 0, last = 0, code, matches
+        cdef double score, bound
+        cdef size_t k
+
+        # only the possibilities in the range of lengths whose
+        # real_quick_ratio() reaches the cutoff are considered
+        for bucket in range(<Py_ssize_t>self.bucket_lengths.size()):
+            la = self.bucket_lengths[bucket]
+            if _calculate_ratio(min(la, lb), la + lb) >= cutoff:
+                if last == first:
+                    first = self.bucket_offsets[bucket]
+                last = self.bucket_offsets[bucket + 1]
+
+        if cutoff > 0.0 and lb > 0:
+            # A possibility sharing no element with the word has a ratio of
+            # 0, so only the possibilities in the posting lists of the
+            # elements of the word are visited.  common accumulates the
+            # number of shared elements of each of them
+            common.assign(<size_t>(last - first), 0)
+            for k in range(word_keys.size()):
+                code = word_keys[k]
+                end = self.posting_offsets[code + 1]
+                pos = lower_bound(self.postings.begin() + self.posting_offsets[code],
+                                  self.postings.begin() + end, first) - self.postings.begin()
+                while pos < end and self.postings[pos] < last:
+                    i = self.postings[pos] - first
+                    if common[i] == 0:
+                        found.push_back(self.postings[pos])
+                    common[i] += min(word_counts[k], self.posting_counts[pos])
+                    pos += 1
+            for k in range(found.size()):
+                idx = self.order[found[k]]
+                la = self.seq_offsets[idx + 1] - self.seq_offsets[idx]
+                bound = _calculate_ratio(common[found[k] - first], la + lb)
+                if bound >= cutoff:
+                    bounds.push_back(pair[double, Py_ssize_t](-bound, idx))
+        else:
+            # all possibilities in the range reach a cutoff of 0, and with an
+            # empty word there are no posting lists to look at
+            for pos in range(first, last):
+                idx = self.order[pos]
+                la = self.seq_offsets[idx + 1] - self.seq_offsets[idx]
+                matches = _count_common(
+                    self.count_keys.data() + self.count_offsets[idx],
+                    self.count_values.data() + self.count_offsets[idx],
+                    self.count_offsets[idx + 1] - self.count_offsets[idx],
+                    word_keys.data(), word_counts.data(), word_keys.size())
+                bound = _calculate_ratio(matches, la + lb)
+                if bound >= cutoff:
+                    bounds.push_back(pair[double, Py_ssize_t](-bound, idx))
+        cpp_sort(bounds.begin(), bounds.end())
+
+        # compute ratio() in order of the upper bound, until it can't reach
+        # the score of the n best matches so far anymore
+        _init_scratch(&scratch, buffer, lb)
+        for k in range(bounds.size()):
+            bound = -bounds[k].first
+            if <Py_ssize_t>best.size() == n and bound < -best.top():
+                break
+            idx = bounds[k].second
+            la = self.seq_offsets[idx + 1] - self.seq_offsets[idx]
+            a.resize(<size_t>la)
+            for i in range(la):
+                it = translate.find(self.seq_codes[self.seq_offsets[idx] + i])
+                a[i] = deref(it).second if it != translate.end() else -1
+            bound = cutoff
+            if <Py_ssize_t>best.size() == n:
+                bound = max(bound, -best.top())
+            matches = _count_matches(bidx, a.data(), la, &scratch, bound)
+            score = _calculate_ratio(matches, la + lb)
+            if score < bound:
+                continue
 
-class Differ:
-    r"""
-    Differ is a class for comparing sequences of lines of text, and
-    producing human-readable differences or deltas.  Differ uses
-    SequenceMatcher both to compare sequences of lines, and to compare
-    sequences of characters within similar (near-matching) lines.
+            candidates.push_back(pair[double, Py_ssize_t](score, idx))
+            best.push(-score)
+            if <Py_ssize_t>best.size() > n:
+                best.pop()
+        return 0
 
-    Each line of a Differ delta begins with a two-letter code:
 
-        '- '    line unique to sequence 1
-        '+ '    line unique to sequence 2
-        '  '    line common to both sequences
-        '? '    line not present in either input sequence
+cdef enum Scorer:
+    SCORER_RATIO
+    SCORER_QUICK_RATIO
+    SCORER_REAL_QUICK_RATIO
 
-    Lines beginning with '? ' attempt to guide the eye to intraline
-    differences, and were not present in either input sequence.  These lines
-    can be confusing if the sequences contain tab characters.
+_scorers = {
+    'ratio': SCORER_RATIO,
+    'quick_ratio': SCORER_QUICK_RATIO,
+    'real_quick_ratio': SCORER_REAL_QUICK_RATIO,
+}
 
-    Note that Differ makes no claim to produce a *minimal* diff.  To the
-    contrary, minimal diffs are often counter-intuitive, because they synch
-    up anywhere possible, sometimes accidental matches 100 pages apart.
-    Restricting synch points to contiguous matches preserves some notion of
-    locality, at the occasional cost of producing a longer diff.
 
-    Example: Comparing two texts.
+@cython.final
+cdef class _ScoreMatrix:
+    """Queries and choices of cdist() mapped to integer codes.
 
-    First we set up the texts, sequences of individual single-line strings
-    ending with newlines (such sequences can also be obtained from the
-    `readlines()` method of file-like objects):
+    Every choice is indexed once.  All elements share one code space, and
+    translate maps these codes to the codes of the index of each choice.
+    Nothing is modified after creation, so rows can be scored from
+    multiple threads without holding the GIL.
+    """
 
-    >>> text1 = '''  1. Beautiful is better than ugly.
-    ...   2. Explicit is better than implicit.
-    ...   3. Simple is better than complex.
-    ...   4. Complex is better than complicated.
-    ... '''.splitlines(keepends=True)
-    >>> len(text1)
-    4
-    >>> text1[0][-1]
-    '\n'
+    cdef Scorer scorer
+    cdef double cutoff
+    cdef bint counted
+    cdef bint single
+    cdef char* out
+    cdef Py_ssize_t ncols
+    cdef list indexes
+    cdef vector[BIndexView] views
+    cdef vector[unordered_map[Py_ssize_t, Py_ssize_t]] translate
+    # queries mapped to the shared codes, as CSR array
+    cdef vector[Py_ssize_t] seq_offsets
+    cdef vector[Py_ssize_t] seq_codes
+    # multisets of the queries and choices as (code, count) pairs
+    cdef vector[Py_ssize_t] query_offsets, query_keys, query_values
+    cdef vector[Py_ssize_t] choice_offsets, choice_keys, choice_values
+
+    def __init__(self, queries, choices, scorer, double cutoff):
+        cdef PreparedSequence bindex
+        cdef Py_ssize_t start, end
+        cdef vector[Py_ssize_t] codes, buffer
+        cdef dict keys = {}
+
+        self.scorer = scorer
+        self.cutoff = cutoff
+        # quick_ratio() is used as upper bound of ratio() when there is a cutoff
+        self.counted = scorer == SCORER_QUICK_RATIO or (scorer == SCORER_RATIO and cutoff > 0.0)
+        self.indexes = []
+        self.seq_offsets.push_back(0)
+        self.query_offsets.push_back(0)
+        for x in queries:
+            for elt in x:
+                self.seq_codes.push_back(keys.setdefault(elt, len(keys)))
+            start = self.seq_offsets.back()
+            end = self.seq_codes.size()
+            self.seq_offsets.push_back(end)
+            if self.counted:
+                _count_codes(self.seq_codes.data() + start, end - start, buffer,
+                             self.query_keys, self.query_values)
+            self.query_offsets.push_back(self.query_keys.size())
+
+        self.choice_offsets.push_back(0)
+        for y in choices:
+            bindex = PreparedSequence(y, None, True)
+            self.indexes.append(bindex)
+            self.views.push_back(bindex.view)
+            self.translate.push_back(unordered_map[Py_ssize_t, Py_ssize_t]())
+            if scorer == SCORER_RATIO:
+                for code, elt in enumerate(bindex._elements()):
+                    if elt in keys:
+                        self.translate.back()[keys[elt]] = code
+            if self.counted:
+                codes.clear()
+                for elt in y:
+                    codes.push_back(keys.get(elt, -1))
+                _count_codes(codes.data(), codes.size(), buffer, self.choice_keys, self.choice_values)
+            self.choice_offsets.push_back(self.choice_keys.size())
+        self.ncols = self.views.size()
+
+    def score_rows(self, Py_ssize_t start, Py_ssize_t end):
+        with nogil:
+            self._score_rows(start, end)
+
+    cdef int _score_rows(self, Py_ssize_t start, Py_ssize_t end) except -1 nogil:
+        cdef unordered_map[Py_ssize_t, Py_ssize_t].const_iterator it
+        cdef vector[Py_ssize_t] a, buffer
+        cdef MatchScratch scratch
+        cdef const BIndexView* bidx
+        cdef Py_ssize_t row, col, la, lb, i, matches
+        cdef double score
+
+        for row in range(start, end):
+            la = self.seq_offsets[row + 1] - self.seq_offsets[row]
+            for col in range(self.ncols):
+                bidx = &self.views[col]
+                lb = bidx.lb
+                # real_quick_ratio() and quick_ratio() are upper bounds of
+                # the following scores, so pairs below the cutoff stop early
+                score = _calculate_ratio(min(la, lb), la + lb)
+                if self.counted and self.scorer != SCORER_REAL_QUICK_RATIO and score >= self.cutoff:
+                    matches = _count_common(
+                        self.query_keys.data() + self.query_offsets[row],
+                        self.query_values.data() + self.query_offsets[row],
+                        self.query_offsets[row + 1] - self.query_offsets[row],
+                        self.choice_keys.data() + self.choice_offsets[col],
+                        self.choice_values.data() + self.choice_offsets[col],
+                        self.choice_offsets[col + 1] - self.choice_offsets[col])
+                    score = _calculate_ratio(matches, la + lb)
+                if self.scorer == SCORER_RATIO and score >= self.cutoff:
+                    matches = 0
+                    if not self.translate[col].empty():
+                        a.resize(<size_t>la)
+                        for i in range(la):
+                            it = self.translate[col].find(self.seq_codes[self.seq_offsets[row] + i])
+                            a[i] = deref(it).second if it != self.translate[col].end() else -1
+                        _init_scratch(&scratch, buffer, lb)
+                        matches = _count_matches(bidx, a.data(), la, &scratch, self.cutoff)
+                    score = _calculate_ratio(matches, la + lb)
+                if score < self.cutoff:
+                    score = 0.0
+                if self.single:
+                    (<float*>self.out)[row * self.ncols + col] = <float>score
+                else:
+                    (<double*>self.out)[row * self.ncols + col] = score
+        return 0
+
+
+def cdist(queries, choices, *, scorer='ratio', score_cutoff=None, dtype=None, workers=-1):
+    """Compute the similarity of every query to every choice.
+
+    Returns a numpy array of shape (len(queries), len(choices)), where
+    result[i, j] is the score of SequenceMatcher(None, queries[i],
+    choices[j]).  This requires numpy.
+
+    Optional arg scorer selects the score: 'ratio' (the default),
+    'quick_ratio' or 'real_quick_ratio'.
+
+    Optional arg score_cutoff is a float in [0, 1].  Scores below it are
+    set to 0.0.  Pairs that can't reach it according to the cheaper upper
+    bounds are skipped without computing the score.
+
+    Optional arg dtype is numpy.float64 (the default) or numpy.float32.
+
+    Optional arg workers is the number of threads used to compute the
+    rows of the result.  -1 (the default) uses one thread per CPU.  The
+    GIL is released while computing the scores.
+
+    >>> cdist(["abcd", "bcde"], ["bcde", "xyz"]).tolist()
+    [[0.75, 0.0], [1.0, 0.0]]
+    """
+    import numpy as np
+    cdef _ScoreMatrix matrix
+    cdef Py_buffer view
+    cdef Py_ssize_t nrows, chunksize
+
+    if scorer not in _scorers:
+        raise ValueError("scorer must be one of 'ratio', 'quick_ratio', 'real_quick_ratio': %r" % (scorer,))
+    if score_cutoff is None:
+        score_cutoff = 0.0
+    if not 0.0 <= score_cutoff <= 1.0:
+        raise ValueError("score_cutoff must be in [0.0, 1.0]: %r" % (score_cutoff,))
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    if dtype != np.float64 and dtype != np.float32:
+        raise ValueError("dtype must be float32 or float64: %r" % (dtype,))
+    if workers == -1:
+        workers = _cpu_count() or 1
+    if not workers > 0:
+        raise ValueError("workers must be > 0 or -1: %r" % (workers,))
+
+    queries = list(queries)
+    choices = list(choices)
+    matrix = _ScoreMatrix(queries, choices, _scorers[scorer], score_cutoff)
+    result = np.empty((len(queries), len(choices)), dtype=dtype)
+    nrows = len(queries)
+    PyObject_GetBuffer(result, &view, PyBUF_WRITABLE)
+    try:
+        matrix.out = <char*>view.buf
+        matrix.single = dtype == np.float32
+        workers = min(workers, nrows)
+        if workers <= 1:
+            matrix.score_rows(0, nrows)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            # several chunks per thread, so rows of different cost are
+            # balanced between the threads
+            chunksize = max(1, nrows // (workers * 4))
+            with ThreadPoolExecutor(workers) as executor:
+                for _ in executor.map(lambda start: matrix.score_rows(start, min(start + chunksize, nrows)),
+                                      range(0, nrows, chunksize)):
+                    pass
+    finally:
+        matrix.out = NULL
+        PyBuffer_Release(&view)
+    return result
+
+
+_diff_kinds = ('unified', 'opcodes', 'ratio')
+
+def _diff_pair(kind, pair, kwds):
+    if kind == 'ratio':
+        return SequenceMatcher(None, pair[0], pair[1], **kwds).ratio()
+    if kind == 'opcodes':
+        return SequenceMatcher(None, pair[0], pair[1], **kwds).get_opcodes()
+    a, b = pair[0], pair[1]
+    if isinstance(a, (str, bytes)):
+        a = _split_newlines(a)
+    if isinstance(b, (str, bytes)):
+        b = _split_newlines(b)
+    if len(pair) > 2:
+        kwds = dict(kwds, fromfile=pair[2], tofile=pair[3])
+    lines = unified_diff(a, b, **kwds)
+    first = next(lines, None)
+    if first is not None:
+        return first + first[:0].join(lines)
+    # the empty diff has the type of the lines, like in _check_types()
+    first = [seq[0] for seq in (a, b) if seq]
+    if first:
+        use_bytes = isinstance(first[0], (bytes, bytearray))
+    else:
+        use_bytes = any(isinstance(arg, (bytes, bytearray)) for arg in pair)
+    return b'' if use_bytes else ''
+
+def _diff_chunk(kind, indices, pairs, kwds):
+    # runs in the worker processes of diff_many()
+    return indices, [_diff_pair(kind, pair, kwds) for pair in pairs]
+
+def _pair_cost(pair):
+    cdef Py_ssize_t la = len(pair[0])
+    cdef Py_ssize_t lb = len(pair[1])
+    return la * lb + la + lb
+
+def _iter_diff_many(kind, list pairs, workers, chunksize, dict kwds):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    cdef Py_ssize_t start, npairs = len(pairs)
+
+    if workers <= 1 or npairs <= chunksize:
+        for start in range(npairs):
+            yield start, _diff_pair(kind, pairs[start], kwds)
+        return
+
+    # the most expensive pairs are submitted first and the cheap ones fill
+    # the gaps at the end, so the workers finish at about the same time
+    order = sorted(range(npairs), key=lambda i: _pair_cost(pairs[i]), reverse=True)
+    executor = ProcessPoolExecutor(min(workers, (npairs + chunksize - 1) // chunksize))
+    try:
+        futures = []
+        for start in range(0, npairs, chunksize):
+            indices = order[start:start + chunksize]
+            futures.append(executor.submit(_diff_chunk, kind, indices, [pairs[i] for i in indices], kwds))
+        for future in as_completed(futures):
+            indices, results = future.result()
+            yield from zip(indices, results)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def diff_many(pairs, kind='unified', *, workers=-1, chunksize=None, as_completed=False, **kwds):
+    """Compare many pairs of sequences in a pool of worker processes.
+
+    pairs is an iterable of (a, b) tuples.  kind selects the result for
+    every pair:
+
+    - 'unified' (the default): the unified_diff() of a and b as one str,
+      or bytes for bytes lines, which is empty if a and b are equal.  a and
+      b are sequences of lines or whole str or bytes documents, which are
+      split after every newline by the workers, so they are cheaper to pass
+      to them.
+      The pairs may also be (a, b, fromfile, tofile) tuples.
+    - 'opcodes': SequenceMatcher(None, a, b).get_opcodes()
+    - 'ratio': SequenceMatcher(None, a, b).ratio()
+
+    Additional keyword arguments are passed to unified_diff() or
+    SequenceMatcher, e.g. n or algorithm, and have to be picklable.
+
+    Optional arg workers is the number of worker processes.  -1 (the
+    default) uses one process per CPU and 1 compares the pairs in the
+    calling process.
+
+    The pairs are distributed to the workers in chunks of chunksize pairs,
+    most expensive first according to the product of their lengths.  By
+    default there are about four chunks per worker.
+
+    Returns the list of results in the order of pairs.  If as_completed is
+    true, an iterator of (index, result) tuples is returned instead, which
+    yields the results as soon as their chunk is done.
+
+    >>> diff_many([("abcd", "bcde"), ("ab", "ab")], 'ratio', workers=1)
+    [0.75, 1.0]
+    >>> pairs = [("one\\ntwo\\n", "one\\n2\\n", "old", "new")]
+    >>> print(diff_many(pairs, n=0, workers=1)[0], end="")
+    --- old
+    +++ new
+    @@ -2 +2 @@
+    -two
+    +2
+    """
+    if kind not in _diff_kinds:
+        raise ValueError("kind must be one of 'unified', 'opcodes', 'ratio': %r" % (kind,))
+    if workers == -1:
+        workers = _cpu_count() or 1
+    if not workers > 0:
+        raise ValueError("workers must be > 0 or -1: %r" % (workers,))
+    if chunksize is not None and not chunksize > 0:
+        raise ValueError("chunksize must be None or > 0: %r" % (chunksize,))
+
+    pairs = list(pairs)
+    if chunksize is None:
+        chunksize = max(1, len(pairs) // (workers * 4))
+    results = _iter_diff_many(kind, pairs, workers, chunksize, kwds)
+    if as_completed:
+        return results
+    ordered = [None] * len(pairs)
+    for index, result in results:
+        ordered[index] = result
+    return ordered
+
+
+_CacheInfo = _namedtuple('CacheInfo', 'hits misses maxsize currsize', module=__name__)
+
+@cython.final
+cdef class _LRUCache:
+    """Least recently used cache of intraline comparisons.
+
+    The keys are tuples of line contents and charjunk, so equal lines share
+    their entries no matter where they appear.  maxsize 0 disables it.
+    """
+
+    cdef object entries
+    cdef Py_ssize_t maxsize
+    cdef Py_ssize_t hits
+    cdef Py_ssize_t misses
+
+    def __cinit__(self):
+        self.entries = _OrderedDict()
+
+    cdef object get(self, key):
+        """cached value of key or None"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    cdef int put(self, key, value) except -1:
+        self.entries[key] = value
+        return self.resize(self.maxsize)
+
+    cdef int resize(self, Py_ssize_t maxsize) except -1:
+        self.maxsize = maxsize
+        while len(self.entries) > maxsize:
+            self.entries.popitem(last=False)
+        return 0
+
+# shared by Differ, ndiff, side_by_side and HtmlDiff
+cdef _LRUCache _intraline_cache = _LRUCache()
+
+def set_intraline_cache_size(maxsize):
+    """Enable the cache of intraline comparisons or change its size.
+
+    Differ, ndiff(), side_by_side() and HtmlDiff compare the characters of
+    similar lines of replaced blocks.  The cache keeps the character index
+    of up to maxsize lines, the most similar pair of lines of replaced
+    blocks and the opcodes of the lines marked up, so comparing the same
+    lines again, e.g. rendering one pair of texts with both ndiff() and
+    HtmlDiff, reuses the earlier work.  Entries are keyed by the contents
+    of the lines and charjunk and the least recently used entries are
+    dropped first.  maxsize 0 (the default) disables the cache.
+
+    >>> set_intraline_cache_size(1024)
+    >>> intraline_cache_clear()
+    >>> d = list(ndiff(["abcDefghiJkl\\n"], ["abcdefGhijkl\\n"]))
+    >>> d = list(ndiff(["abcDefghiJkl\\n"], ["abcdefGhijkl\\n"]))
+    >>> intraline_cache_info()
+    CacheInfo(hits=3, misses=3, maxsize=1024, currsize=3)
+    >>> set_intraline_cache_size(0)
+    """
+    if not maxsize >= 0:
+        raise ValueError("maxsize must be >= 0: %r" % (maxsize,))
+    _intraline_cache.resize(maxsize)
+
+def intraline_cache_info():
+    """Return the hits, misses, maxsize and currsize of the intraline cache"""
+    return _CacheInfo(_intraline_cache.hits, _intraline_cache.misses, _intraline_cache.maxsize,
+                      len(_intraline_cache.entries))
+
+def intraline_cache_clear():
+    """Remove all entries of the intraline cache and reset its statistics"""
+    _intraline_cache.entries.clear()
+    _intraline_cache.hits = _intraline_cache.misses = 0
+
+cdef PreparedSequence _prepared_line(line, charjunk):
+    """character index of line, which is cached if enabled"""
+    cdef PreparedSequence bindex
+    if _intraline_cache.maxsize == 0:
+        return PreparedSequence(line, charjunk, True)
+    key = ('index', line, charjunk)
+    bindex = _intraline_cache.get(key)
+    if bindex is None:
+        bindex = PreparedSequence(line, charjunk, True)
+        _intraline_cache.put(key, bindex)
+    return bindex
+
+cdef Opcodes _intraline_opcodes(aline, bline, charjunk):
+    """opcodes of the characters of a synched pair of lines"""
+    cdef Opcodes opcodes
+    if _intraline_cache.maxsize == 0:
+        return SequenceMatcher(charjunk, aline, bline).get_opcodes()
+    key = ('opcodes', aline, bline, charjunk)
+    opcodes = _intraline_cache.get(key)
+    if opcodes is None:
+        opcodes = SequenceMatcher(charjunk, aline, _prepared_line(bline, charjunk)).get_opcodes()
+        _intraline_cache.put(key, opcodes)
+    return opcodes
+
+
+@cython.final
+cdef class _LineBlock:
+    """Lines of a replaced block mapped to the codes of their characters.
+
+    All characters of both blocks of a _fancy_replace call share one code
+    space.  The lines of b are also indexed like the second sequence of
+    SequenceMatcher(charjunk), and translate maps the shared codes to the
+    codes of these indexes.
+    """
+
+    cdef vector[Py_ssize_t] offsets
+    cdef vector[Py_ssize_t] codes
+    # multiset of every line as (code, count) pairs sorted by code
+    cdef vector[Py_ssize_t] count_offsets
+    cdef vector[Py_ssize_t] count_keys
+    cdef vector[Py_ssize_t] count_values
+    cdef list indexes
+    cdef vector[BIndexView] views
+    cdef vector[Py_ssize_t] translate_offsets
+    cdef vector[pair[Py_ssize_t, Py_ssize_t]] translate
+
+    cdef int add_lines(self, lines, Py_ssize_t lo, Py_ssize_t hi, dict keys) except -1:
+        cdef Py_ssize_t start, end
+        cdef vector[Py_ssize_t] buffer
+        self.offsets.push_back(0)
+        self.count_offsets.push_back(0)
+        for line in lines[lo:hi]:
+            for elt in <str>line:
+                self.codes.push_back(keys.setdefault(elt, len(keys)))
+            start = self.offsets.back()
+            end = self.codes.size()
+            self.offsets.push_back(end)
+            _count_codes(self.codes.data() + start, end - start, buffer, self.count_keys, self.count_values)
+            self.count_offsets.push_back(self.count_keys.size())
+        return 0
+
+    cdef int add_indexes(self, lines, Py_ssize_t lo, Py_ssize_t hi, charjunk, dict keys) except -1:
+        cdef PreparedSequence bindex
+        self.indexes = []
+        self.translate_offsets.push_back(0)
+        for line in lines[lo:hi]:
+            bindex = _prepared_line(line, charjunk)
+            self.indexes.append(bindex)
+            self.views.push_back(bindex.view)
+            for code, elt in enumerate(bindex._elements()):
+                self.translate.push_back(pair[Py_ssize_t, Py_ssize_t](keys[elt], code))
+            self.translate_offsets.push_back(self.translate.size())
+        return 0
+
+
+cdef inline int _popcount(uint64_t x) noexcept nogil:
+    x = x - ((x >> 1) & 0x5555555555555555ULL)
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL)
+    x = (x + (x >> 4)) & 0x0F0F0F0F0F0F0F0FULL
+    return <int>((x * 0x0101010101010101ULL) >> 56)
+
+cdef int _build_pattern_masks(const BIndexView* bidx, vector[uint64_t]& masks) except -1 nogil:
+    """bit j of the masks of code c is set iff b[j] == c"""
+    cdef Py_ssize_t words = (bidx.lb + 63) // 64
+    cdef Py_ssize_t j
+    masks.assign(<size_t>(bidx.nkeys * words), 0)
+    for j in range(bidx.lb):
+        masks[bidx.b[j] * words + j // 64] |= (<uint64_t>1) << (j % 64)
+    return 0
+
+cdef Py_ssize_t _lcs_length(const uint64_t* masks, Py_ssize_t lb, const Py_ssize_t* a, Py_ssize_t la,
+                            vector[uint64_t]& v) except -1 nogil:
+    """Length of the longest common subsequence of a and b.
+
+    This uses the bit-parallel algorithm of Hyyro with the masks created by
+    _build_pattern_masks.  The matching blocks of SequenceMatcher form a
+    common subsequence, so this is an upper bound of their size.
+    """
+    cdef Py_ssize_t words = (lb + 63) // 64
+    cdef Py_ssize_t i, w, zeros = 0
+    cdef const uint64_t* m
+    cdef uint64_t u, t, x, carry
+    v.assign(<size_t>words, ~(<uint64_t>0))
+    for i in range(la):
+        if a[i] < 0:
+            continue
+        m = masks + a[i] * words
+        carry = 0
+        for w in range(words):
+            u = v[w] & m[w]
+            t = v[w] + carry
+            carry = t < carry
+            x = t + u
+            carry |= x < t
+            v[w] = x | (v[w] & ~m[w])
+    for w in range(words):
+        zeros += 64 - _popcount(v[w])
+    # the bits above lb are always set
+    return zeros
+
+cdef int _search_similar_pair(_LineBlock a, _LineBlock b, Py_ssize_t nkeys, double* best_ratio,
+                              Py_ssize_t* best_i, Py_ssize_t* best_j,
+                              Py_ssize_t* eqi, Py_ssize_t* eqj) except -1 nogil:
+    cdef vector[Py_ssize_t] local, coded, buffer
+    cdef vector[uint64_t] masks, lcs_buffer
+    cdef MatchScratch scratch
+    cdef const BIndexView* bidx
+    cdef Py_ssize_t na = a.offsets.size() - 1, nb = b.offsets.size() - 1
+    cdef Py_ssize_t i, j, k, la, lb, matches
+    cdef const Py_ssize_t* acodes
+    cdef const Py_ssize_t* bcodes
+    cdef double score
+
+    local.assign(<size_t>nkeys, -1)
+    for j in range(nb):
+        bidx = &b.views[j]
+        lb = bidx.lb
+        bcodes = b.codes.data() + b.offsets[j]
+        for k in range(b.translate_offsets[j], b.translate_offsets[j + 1]):
+            local[b.translate[k].first] = b.translate[k].second
+        _init_scratch(&scratch, buffer, lb)
+        _build_pattern_masks(bidx, masks)
+
+        for i in range(na):
+            la = a.offsets[i + 1] - a.offsets[i]
+            acodes = a.codes.data() + a.offsets[i]
+            if la == lb:
+                k = 0
+                while k < la and acodes[k] == bcodes[k]:
+                    k += 1
+                if k == la:
+                    if eqi[0] == -1:
+                        eqi[0], eqj[0] = i, j
+                    continue
+
+            # computing similarity is expensive, so use the quick upper
+            # bounds first
+            if not _calculate_ratio(min(la, lb), la + lb) > best_ratio[0]:
+                continue
+            matches = _count_common(
+                a.count_keys.data() + a.count_offsets[i], a.count_values.data() + a.count_offsets[i],
+                a.count_offsets[i + 1] - a.count_offsets[i],
+                b.count_keys.data() + b.count_offsets[j], b.count_values.data() + b.count_offsets[j],
+                b.count_offsets[j + 1] - b.count_offsets[j])
+            if not _calculate_ratio(matches, la + lb) > best_ratio[0]:
+                continue
+
+            coded.resize(<size_t>la)
+            for k in range(la):
+                coded[k] = local[acodes[k]]
+            matches = _lcs_length(masks.data(), lb, coded.data(), la, lcs_buffer)
+            if not _calculate_ratio(matches, la + lb) > best_ratio[0]:
+                continue
+            matches = _count_matches(bidx, coded.data(), la, &scratch, best_ratio[0])
+            score = _calculate_ratio(matches, la + lb)
+            if score > best_ratio[0]:
+                best_ratio[0], best_i[0], best_j[0] = score, i, j
+
+        for k in range(b.translate_offsets[j], b.translate_offsets[j + 1]):
+            local[b.translate[k].first] = -1
+    return 0
+
+
+cdef tuple _find_similar_pair(a, Py_ssize_t alo, Py_ssize_t ahi, b, Py_ssize_t blo, Py_ssize_t bhi, charjunk):
+    """Native version of the search for the best matching pair of lines in
+    Differ._fancy_replace.
+
+    Returns (best_ratio, best_i, best_j, eqi, eqj), or None when not all
+    lines are str, since the search relies on lines being equal iff their
+    characters are.
+    """
+    cdef _LineBlock ablock, bblock
+    cdef dict keys = {}
+    cdef double best_ratio = 0.74
+    cdef Py_ssize_t best_i = -1, best_j = -1, eqi = -1, eqj = -1
+    cdef Py_ssize_t nkeys
+
+    for lines, lo, hi in ((a, alo, ahi), (b, blo, bhi)):
+        for i in range(lo, hi):
+            if type(lines[i]) is not str:
+                return None
+
+    ablock = _LineBlock()
+    ablock.add_lines(a, alo, ahi, keys)
+    bblock = _LineBlock()
+    bblock.add_lines(b, blo, bhi, keys)
+    bblock.add_indexes(b, blo, bhi, charjunk, keys)
+    nkeys = len(keys)
+    with nogil:
+        _search_similar_pair(ablock, bblock, nkeys, &best_ratio, &best_i, &best_j, &eqi, &eqj)
+
+    return (best_ratio,
+            alo + best_i if best_i != -1 else None,
+            blo + best_j if best_j != -1 else None,
+            alo + eqi if eqi != -1 else None,
+            blo + eqj if eqj != -1 else None)
+
+
+def _keep_original_ws(s, tag_s):
+    """Replace whitespace with the original whitespace characters in `s`"""
+    return ''.join(
+        c if tag_c == " " and c.isspace() else tag_c
+        for c, tag_c in zip(s, tag_s)
+    )
+
+
+
+class Differ:
+    r"""
+    Differ is a class for comparing sequences of lines of text, and
+    producing human-readable differences or deltas.  Differ uses
+    SequenceMatcher both to compare sequences of lines, and to compare
+    sequences of characters within similar (near-matching) lines.
+
+    Each line of a Differ delta begins with a two-letter code:
+
+        '- '    line unique to sequence 1
+        '+ '    line unique to sequence 2
+        '  '    line common to both sequences
+        '? '    line not present in either input sequence
+
+    Lines beginning with '? ' attempt to guide the eye to intraline
+    differences, and were not present in either input sequence.  These lines
+    can be confusing if the sequences contain tab characters.
+
+    Note that Differ makes no claim to produce a *minimal* diff.  To the
+    contrary, minimal diffs are often counter-intuitive, because they synch
+    up anywhere possible, sometimes accidental matches 100 pages apart.
+    Restricting synch points to contiguous matches preserves some notion of
+    locality, at the occasional cost of producing a longer diff.
+
+    Example: Comparing two texts.
+
+    First we set up the texts, sequences of individual single-line strings
+    ending with newlines (such sequences can also be obtained from the
+    `readlines()` method of file-like objects):
+
+    >>> text1 = '''  1. Beautiful is better than ugly.
+    ...   2. Explicit is better than implicit.
+    ...   3. Simple is better than complex.
+    ...   4. Complex is better than complicated.
+    ... '''.splitlines(keepends=True)
+    >>> len(text1)
+    4
+    >>> text1[0][-1]
+    '\n'
     >>> text2 = '''  1. Beautiful is better than ugly.
     ...   3.   Simple is better than complex.
     ...   4. Complicated is better than complex.
@@ -852,7 +4045,8 @@ class Differ:
     +   5. Flat is better than nested.
     """
 
-    def __init__(self, linejunk=None, charjunk=None):
+    def __init__(self, linejunk=None, charjunk=None, *, algorithm='gestalt',
+                 max_cost=None, timeout=None):
         """
         Construct a text differencer, with optional filters.
 
@@ -870,10 +4064,24 @@ class Differ:
           module-level function `IS_CHARACTER_JUNK` may be used to filter out
           whitespace characters (a blank or tab; **note**: bad idea to include
           newline in this!).  Use of IS_CHARACTER_JUNK is recommended.
+
+        - `algorithm`: The algorithm used to compare the sequences of lines
+          (see SequenceMatcher.__init__).  Similar lines are always compared
+          character by character with the default 'gestalt' algorithm.
+
+        - `max_cost`, `timeout`: The work budget of the comparison of the
+          sequences of lines (see SequenceMatcher.__init__).
         """
 
+        cdef Py_ssize_t c_max_cost
+        cdef double c_timeout
+        _get_algorithm(algorithm)
+        _get_budget(max_cost, timeout, &c_max_cost, &c_timeout)
         self.linejunk = linejunk
         self.charjunk = charjunk
+        self.algorithm = algorithm
+        self.max_cost = max_cost
+        self.timeout = timeout
 
     def compare(self, a, b):
         r"""
@@ -901,7 +4109,8 @@ class Differ:
         + emu
         """
 
-        cruncher = SequenceMatcher(self.linejunk, a, b)
+        cruncher = SequenceMatcher(self.linejunk, a, b, algorithm=self.algorithm,
+                                   max_cost=self.max_cost, timeout=self.timeout)
         for tag, alo, ahi, blo, bhi in cruncher.get_opcodes():
             if tag == 'replace':
                 g = self._fancy_replace(a, alo, ahi, b, blo, bhi)
@@ -954,48 +4163,14 @@ class Differ:
         ?    ^  ^  ^
         """
 
-        # don't synch up unless the lines have a similarity score of at
-        # least cutoff; best_ratio tracks the best score seen so far
-        best_ratio, cutoff = 0.74, 0.75
-        cruncher = SequenceMatcher(self.charjunk)
-        eqi, eqj = None, None   # 1st indices of equal lines (if any)
-
-        # search for the pair that matches best without being identical
-        # (identical lines must be junk lines, & we don't want to synch up
-        # on junk -- unless we have to)
-        for j in range(blo, bhi):
-            bj = b[j]
-            cruncher.set_seq2(bj)
-            for i in range(alo, ahi):
-                ai = a[i]
-                if ai == bj:
-                    if eqi is None:
-                        eqi, eqj = i, j
-                    continue
-                cruncher.set_seq1(ai)
-                # computing similarity is expensive, so use the quick
-                # upper bounds first -- have seen this speed up messy
-                # compares by a factor of 3.
-                # note that ratio() is only expensive to compute the first
-                # time it's called on a sequence pair; the expensive part
-                # of the computation is cached by cruncher
-                if cruncher.real_quick_ratio() > best_ratio and \
-                      cruncher.quick_ratio() > best_ratio and \
-                      cruncher.ratio() > best_ratio:
-                    best_ratio, best_i, best_j = cruncher.ratio(), i, j
-        if best_ratio < cutoff:
-            # no non-identical "pretty close" pair
-            if eqi is None:
-                # no identical pair either -- treat it as a straight replace
-                yield from self._plain_replace(a, alo, ahi, b, blo, bhi)
-                return
-            # no close pair, but an identical pair -- synch up on that
-            best_i, best_j, best_ratio = eqi, eqj, 1.0
-        else:
-            # there's a close pair, so forget the identical pair (if any)
-            eqi = None
+        synch = _find_synch_pair(a, alo, ahi, b, blo, bhi, self.charjunk)
+        if synch is None:
+            # no similar or identical pair -- treat it as a straight replace
+            yield from self._plain_replace(a, alo, ahi, b, blo, bhi)
+            return
+        best_i, best_j, identical = synch
 
-        # a[best_i] very similar to b[best_j]; eqi is None iff they're not
+        # a[best_i] very similar to b[best_j]; identical is True iff they're
         # identical
 
         # pump out diffs from before the synch point
@@ -1003,11 +4178,10 @@ class Differ:
 
         # do intraline marking on the synch pair
         aelt, belt = a[best_i], b[best_j]
-        if eqi is None:
+        if not identical:
             # pump out a '-', '?', '+', '?' quad for the synched lines
             atags = btags = ""
-            cruncher.set_seqs(aelt, belt)
-            for tag, ai1, ai2, bj1, bj2 in cruncher.get_opcodes():
+            for tag, ai1, ai2, bj1, bj2 in _intraline_opcodes(aelt, belt, self.charjunk):
                 la, lb = ai2 - ai1, bj2 - bj1
                 if tag == 'replace':
                     atags += '^' * la
@@ -1138,7 +4312,8 @@ def _format_range_unified(start, stop):
     return '{},{}'.format(beginning, length)
 
 def unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
-                 tofiledate='', n=3, lineterm='\n'):
+                 tofiledate='', n=3, lineterm='\n', *, algorithm='gestalt',
+                 max_cost=None, timeout=None):
     r"""
     Compare two sequences of lines; generate the delta as a unified diff.
 
@@ -1160,6 +4335,16 @@ def unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
     'fromfile', 'tofile', 'fromfiledate', and 'tofiledate'.
     The modification times are normally expressed in the ISO 8601 format.
 
+    The lines may be bytes instead of str, which are compared and output
+    without decoding them.  The other string arguments have to be bytes
+    as well in this case, but str arguments are accepted if they only
+    contain ASCII characters (like the defaults).
+
+    The keyword argument 'algorithm' selects the SequenceMatcher algorithm
+    used to compare the lines ('gestalt', 'myers' or 'histogram').  The
+    keyword arguments 'max_cost' and 'timeout' bound the work spent on the
+    comparison (see SequenceMatcher.__init__).
+
     Example:
 
     >>> for line in unified_diff('one two three four'.split(),
@@ -1178,32 +4363,53 @@ def unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
      four
     """
 
-    _check_types(a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm)
+    fromfile, tofile, fromfiledate, tofiledate, lineterm = _check_types(
+        a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm)
+    a, b = _hashable_lines(a), _hashable_lines(b)
+    groups = SequenceMatcher(None,a,b,algorithm=algorithm,max_cost=max_cost,
+                             timeout=timeout).get_grouped_opcodes(n)
+    yield from _unified_diff_lines(a, b, groups, fromfile, tofile, fromfiledate,
+                                   tofiledate, lineterm)
+
+def _unified_diff_lines(a, b, groups, fromfile, tofile, fromfiledate, tofiledate,
+                        lineterm):
+    """Generate the lines of a unified diff from the grouped opcodes.
+
+    The lines and the other arguments are either all str or all bytes.
+    """
+    if isinstance(lineterm, str):
+        fromline, toline, hunk = '--- %s%s%s', '+++ %s%s%s', '@@ -%s +%s @@%s'
+        tab, space, minus, plus = '\t', ' ', '-', '+'
+    else:
+        fromline, toline, hunk = b'--- %s%s%s', b'+++ %s%s%s', b'@@ -%s +%s @@%s'
+        tab, space, minus, plus = b'\t', b' ', b'-', b'+'
     started = False
-    for group in SequenceMatcher(None,a,b).get_grouped_opcodes(n):
+    for group in groups:
         if not started:
             started = True
-            fromdate = '\t{}'.format(fromfiledate) if fromfiledate else ''
-            todate = '\t{}'.format(tofiledate) if tofiledate else ''
-            yield '--- {}{}{}'.format(fromfile, fromdate, lineterm)
-            yield '+++ {}{}{}'.format(tofile, todate, lineterm)
+            fromdate = tab + fromfiledate if fromfiledate else fromfiledate[:0]
+            todate = tab + tofiledate if tofiledate else tofiledate[:0]
+            yield fromline % (fromfile, fromdate, lineterm)
+            yield toline % (tofile, todate, lineterm)
 
         first, last = group[0], group[-1]
         file1_range = _format_range_unified(first[1], last[2])
         file2_range = _format_range_unified(first[3], last[4])
-        yield '@@ -{} +{} @@{}'.format(file1_range, file2_range, lineterm)
+        if type(hunk) is bytes:
+            file1_range, file2_range = file1_range.encode(), file2_range.encode()
+        yield hunk % (file1_range, file2_range, lineterm)
 
         for tag, i1, i2, j1, j2 in group:
             if tag == 'equal':
                 for line in a[i1:i2]:
-                    yield ' ' + line
+                    yield space + line
                 continue
             if tag in {'replace', 'delete'}:
                 for line in a[i1:i2]:
-                    yield '-' + line
+                    yield minus + line
             if tag in {'replace', 'insert'}:
                 for line in b[j1:j2]:
-                    yield '+' + line
+                    yield plus + line
 
 
 ########################################################################
@@ -1223,7 +4429,8 @@ def _format_range_context(start, stop):
 
 # See http://www.unix.org/single_unix_specification/
 def context_diff(a, b, fromfile='', tofile='',
-                 fromfiledate='', tofiledate='', n=3, lineterm='\n'):
+                 fromfiledate='', tofiledate='', n=3, lineterm='\n', *, algorithm='gestalt',
+                 max_cost=None, timeout=None):
     r"""
     Compare two sequences of lines; generate the delta as a context diff.
 
@@ -1246,6 +4453,13 @@ def context_diff(a, b, fromfile='', tofile='',
     The modification times are normally expressed in the ISO 8601 format.
     If not specified, the strings default to blanks.
 
+    The lines may be bytes instead of str like for unified_diff().
+
+    The keyword argument 'algorithm' selects the SequenceMatcher algorithm
+    used to compare the lines ('gestalt', 'myers' or 'histogram').  The
+    keyword arguments 'max_cost' and 'timeout' bound the work spent on the
+    comparison (see SequenceMatcher.__init__).
+
     Example:
 
     >>> print(''.join(context_diff('one\ntwo\nthree\nfour\n'.splitlines(True),
@@ -1266,22 +4480,45 @@ def context_diff(a, b, fromfile='', tofile='',
       four
     """
 
-    _check_types(a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm)
-    prefix = dict(insert='+ ', delete='- ', replace='! ', equal='  ')
+    fromfile, tofile, fromfiledate, tofiledate, lineterm = _check_types(
+        a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm)
+    a, b = _hashable_lines(a), _hashable_lines(b)
+    groups = SequenceMatcher(None,a,b,algorithm=algorithm,max_cost=max_cost,
+                             timeout=timeout).get_grouped_opcodes(n)
+    yield from _context_diff_lines(a, b, groups, fromfile, tofile, fromfiledate,
+                                   tofiledate, lineterm)
+
+def _context_diff_lines(a, b, groups, fromfile, tofile, fromfiledate, tofiledate,
+                        lineterm):
+    """Generate the lines of a context diff from the grouped opcodes.
+
+    The lines and the other arguments are either all str or all bytes.
+    """
+    if isinstance(lineterm, str):
+        prefix = dict(insert='+ ', delete='- ', replace='! ', equal='  ')
+        fromline, toline, separator = '*** %s%s%s', '--- %s%s%s', '***************'
+        fromhunk, tohunk, tab = '*** %s ****%s', '--- %s ----%s', '\t'
+    else:
+        prefix = dict(insert=b'+ ', delete=b'- ', replace=b'! ', equal=b'  ')
+        fromline, toline, separator = b'*** %s%s%s', b'--- %s%s%s', b'***************'
+        fromhunk, tohunk, tab = b'*** %s ****%s', b'--- %s ----%s', b'\t'
     started = False
-    for group in SequenceMatcher(None,a,b).get_grouped_opcodes(n):
+    for group in groups:
         if not started:
             started = True
-            fromdate = '\t{}'.format(fromfiledate) if fromfiledate else ''
-            todate = '\t{}'.format(tofiledate) if tofiledate else ''
-            yield '*** {}{}{}'.format(fromfile, fromdate, lineterm)
-            yield '--- {}{}{}'.format(tofile, todate, lineterm)
+            fromdate = tab + fromfiledate if fromfiledate else fromfiledate[:0]
+            todate = tab + tofiledate if tofiledate else tofiledate[:0]
+            yield fromline % (fromfile, fromdate, lineterm)
+            yield toline % (tofile, todate, lineterm)
 
         first, last = group[0], group[-1]
-        yield '***************' + lineterm
+        yield separator + lineterm
 
         file1_range = _format_range_context(first[1], last[2])
-        yield '*** {} ****{}'.format(file1_range, lineterm)
+        file2_range = _format_range_context(first[3], last[4])
+        if type(tab) is bytes:
+            file1_range, file2_range = file1_range.encode(), file2_range.encode()
+        yield fromhunk % (file1_range, lineterm)
 
         if any(tag in {'replace', 'delete'} for tag, _, _, _, _ in group):
             for tag, i1, i2, _, _ in group:
@@ -1289,8 +4526,7 @@ def context_diff(a, b, fromfile='', tofile='',
                     for line in a[i1:i2]:
                         yield prefix[tag] + line
 
-        file2_range = _format_range_context(first[3], last[4])
-        yield '--- {} ----{}'.format(file2_range, lineterm)
+        yield tohunk % (file2_range, lineterm)
 
         if any(tag in {'replace', 'insert'} for tag, _, _, _, _ in group):
             for tag, _, _, j1, j2 in group:
@@ -1298,13 +4534,301 @@ def context_diff(a, b, fromfile='', tofile='',
                     for line in b[j1:j2]:
                         yield prefix[tag] + line
 
+########################################################################
+###  Formatted Diffs
+########################################################################
+
+cdef extern from "Python.h":
+    Py_UCS4 PyUnicode_MAX_CHAR_VALUE(object text)
+
+ctypedef struct _Piece:
+    # ASCII text written in front of text
+    const char* prefix
+    Py_ssize_t prefix_len
+    # borrowed, the owner is kept alive by _DiffBuffer.owners
+    PyObject* text
+
+@cython.final
+cdef class _DiffBuffer:
+    """Lines of a diff, which are joined with their prefixes into one str
+    or bytes object without creating an object per line.
+    """
+    cdef vector[_Piece] pieces
+    cdef list owners
+    cdef bint use_bytes
+
+    def __cinit__(self, bint use_bytes):
+        self.use_bytes = use_bytes
+        self.owners = []
+
+    cdef int add(self, text) except -1:
+        cdef _Piece piece
+        piece.prefix = b""
+        piece.prefix_len = 0
+        piece.text = <PyObject*>text
+        self.owners.append(text)
+        self.pieces.push_back(piece)
+        return 0
+
+    cdef int add_lines(self, const char* prefix, list lines, Py_ssize_t lo,
+                       Py_ssize_t hi) except -1:
+        cdef _Piece piece
+        cdef Py_ssize_t i
+        piece.prefix = prefix
+        piece.prefix_len = len(prefix)
+        if lo < hi:
+            self.owners.append(lines)
+        for i in range(lo, hi):
+            piece.text = PyList_GET_ITEM(lines, i)
+            self.pieces.push_back(piece)
+        return 0
+
+    cdef object getvalue(self):
+        """Join the lines added since the last call"""
+        cdef Py_ssize_t size = 0, pos = 0, length, i
+        cdef Py_UCS4 maxchar = 127
+        cdef _Piece piece
+        cdef object result
+        cdef char* out
+        cdef void* data
+        cdef int kind
+
+        for piece in self.pieces:
+            text = <object>piece.text
+            if self.use_bytes:
+                if not isinstance(text, (bytes, bytearray)):
+                    raise TypeError('lines to compare must be bytes, not %s (%r)' %
+                                    (type(text).__name__, text))
+                size += len(text)
+            else:
+                if not isinstance(text, str):
+                    raise TypeError('lines to compare must be str, not %s (%r)' %
+                                    (type(text).__name__, text))
+                size += PyUnicode_GET_LENGTH(text)
+                maxchar = max(maxchar, PyUnicode_MAX_CHAR_VALUE(text))
+            size += piece.prefix_len
+
+        if self.use_bytes:
+            result = PyBytes_FromStringAndSize(NULL, size)
+            out = PyBytes_AS_STRING(result)
+            for piece in self.pieces:
+                memcpy(out + pos, piece.prefix, piece.prefix_len)
+                pos += piece.prefix_len
+                text = <object>piece.text
+                if isinstance(text, bytes):
+                    length = PyBytes_GET_SIZE(text)
+                    memcpy(out + pos, PyBytes_AS_STRING(text), length)
+                else:
+                    length = PyByteArray_GET_SIZE(text)
+                    memcpy(out + pos, PyByteArray_AS_STRING(text), length)
+                pos += length
+        else:
+            result = PyUnicode_New(size, maxchar)
+            kind = PyUnicode_KIND(result)
+            data = PyUnicode_DATA(result)
+            for piece in self.pieces:
+                for i in range(piece.prefix_len):
+                    PyUnicode_WRITE(kind, data, pos + i, piece.prefix[i])
+                pos += piece.prefix_len
+                length = PyUnicode_GET_LENGTH(<object>piece.text)
+                PyUnicode_CopyCharacters(result, pos, <object>piece.text, 0, length)
+                pos += length
+
+        self.pieces.clear()
+        self.owners = []
+        return result
+
+cdef object _flush_hunk(_DiffBuffer buffer, file):
+    if file is not None:
+        file.write(buffer.getvalue())
+
+def _format_unified(list a, list b, groups, fromfile, tofile, fromfiledate, tofiledate,
+                    lineterm, file):
+    """Same as _unified_diff_lines(), but the lines are joined by a _DiffBuffer
+    and written to file per hunk or returned as a whole
+    """
+    cdef _DiffBuffer buffer = _DiffBuffer(not isinstance(lineterm, str))
+    cdef Py_ssize_t i1, i2, j1, j2
+    if isinstance(lineterm, str):
+        fromline, toline, hunk, tab = '--- %s%s%s', '+++ %s%s%s', '@@ -%s +%s @@%s', '\t'
+    else:
+        fromline, toline, hunk, tab = b'--- %s%s%s', b'+++ %s%s%s', b'@@ -%s +%s @@%s', b'\t'
+    started = False
+    for group in groups:
+        if not started:
+            started = True
+            fromdate = tab + fromfiledate if fromfiledate else fromfiledate[:0]
+            todate = tab + tofiledate if tofiledate else tofiledate[:0]
+            buffer.add(fromline % (fromfile, fromdate, lineterm))
+            buffer.add(toline % (tofile, todate, lineterm))
+
+        first, last = group[0], group[-1]
+        file1_range = _format_range_unified(first[1], last[2])
+        file2_range = _format_range_unified(first[3], last[4])
+        if type(hunk) is bytes:
+            file1_range, file2_range = file1_range.encode(), file2_range.encode()
+        buffer.add(hunk % (file1_range, file2_range, lineterm))
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                buffer.add_lines(b' ', a, i1, i2)
+                continue
+            if tag == 'replace' or tag == 'delete':
+                buffer.add_lines(b'-', a, i1, i2)
+            if tag == 'replace' or tag == 'insert':
+                buffer.add_lines(b'+', b, j1, j2)
+        _flush_hunk(buffer, file)
+
+    if file is None:
+        return buffer.getvalue()
+
+def _format_context(list a, list b, groups, fromfile, tofile, fromfiledate, tofiledate,
+                    lineterm, file):
+    """Same as _context_diff_lines(), but the lines are joined by a _DiffBuffer
+    and written to file per hunk or returned as a whole
+    """
+    cdef _DiffBuffer buffer = _DiffBuffer(not isinstance(lineterm, str))
+    cdef Py_ssize_t i1, i2, j1, j2
+    prefix = dict(insert=b'+ ', delete=b'- ', replace=b'! ', equal=b'  ')
+    if isinstance(lineterm, str):
+        fromline, toline, separator = '*** %s%s%s', '--- %s%s%s', '***************'
+        fromhunk, tohunk, tab = '*** %s ****%s', '--- %s ----%s', '\t'
+    else:
+        fromline, toline, separator = b'*** %s%s%s', b'--- %s%s%s', b'***************'
+        fromhunk, tohunk, tab = b'*** %s ****%s', b'--- %s ----%s', b'\t'
+    started = False
+    for group in groups:
+        if not started:
+            started = True
+            fromdate = tab + fromfiledate if fromfiledate else fromfiledate[:0]
+            todate = tab + tofiledate if tofiledate else tofiledate[:0]
+            buffer.add(fromline % (fromfile, fromdate, lineterm))
+            buffer.add(toline % (tofile, todate, lineterm))
+
+        first, last = group[0], group[-1]
+        buffer.add(separator + lineterm)
+
+        file1_range = _format_range_context(first[1], last[2])
+        file2_range = _format_range_context(first[3], last[4])
+        if type(tab) is bytes:
+            file1_range, file2_range = file1_range.encode(), file2_range.encode()
+        buffer.add(fromhunk % (file1_range, lineterm))
+
+        if any(tag == 'replace' or tag == 'delete' for tag, _, _, _, _ in group):
+            for tag, i1, i2, _, _ in group:
+                if tag != 'insert':
+                    buffer.add_lines(prefix[tag], a, i1, i2)
+
+        buffer.add(tohunk % (file2_range, lineterm))
+
+        if any(tag == 'replace' or tag == 'insert' for tag, _, _, _, _ in group):
+            for tag, _, _, j1, j2 in group:
+                if tag != 'delete':
+                    buffer.add_lines(prefix[tag], b, j1, j2)
+        _flush_hunk(buffer, file)
+
+    if file is None:
+        return buffer.getvalue()
+
+def format_unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
+                        tofiledate='', n=3, lineterm='\n', *, file=None,
+                        algorithm='gestalt', max_cost=None, timeout=None):
+    r"""
+    Compare two sequences of lines; return the delta as one unified diff.
+
+    The result is the same as ''.join(unified_diff(a, b, ...)) with the
+    same arguments, but the lines are copied into one str (or bytes object
+    for bytes lines) in C instead of being generated one at a time.
+
+    If 'file' is given, the diff is written to it with one write() call
+    per hunk (the first one includes the file names) and None is returned.
+
+    Example:
+
+    >>> print(format_unified_diff('one\ntwo\nthree\nfour\n'.splitlines(True),
+    ...       'zero\none\ntree\nfour\n'.splitlines(True), 'Original', 'Current'),
+    ...       end="")
+    --- Original
+    +++ Current
+    @@ -1,4 +1,4 @@
+    +zero
+     one
+    -two
+    -three
+    +tree
+     four
+    """
+
+    fromfile, tofile, fromfiledate, tofiledate, lineterm = _check_types(
+        a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm)
+    a, b = _hashable_lines(a), _hashable_lines(b)
+    a = a if type(a) is list else list(a)
+    b = b if type(b) is list else list(b)
+    groups = SequenceMatcher(None,a,b,algorithm=algorithm,max_cost=max_cost,
+                             timeout=timeout).get_grouped_opcodes(n)
+    return _format_unified(a, b, groups, fromfile, tofile, fromfiledate,
+                           tofiledate, lineterm, file)
+
+def format_context_diff(a, b, fromfile='', tofile='', fromfiledate='',
+                        tofiledate='', n=3, lineterm='\n', *, file=None,
+                        algorithm='gestalt', max_cost=None, timeout=None):
+    r"""
+    Compare two sequences of lines; return the delta as one context diff.
+
+    The result is the same as ''.join(context_diff(a, b, ...)) with the
+    same arguments.  The lines are joined and written to 'file' like in
+    format_unified_diff().
+
+    Example:
+
+    >>> print(format_context_diff('one\ntwo\nthree\nfour\n'.splitlines(True),
+    ...       'zero\none\ntree\nfour\n'.splitlines(True), 'Original', 'Current'),
+    ...       end="")
+    *** Original
+    --- Current
+    ***************
+    *** 1,4 ****
+      one
+    ! two
+    ! three
+      four
+    --- 1,4 ----
+    + zero
+      one
+    ! tree
+      four
+    """
+
+    fromfile, tofile, fromfiledate, tofiledate, lineterm = _check_types(
+        a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm)
+    a, b = _hashable_lines(a), _hashable_lines(b)
+    a = a if type(a) is list else list(a)
+    b = b if type(b) is list else list(b)
+    groups = SequenceMatcher(None,a,b,algorithm=algorithm,max_cost=max_cost,
+                             timeout=timeout).get_grouped_opcodes(n)
+    return _format_context(a, b, groups, fromfile, tofile, fromfiledate,
+                           tofiledate, lineterm, file)
+
 def _check_types(a, b, *args):
+    """Returns args, encoded to bytes if the lines are bytes"""
     # Checking types is weird, but the alternative is garbled output when
     # someone passes mixed bytes and str to {unified,context}_diff(). E.g.
     # without this check, passing filenames as bytes results in output like
     #   --- b'oldfile.txt'
     #   +++ b'newfile.txt'
     # because of how str.format() incorporates bytes objects.
+    first = [lines[0] for lines in (a, b) if lines]
+    if first:
+        use_bytes = isinstance(first[0], (bytes, bytearray))
+    else:
+        use_bytes = any(isinstance(arg, (bytes, bytearray)) for arg in args)
+    if use_bytes:
+        for line in first:
+            if not isinstance(line, (bytes, bytearray)):
+                raise TypeError('lines to compare must be str, not %s (%r)' %
+                                (type(first[0]).__name__, first[0]))
+        return tuple(map(_bytes_argument, args))
+
     if a and not isinstance(a[0], str):
         raise TypeError('lines to compare must be str, not %s (%r)' %
                         (type(a[0]).__name__, a[0]))
@@ -1314,25 +4838,54 @@ def _check_types(a, b, *args):
     for arg in args:
         if not isinstance(arg, str):
             raise TypeError('all arguments must be str, not: %r' % (arg,))
+    return args
+
+def _hashable_lines(lines):
+    """Returns lines with bytearray lines converted to bytes, so they can
+    be hashed by SequenceMatcher"""
+    if not lines or not isinstance(lines[0], (bytes, bytearray)):
+        return lines
+    if any(isinstance(line, bytearray) for line in lines):
+        return [bytes(line) if isinstance(line, bytearray) else line for line in lines]
+    return lines
+
+def _bytes_argument(arg):
+    if isinstance(arg, (bytes, bytearray)):
+        return arg
+    if isinstance(arg, str) and arg.isascii():
+        return arg.encode('ascii')
+    raise TypeError('all arguments must be bytes, not %s (%r)' %
+                    (type(arg).__name__, arg))
 
 def diff_bytes(dfunc, a, b, fromfile=b'', tofile=b'',
                fromfiledate=b'', tofiledate=b'', n=3, lineterm=b'\n'):
     r"""
     Compare `a` and `b`, two sequences of lines represented as bytes rather
     than str. This is a wrapper for `dfunc`, which is typically either
-    unified_diff() or context_diff(). Inputs are losslessly converted to
-    strings so that `dfunc` only has to worry about strings, and encoded
-    back to bytes on return. This is necessary to compare files with
-    unknown or inconsistent encoding. All other inputs (except `n`) must be
-    bytes rather than str.
+    unified_diff() or context_diff(). These compare bytes natively, so the
+    lines are passed on as is. For any other `dfunc` inputs are losslessly
+    converted to strings so that `dfunc` only has to worry about strings,
+    and encoded back to bytes on return. This is necessary to compare files
+    with unknown or inconsistent encoding. All other inputs (except `n`)
+    must be bytes rather than str.
     """
-    def decode(s):
-        try:
-            return s.decode('ascii', 'surrogateescape')
-        except AttributeError as err:
+    def check(s):
+        if not isinstance(s, (bytes, bytearray)):
             msg = ('all arguments must be bytes, not %s (%r)' %
                    (type(s).__name__, s))
-            raise TypeError(msg) from err
+            raise TypeError(msg)
+        return s
+    def decode(s):
+        return check(s).decode('ascii', 'surrogateescape')
+
+    if dfunc is unified_diff or dfunc is context_diff:
+        a = list(map(check, a))
+        b = list(map(check, b))
+        for arg in (fromfile, tofile, fromfiledate, tofiledate, lineterm):
+            check(arg)
+        yield from dfunc(a, b, fromfile, tofile, fromfiledate, tofiledate, n, lineterm)
+        return
+
     a = list(map(decode, a))
     b = list(map(decode, b))
     fromfile = decode(fromfile)
@@ -1345,7 +4898,283 @@ def diff_bytes(dfunc, a, b, fromfile=b'', tofile=b'',
     for line in lines:
         yield line.encode('ascii', 'surrogateescape')
 
-def ndiff(a, b, linejunk=None, charjunk=IS_CHARACTER_JUNK):
+########################################################################
+###  Diff of Files
+########################################################################
+
+# encodings whose lines can be split and compared as bytes: newlines are
+# encoded as the same single bytes, which never occur inside of another
+# character, and different bytes always decode to different text
+_bytewise_encodings = ('utf-8', 'ascii', 'iso8859-1')
+_bytewise_errors = ('strict', 'surrogateescape')
+
+cdef inline uint64_t _hash_line(const unsigned char* data, Py_ssize_t size) noexcept nogil:
+    cdef uint64_t h = 0x9e3779b97f4a7c15ULL ^ <uint64_t>size
+    cdef uint64_t word
+    while size >= 8:
+        memcpy(&word, data, 8)
+        h = (h ^ word) * 0xff51afd7ed558ccdULL
+        h ^= h >> 32
+        data += 8
+        size -= 8
+    word = 0
+    memcpy(&word, data, size)
+    h = (h ^ word) * 0xc4ceb9fe1a85ec53ULL
+    return h ^ (h >> 29)
+
+# lines of both files with the same text share a code
+ctypedef struct LineTable:
+    # hash -> first code with this hash
+    unordered_map[uint64_t, Py_ssize_t] heads
+    # code -> next code with the same hash or -1
+    vector[Py_ssize_t] chain
+    # code -> text of the line (without line ending)
+    vector[const unsigned char*] data
+    vector[Py_ssize_t] size
+    vector[bint] terminated
+
+cdef int _split_lines(const unsigned char* data, Py_ssize_t size,
+                      vector[Py_ssize_t]& starts, vector[Py_ssize_t]& ends) except -1 nogil:
+    """Split data into lines the same way as universal newlines mode does.
+
+    Line i is data[starts[i]:ends[i]] followed by its line ending, which
+    reaches up to starts[i + 1].
+    """
+    cdef Py_ssize_t pos = 0, lf = -1, cr = -1
+    cdef const void* found
+    starts.push_back(0)
+    while pos < size:
+        # the next '\n' and '\r' are searched separately, so each search
+        # only has to be repeated once it is passed
+        if lf < pos:
+            found = memchr(data + pos, b'\n', size - pos)
+            lf = <const unsigned char*>found - data if found != NULL else size
+        if cr < pos:
+            found = memchr(data + pos, b'\r', size - pos)
+            cr = <const unsigned char*>found - data if found != NULL else size
+        if lf < cr:
+            ends.push_back(lf)
+            pos = lf + 1
+        elif cr < size:
+            ends.push_back(cr)
+            pos = cr + 2 if cr + 1 < size and data[cr + 1] == b'\n' else cr + 1
+        else:
+            ends.push_back(size)
+            pos = size
+        starts.push_back(pos)
+    return 0
+
+cdef int _code_lines(LineTable* table, const unsigned char* data, const vector[Py_ssize_t]& starts,
+                     const vector[Py_ssize_t]& ends, int64_t* codes) except -1 nogil:
+    cdef size_t i
+    cdef Py_ssize_t code, length
+    cdef const unsigned char* line
+    cdef bint terminated
+    cdef uint64_t h
+    cdef unordered_map[uint64_t, Py_ssize_t].iterator it
+    for i in range(ends.size()):
+        line = data + starts[i]
+        length = ends[i] - starts[i]
+        terminated = ends[i] < starts[i + 1]
+        h = _hash_line(line, length) ^ terminated
+        it = table.heads.find(h)
+        code = deref(it).second if it != table.heads.end() else -1
+        while code >= 0:
+            if (table.size[code] == length and table.terminated[code] == terminated and
+                    memcmp(table.data[code], line, length) == 0):
+                break
+            code = table.chain[code]
+        if code < 0:
+            code = table.chain.size()
+            table.chain.push_back(deref(it).second if it != table.heads.end() else -1)
+            table.heads[h] = code
+            table.data.push_back(line)
+            table.size.push_back(length)
+            table.terminated.push_back(terminated)
+        codes[i] = code
+    return 0
+
+@cython.final
+cdef class _MappedLines:
+    """The lines of a memory mapped text file.
+
+    Behaves like the list returned by readlines() of the file opened in text
+    mode, but the lines are only decoded when they are accessed.  The codes
+    of the lines, which are equal for lines with the same text, are stored
+    in the buffer of codes.
+    """
+
+    cdef object map
+    cdef Py_buffer view
+    cdef bint has_view
+    cdef const unsigned char* data
+    cdef vector[Py_ssize_t] starts
+    cdef vector[Py_ssize_t] ends
+    cdef bytes encoding
+    cdef bytes errors
+    cdef readonly cpython_array.array codes
+
+    def __init__(self, path, str encoding, str errors):
+        with open(path, 'rb') as fp:
+            try:
+                self.map = _mmap(fp.fileno(), 0, access=_ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                if _fstat(fp.fileno()).st_size:
+                    raise
+                self.map = b''
+        PyObject_GetBuffer(self.map, &self.view, PyBUF_SIMPLE)
+        self.has_view = True
+        self.data = <const unsigned char*>self.view.buf
+        self.encoding = encoding.encode('ascii')
+        self.errors = errors.encode('ascii')
+        with nogil:
+            _split_lines(self.data, self.view.len, self.starts, self.ends)
+        self.codes = cpython_array.clone(_codes_template, self.ends.size(), False)
+
+    def __dealloc__(self):
+        if self.has_view:
+            PyBuffer_Release(&self.view)
+
+    def __len__(self):
+        return self.ends.size()
+
+    cdef str _line(self, Py_ssize_t i):
+        cdef Py_ssize_t start = self.starts[i], end = self.ends[i]
+        line = PyUnicode_Decode(<const char*>self.data + start, end - start,
+                                self.encoding, self.errors)
+        if end < self.starts[i + 1]:
+            line += '\n'
+        return line
+
+    def __getitem__(self, index):
+        cdef Py_ssize_t i
+        if isinstance(index, slice):
+            return [self._line(i) for i in range(*index.indices(self.ends.size()))]
+        i = index
+        if i < 0:
+            i += self.ends.size()
+        if not 0 <= i < <Py_ssize_t>self.ends.size():
+            raise IndexError('line index out of range')
+        return self._line(i)
+
+    def close(self):
+        if self.has_view:
+            PyBuffer_Release(&self.view)
+            self.has_view = False
+            if isinstance(self.map, _mmap):
+                self.map.close()
+
+cdef cpython_array.array _codes_template = cpython_array.array('q')
+
+def _code_files(_MappedLines a, _MappedLines b):
+    """Store codes of the lines of a and b, equal for lines with the same text"""
+    cdef LineTable table
+    with nogil:
+        _code_lines(&table, a.data, a.starts, a.ends, <int64_t*>a.codes.data.as_voidptr)
+        _code_lines(&table, b.data, b.starts, b.ends, <int64_t*>b.codes.data.as_voidptr)
+
+def _validate_text(_MappedLines lines, encoding, errors):
+    """Raise the UnicodeDecodeError reading the file in text mode would raise"""
+    decoder = _getincrementaldecoder(encoding)(errors)
+    with memoryview(lines.map) as view:
+        for start in range(0, len(view), 1 << 20):
+            with view[start:start + (1 << 20)] as chunk:
+                decoder.decode(chunk)
+    decoder.decode(b'', True)
+
+def _read_files(path_a, path_b, encoding, errors):
+    """Returns the lines of both files and the SequenceMatcher input for them.
+
+    The files are compared by the codes of their lines, when it is possible
+    to split and compare the lines as bytes in the encoding.  Otherwise they
+    are read with readlines().
+    """
+    with open(path_a, encoding=encoding, errors=errors) as fp:
+        # the same defaults as for reading the file
+        encoding, errors = fp.encoding, fp.errors
+        codec = _lookup_codec(encoding).name
+        if codec not in _bytewise_encodings or (
+                codec != 'iso8859-1' and errors not in _bytewise_errors):
+            a = fp.readlines()
+            with open(path_b, encoding=encoding, errors=errors) as fp:
+                b = fp.readlines()
+            return a, b, a, b
+
+    a = _MappedLines(path_a, encoding, errors)
+    try:
+        b = _MappedLines(path_b, encoding, errors)
+    except:
+        a.close()
+        raise
+    try:
+        if errors == 'strict' and codec != 'iso8859-1':
+            _validate_text(a, encoding, errors)
+            _validate_text(b, encoding, errors)
+        _code_files(a, b)
+    except:
+        a.close()
+        b.close()
+        raise
+    return a, b, a.codes, b.codes
+
+def unified_diff_files(path_a, path_b, fromfile='', tofile='', fromfiledate='',
+                       tofiledate='', n=3, lineterm='\n', *, encoding=None,
+                       errors=None, algorithm='gestalt', max_cost=None, timeout=None):
+    r"""
+    Compare two text files; generate the delta as a unified diff.
+
+    The output is the same as of unified_diff() for the lines returned by
+    readlines() of both files opened in text mode with the given encoding
+    and errors.  The other arguments are the same as for unified_diff().
+
+    For UTF-8, ASCII and Latin-1 encoded files the files are memory mapped.
+    Their lines are split, hashed and compared as bytes and only the lines
+    shown in the diff are decoded, so the files are never read into lists
+    of lines.  Other encodings are read with readlines().
+    """
+
+    for arg in (fromfile, tofile, fromfiledate, tofiledate, lineterm):
+        if not isinstance(arg, str):
+            raise TypeError('all arguments must be str, not: %r' % (arg,))
+    a, b, seq_a, seq_b = _read_files(path_a, path_b, encoding, errors)
+    try:
+        groups = SequenceMatcher(None,seq_a,seq_b,algorithm=algorithm,max_cost=max_cost,
+                                 timeout=timeout).get_grouped_opcodes(n)
+        yield from _unified_diff_lines(a, b, groups, fromfile, tofile, fromfiledate,
+                                       tofiledate, lineterm)
+    finally:
+        if isinstance(a, _MappedLines):
+            a.close()
+            b.close()
+
+def context_diff_files(path_a, path_b, fromfile='', tofile='', fromfiledate='',
+                       tofiledate='', n=3, lineterm='\n', *, encoding=None,
+                       errors=None, algorithm='gestalt', max_cost=None, timeout=None):
+    r"""
+    Compare two text files; generate the delta as a context diff.
+
+    The output is the same as of context_diff() for the lines returned by
+    readlines() of both files opened in text mode with the given encoding
+    and errors.  The files are read like in unified_diff_files().
+    """
+
+    for arg in (fromfile, tofile, fromfiledate, tofiledate, lineterm):
+        if not isinstance(arg, str):
+            raise TypeError('all arguments must be str, not: %r' % (arg,))
+    a, b, seq_a, seq_b = _read_files(path_a, path_b, encoding, errors)
+    try:
+        groups = SequenceMatcher(None,seq_a,seq_b,algorithm=algorithm,max_cost=max_cost,
+                                 timeout=timeout).get_grouped_opcodes(n)
+        yield from _context_diff_lines(a, b, groups, fromfile, tofile, fromfiledate,
+                                       tofiledate, lineterm)
+    finally:
+        if isinstance(a, _MappedLines):
+            a.close()
+            b.close()
+
+def ndiff(a, b, linejunk=None, charjunk=IS_CHARACTER_JUNK, *, algorithm='gestalt',
+          max_cost=None, timeout=None):
     r"""
     Compare `a` and `b` (lists of strings); return a `Differ`-style delta.
 
@@ -1363,6 +5192,12 @@ def ndiff(a, b, linejunk=None, charjunk=IS_CHARACTER_JUNK):
       whitespace characters (a blank or tab; note: it's a bad idea to
       include newline in this!).
 
+    - algorithm: The SequenceMatcher algorithm used to compare the
+      sequences of lines ('gestalt', 'myers' or 'histogram').
+
+    - max_cost, timeout: The work budget of the comparison of the sequences
+      of lines (see SequenceMatcher.__init__).
+
     Tools/scripts/ndiff.py is a command-line front-end to this function.
 
     Example:
@@ -1380,10 +5215,315 @@ def ndiff(a, b, linejunk=None, charjunk=IS_CHARACTER_JUNK):
     + tree
     + emu
     """
-    return Differ(linejunk, charjunk).compare(a, b)
+    return Differ(linejunk, charjunk, algorithm=algorithm, max_cost=max_cost,
+                  timeout=timeout).compare(a, b)
+
+cdef inline str _line_text(line):
+    """The text ndiff shows for line"""
+    if type(line) is str:
+        return line
+    return '%s' % (line,)
+
+cdef object _mark_changes(str line, Opcodes opcodes, bint to_side):
+    """Returns line with the changes of one side of opcodes between the
+    markers of side_by_side or None if this side of line is unchanged.
+    """
+    cdef Py_ssize_t pos = 0, lo, hi
+    cdef size_t k
+    cdef COpcode* op
+    pieces = []
+    for k in range(opcodes.opcodes.size()):
+        op = &opcodes.opcodes[k]
+        if op.tag == TAG_EQUAL:
+            continue
+        if to_side:
+            if op.tag == TAG_DELETE:
+                continue
+            lo, hi = op.j1, op.j2
+            mark = '\0+' if op.tag == TAG_INSERT else '\0^'
+        else:
+            if op.tag == TAG_INSERT:
+                continue
+            lo, hi = op.i1, op.i2
+            mark = '\0-' if op.tag == TAG_DELETE else '\0^'
+        pieces += [line[pos:lo], mark, line[lo:hi], '\1']
+        pos = hi
+    if not pieces:
+        return None
+    pieces.append(line[pos:])
+    return ''.join(pieces)
+
+def _find_synch_pair(a, alo, ahi, b, blo, bhi, charjunk):
+    """Returns the pair of lines Differ synchs up on in a replaced block.
+
+    The result is (i, j, identical) for the most similar pair a[i] and
+    b[j], or None if the block is a straight replace.
+    """
+    if _intraline_cache.maxsize == 0:
+        return _search_synch_pair(a, alo, ahi, b, blo, bhi, charjunk)
+    # the pair is cached relative to the block, which the lines of any
+    # other block with the same contents can use as well
+    key = ('synch', tuple(a[alo:ahi]), tuple(b[blo:bhi]), charjunk)
+    synch = _intraline_cache.get(key)
+    if synch is None:
+        synch = _search_synch_pair(a, alo, ahi, b, blo, bhi, charjunk)
+        synch = (None,) if synch is None else (synch[0] - alo, synch[1] - blo, synch[2])
+        _intraline_cache.put(key, synch)
+    if synch[0] is None:
+        return None
+    return alo + synch[0], blo + synch[1], synch[2]
+
+def _search_synch_pair(a, alo, ahi, b, blo, bhi, charjunk):
+
+    # don't synch up unless the lines have a similarity score of at
+    # least cutoff; best_ratio tracks the best score seen so far
+    best_ratio, cutoff = 0.74, 0.75
+    eqi, eqj = None, None   # 1st indices of equal lines (if any)
+
+    # search for the pair that matches best without being identical
+    # (identical lines must be junk lines, & we don't want to synch up
+    # on junk -- unless we have to).  For str lines this search runs
+    # in C, with the same bounds and order as the loop below
+    found = _find_similar_pair(a, alo, ahi, b, blo, bhi, charjunk)
+    if found is not None:
+        best_ratio, best_i, best_j, eqi, eqj = found
+    else:
+        cruncher = SequenceMatcher(charjunk)
+        for j in range(blo, bhi):
+            bj = b[j]
+            cruncher.set_seq2(bj)
+            for i in range(alo, ahi):
+                ai = a[i]
+                if ai == bj:
+                    if eqi is None:
+                        eqi, eqj = i, j
+                    continue
+                cruncher.set_seq1(ai)
+                # computing similarity is expensive, so use the quick
+                # upper bounds first -- have seen this speed up messy
+                # compares by a factor of 3.
+                # ratio() gives up as soon as it can't beat best_ratio
+                if cruncher.real_quick_ratio() > best_ratio and \
+                      cruncher.quick_ratio(best_ratio) > best_ratio:
+                    score = cruncher.ratio(best_ratio)
+                    if score > best_ratio:
+                        best_ratio, best_i, best_j = score, i, j
+    if best_ratio < cutoff:
+        # no non-identical "pretty close" pair
+        if eqi is None:
+            # no identical pair either -- treat it as a straight replace
+            return None
+        # no close pair, but an identical pair -- synch up on that
+        return eqi, eqj, True
+    # there's a close pair, so forget the identical pair (if any)
+    return best_i, best_j, False
+
+def _replace_records(a, alo, ahi, b, blo, bhi, charjunk):
+    """Same as Differ._fancy_replace, but yields (tag, text) records.
+
+    The '?' records hold the text of the line before them with the
+    intraline changes between markers instead of a guide line.
+    """
+    if alo >= ahi:
+        for j in range(blo, bhi):
+            yield '+', _line_text(b[j])
+        return
+    if blo >= bhi:
+        for i in range(alo, ahi):
+            yield '-', _line_text(a[i])
+        return
+
+    synch = _find_synch_pair(a, alo, ahi, b, blo, bhi, charjunk)
+    if synch is None:
+        # dump the shorter block first like Differ._plain_replace
+        if bhi - blo < ahi - alo:
+            yield from _replace_records(a, alo, alo, b, blo, bhi, charjunk)
+            yield from _replace_records(a, alo, ahi, b, bhi, bhi, charjunk)
+        else:
+            yield from _replace_records(a, alo, ahi, b, blo, blo, charjunk)
+            yield from _replace_records(a, ahi, ahi, b, blo, bhi, charjunk)
+        return
+
+    best_i, best_j, identical = synch
+    yield from _replace_records(a, alo, best_i, b, blo, best_j, charjunk)
+    aelt, belt = a[best_i], b[best_j]
+    if identical:
+        yield ' ', aelt
+    else:
+        opcodes = _intraline_opcodes(aelt, belt, charjunk)
+        yield '-', aelt
+        marked = _mark_changes(aelt, opcodes, False)
+        if marked is not None:
+            yield '?', marked
+        yield '+', belt
+        marked = _mark_changes(belt, opcodes, True)
+        if marked is not None:
+            yield '?', marked
+    yield from _replace_records(a, best_i+1, ahi, b, best_j+1, bhi, charjunk)
+
+def _diff_records(a, b, linejunk, charjunk, algorithm, max_cost, timeout):
+    """Yields the lines of ndiff(a, b) as (tag, text) records"""
+    cruncher = SequenceMatcher(linejunk, a, b, algorithm=algorithm, max_cost=max_cost,
+                               timeout=timeout)
+    for tag, alo, ahi, blo, bhi in cruncher.get_opcodes():
+        if tag == 'replace':
+            yield from _replace_records(a, alo, ahi, b, blo, bhi, charjunk)
+        elif tag == 'delete':
+            for i in range(alo, ahi):
+                yield '-', _line_text(a[i])
+        elif tag == 'insert':
+            for j in range(blo, bhi):
+                yield '+', _line_text(b[j])
+        else:
+            for i in range(alo, ahi):
+                yield ' ', _line_text(a[i])
+
+cdef class _LineNumbers:
+    """Line numbers of both sides of side_by_side"""
 
-def _mdiff(fromlines, tolines, context=None, linejunk=None,
-           charjunk=IS_CHARACTER_JUNK):
+    cdef Py_ssize_t num_lines[2]
+
+    cdef tuple make_line(self, list lines, str format_key, int side):
+        """Returns line of text with change markup and its line number.
+
+        lines -- list of (tag, text) records to produce a line of text from.
+                 The records used are removed from this list.
+        format_key -- '+' return first line in list with "add" markup around
+                          the entire line.
+                      '-' return first line in list with "delete" markup around
+                          the entire line.
+                      '?' return the marked up line of the '?' record
+                          following the first line
+                      None return first line in list with no markup
+        side -- indice into the line numbers (0=from,1=to)
+        """
+        self.num_lines[side] += 1
+        if format_key is None:
+            text = lines.pop(0)[1]
+        elif format_key == '?':
+            del lines[0]
+            text = lines.pop(0)[1]
+        else:
+            text = lines.pop(0)[1]
+            # if line of text is just a newline, insert a space so there is
+            # something for the user to highlight and see.
+            if not text:
+                text = ' '
+            # insert marks that won't be noticed by an xml/html escaper.
+            text = '\0' + format_key + text + '\1'
+        return (self.num_lines[side],text)
+
+_end_record = ('X', None)
+
+def _line_iterator(records):
+    """Yields from/to lines of text with a change indication.
+
+    This function is an iterator.  It itself pulls records from a
+    differencing iterator, processes them and yields them.  When it can
+    it yields both a "from" and a "to" line, otherwise it will yield one
+    or the other.  In addition to yielding the lines of from/to text, a
+    boolean flag is yielded to indicate if the text line(s) have
+    differences in them.
+    """
+    cdef _LineNumbers numbers = _LineNumbers()
+    cdef list lines = []
+    cdef Py_ssize_t num_blanks_pending = 0, num_blanks_to_yield = 0
+    while True:
+        # Load up next 4 records so we can look ahead, create strings which
+        # are a concatenation of the tags of the 4 records so we can do
+        # some very readable comparisons.
+        while len(lines) < 4:
+            lines.append(next(records, _end_record))
+        s = ''.join([line[0] for line in lines])
+        if s.startswith('X'):
+            # When no more lines, pump out any remaining blank lines so the
+            # corresponding add/delete lines get a matching blank line so
+            # all line pairs get yielded at the next level.
+            num_blanks_to_yield = num_blanks_pending
+        elif s.startswith('-?+?'):
+            # simple intraline change
+            yield numbers.make_line(lines,'?',0), numbers.make_line(lines,'?',1), True
+            continue
+        elif s.startswith('--++'):
+            # in delete block, add block coming: we do NOT want to get
+            # caught up on blank lines yet, just process the delete line
+            num_blanks_pending -= 1
+            yield numbers.make_line(lines,'-',0), None, True
+            continue
+        elif s.startswith(('--?+', '--+', '- ')):
+            # in delete block and see an intraline change or unchanged line
+            # coming: yield the delete line and then blanks
+            from_line,to_line = numbers.make_line(lines,'-',0), None
+            num_blanks_to_yield,num_blanks_pending = num_blanks_pending-1,0
+        elif s.startswith('-+?'):
+            # intraline change
+            yield numbers.make_line(lines,None,0), numbers.make_line(lines,'?',1), True
+            continue
+        elif s.startswith('-?+'):
+            # intraline change
+            yield numbers.make_line(lines,'?',0), numbers.make_line(lines,None,1), True
+            continue
+        elif s.startswith('-'):
+            # delete FROM line
+            num_blanks_pending -= 1
+            yield numbers.make_line(lines,'-',0), None, True
+            continue
+        elif s.startswith('+--'):
+            # in add block, delete block coming: we do NOT want to get
+            # caught up on blank lines yet, just process the add line
+            num_blanks_pending += 1
+            yield None, numbers.make_line(lines,'+',1), True
+            continue
+        elif s.startswith(('+ ', '+-')):
+            # will be leaving an add block: yield blanks then add line
+            from_line, to_line = None, numbers.make_line(lines,'+',1)
+            num_blanks_to_yield,num_blanks_pending = num_blanks_pending+1,0
+        elif s.startswith('+'):
+            # inside an add block, yield the add line
+            num_blanks_pending += 1
+            yield None, numbers.make_line(lines,'+',1), True
+            continue
+        elif s.startswith(' '):
+            # unchanged text, yield it to both sides
+            yield numbers.make_line(lines[:],None,0),numbers.make_line(lines,None,1),False
+            continue
+        # Catch up on the blank lines so when we yield the next from/to
+        # pair, they are lined up.
+        while(num_blanks_to_yield < 0):
+            num_blanks_to_yield += 1
+            yield None,('','\n'),True
+        while(num_blanks_to_yield > 0):
+            num_blanks_to_yield -= 1
+            yield ('','\n'),None,True
+        if s.startswith('X'):
+            return
+        else:
+            yield from_line,to_line,True
+
+def _line_pair_iterator(line_iterator):
+    """Yields from/to lines of text with a change indication.
+
+    This function is an iterator.  It itself pulls lines from the line
+    iterator.  Its difference from that iterator is that this function
+    always yields a pair of from/to text lines (with the change
+    indication).  If necessary it will collect single from/to lines
+    until it has a matching pair from/to pair to yield.
+    """
+    fromlines,tolines=_deque(),_deque()
+    for from_line, to_line, found_diff in line_iterator:
+        if from_line is not None:
+            fromlines.append((from_line,found_diff))
+        if to_line is not None:
+            tolines.append((to_line,found_diff))
+        # Once we have a pair, remove them from the collection and yield it
+        while fromlines and tolines:
+            from_line, from_diff = fromlines.popleft()
+            to_line, to_diff = tolines.popleft()
+            yield (from_line,to_line,from_diff or to_diff)
+
+def side_by_side(fromlines, tolines, context=None, linejunk=None,
+                 charjunk=IS_CHARACTER_JUNK, *, algorithm='gestalt', max_cost=None,
+                 timeout=None):
     r"""Returns generator yielding marked up from/to side by side differences.
 
     Arguments:
@@ -1391,8 +5531,10 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
     tolines -- list of text lines to be compared to fromlines
     context -- number of context lines to display on each side of difference,
                if None, all from/to text lines will be generated.
-    linejunk -- passed on to ndiff (see ndiff documentation)
-    charjunk -- passed on to ndiff (see ndiff documentation)
+    linejunk -- same as for ndiff (see ndiff documentation)
+    charjunk -- same as for ndiff (see ndiff documentation)
+    algorithm -- same as for ndiff (see ndiff documentation)
+    max_cost, timeout -- same as for ndiff (see ndiff documentation)
 
     This function returns an iterator which returns a tuple:
     (from line tuple, to line tuple, boolean flag)
@@ -1410,246 +5552,78 @@ def _mdiff(fromlines, tolines, context=None, linejunk=None,
 
     This function/iterator was originally developed to generate side by side
     file difference for making HTML pages (see HtmlDiff class for example
-    usage).
-
-    Note, this function utilizes the ndiff function to generate the side by
-    side difference markup.  Optional ndiff arguments may be passed to this
-    function and they in turn will be passed to ndiff.
+    usage).  It generates the same differences as difflib._mdiff, but
+    places the markers using the opcodes of the intraline comparison instead
+    of parsing the output of ndiff.
+
+    >>> for line in side_by_side(['abcDefghiJkl\n', 'same\n'],
+    ...                          ['abcdefGhijkl\n', 'same\n']):
+    ...     print(line)
+    ((1, 'abc\x00^D\x01ef\x00^g\x01hi\x00^J\x01kl\n'), (1, 'abc\x00^d\x01ef\x00^G\x01hi\x00^j\x01kl\n'), True)
+    ((2, 'same\n'), (2, 'same\n'), False)
     """
-    import re
-
-    # regular expression for finding intraline change indices
-    change_re = re.compile(r'(\++|\-+|\^+)')
-
-    # create the difference iterator to generate the differences
-    diff_lines_iterator = ndiff(fromlines,tolines,linejunk,charjunk)
-
-    def _make_line(lines, format_key, side, num_lines=[0,0]):
-        """Returns line of text with user's change markup and line formatting.
-
-        lines -- list of lines from the ndiff generator to produce a line of
-                 text from.  When producing the line of text to return, the
-                 lines used are removed from this list.
-        format_key -- '+' return first line in list with "add" markup around
-                          the entire line.
-                      '-' return first line in list with "delete" markup around
-                          the entire line.
-                      '?' return first line in list with add/delete/change
-                          intraline markup (indices obtained from second line)
-                      None return first line in list with no markup
-        side -- indice into the num_lines list (0=from,1=to)
-        num_lines -- from/to current line number.  This is NOT intended to be a
-                     passed parameter.  It is present as a keyword argument to
-                     maintain memory of the current line numbers between calls
-                     of this function.
-
-        Note, this function is purposefully not defined at the module scope so
-        that data it needs from its parent function (within whose context it
-        is defined) does not need to be of module scope.
-        """
-        num_lines[side] += 1
-        # Handle case where no user markup is to be added, just return line of
-        # text with user's line format to allow for usage of the line number.
-        if format_key is None:
-            return (num_lines[side],lines.pop(0)[2:])
-        # Handle case of intraline changes
-        if format_key == '?':
-            text, markers = lines.pop(0), lines.pop(0)
-            # find intraline changes (store change type and indices in tuples)
-            sub_info = []
-            def record_sub_info(match_object,sub_info=sub_info):
-                sub_info.append([match_object.group(1)[0],match_object.span()])
-                return match_object.group(1)
-            change_re.sub(record_sub_info,markers)
-            # process each tuple inserting our special marks that won't be
-            # noticed by an xml/html escaper.
-            for key,(begin,end) in reversed(sub_info):
-                text = text[0:begin]+'\0'+key+text[begin:end]+'\1'+text[end:]
-            text = text[2:]
-        # Handle case of add/delete entire line
-        else:
-            text = lines.pop(0)[2:]
-            # if line of text is just a newline, insert a space so there is
-            # something for the user to highlight and see.
-            if not text:
-                text = ' '
-            # insert marks that won't be noticed by an xml/html escaper.
-            text = '\0' + format_key + text + '\1'
-        # Return line of text, first allow user's line formatter to do its
-        # thing (such as adding the line number) then replace the special
-        # marks with what the user's change markup.
-        return (num_lines[side],text)
-
-    def _line_iterator():
-        """Yields from/to lines of text with a change indication.
-
-        This function is an iterator.  It itself pulls lines from a
-        differencing iterator, processes them and yields them.  When it can
-        it yields both a "from" and a "to" line, otherwise it will yield one
-        or the other.  In addition to yielding the lines of from/to text, a
-        boolean flag is yielded to indicate if the text line(s) have
-        differences in them.
-
-        Note, this function is purposefully not defined at the module scope so
-        that data it needs from its parent function (within whose context it
-        is defined) does not need to be of module scope.
-        """
-        lines = []
-        num_blanks_pending, num_blanks_to_yield = 0, 0
-        while True:
-            # Load up next 4 lines so we can look ahead, create strings which
-            # are a concatenation of the first character of each of the 4 lines
-            # so we can do some very readable comparisons.
-            while len(lines) < 4:
-                lines.append(next(diff_lines_iterator, 'X'))
-            s = ''.join([line[0] for line in lines])
-            if s.startswith('X'):
-                # When no more lines, pump out any remaining blank lines so the
-                # corresponding add/delete lines get a matching blank line so
-                # all line pairs get yielded at the next level.
-                num_blanks_to_yield = num_blanks_pending
-            elif s.startswith('-?+?'):
-                # simple intraline change
-                yield _make_line(lines,'?',0), _make_line(lines,'?',1), True
-                continue
-            elif s.startswith('--++'):
-                # in delete block, add block coming: we do NOT want to get
-                # caught up on blank lines yet, just process the delete line
-                num_blanks_pending -= 1
-                yield _make_line(lines,'-',0), None, True
-                continue
-            elif s.startswith(('--?+', '--+', '- ')):
-                # in delete block and see an intraline change or unchanged line
-                # coming: yield the delete line and then blanks
-                from_line,to_line = _make_line(lines,'-',0), None
-                num_blanks_to_yield,num_blanks_pending = num_blanks_pending-1,0
-            elif s.startswith('-+?'):
-                # intraline change
-                yield _make_line(lines,None,0), _make_line(lines,'?',1), True
-                continue
-            elif s.startswith('-?+'):
-                # intraline change
-                yield _make_line(lines,'?',0), _make_line(lines,None,1), True
-                continue
-            elif s.startswith('-'):
-                # delete FROM line
-                num_blanks_pending -= 1
-                yield _make_line(lines,'-',0), None, True
-                continue
-            elif s.startswith('+--'):
-                # in add block, delete block coming: we do NOT want to get
-                # caught up on blank lines yet, just process the add line
-                num_blanks_pending += 1
-                yield None, _make_line(lines,'+',1), True
-                continue
-            elif s.startswith(('+ ', '+-')):
-                # will be leaving an add block: yield blanks then add line
-                from_line, to_line = None, _make_line(lines,'+',1)
-                num_blanks_to_yield,num_blanks_pending = num_blanks_pending+1,0
-            elif s.startswith('+'):
-                # inside an add block, yield the add line
-                num_blanks_pending += 1
-                yield None, _make_line(lines,'+',1), True
-                continue
-            elif s.startswith(' '):
-                # unchanged text, yield it to both sides
-                yield _make_line(lines[:],None,0),_make_line(lines,None,1),False
-                continue
-            # Catch up on the blank lines so when we yield the next from/to
-            # pair, they are lined up.
-            while(num_blanks_to_yield < 0):
-                num_blanks_to_yield += 1
-                yield None,('','\n'),True
-            while(num_blanks_to_yield > 0):
-                num_blanks_to_yield -= 1
-                yield ('','\n'),None,True
-            if s.startswith('X'):
-                return
-            else:
-                yield from_line,to_line,True
-
-    def _line_pair_iterator():
-        """Yields from/to lines of text with a change indication.
-
-        This function is an iterator.  It itself pulls lines from the line
-        iterator.  Its difference from that iterator is that this function
-        always yields a pair of from/to text lines (with the change
-        indication).  If necessary it will collect single from/to lines
-        until it has a matching pair from/to pair to yield.
-
-        Note, this function is purposefully not defined at the module scope so
-        that data it needs from its parent function (within whose context it
-        is defined) does not need to be of module scope.
-        """
-        line_iterator = _line_iterator()
-        fromlines,tolines=[],[]
-        while True:
-            # Collecting lines of text until we have a from/to pair
-            while (len(fromlines)==0 or len(tolines)==0):
-                try:
-                    from_line, to_line, found_diff = next(line_iterator)
-                except StopIteration:
-                    return
-                if from_line is not None:
-                    fromlines.append((from_line,found_diff))
-                if to_line is not None:
-                    tolines.append((to_line,found_diff))
-            # Once we have a pair, remove them from the collection and yield it
-            from_line, fromDiff = fromlines.pop(0)
-            to_line, to_diff = tolines.pop(0)
-            yield (from_line,to_line,fromDiff or to_diff)
+    cdef Py_ssize_t c_max_cost
+    cdef double c_timeout
+    _get_algorithm(algorithm)
+    _get_budget(max_cost, timeout, &c_max_cost, &c_timeout)
+    records = _diff_records(fromlines, tolines, linejunk, charjunk, algorithm, max_cost,
+                            timeout)
+    line_pair_iterator = _line_pair_iterator(_line_iterator(records))
 
     # Handle case where user does not want context differencing, just yield
     # them up without doing anything else with them.
-    line_pair_iterator = _line_pair_iterator()
     if context is None:
         yield from line_pair_iterator
+        return
+
     # Handle case where user wants context differencing.  We must do some
     # storage of lines until we know for sure that they are to be yielded.
-    else:
-        context += 1
-        lines_to_write = 0
-        while True:
-            # Store lines up until we find a difference, note use of a
-            # circular queue because we only need to keep around what
-            # we need for context.
-            index, contextLines = 0, [None]*(context)
-            found_diff = False
-            while(found_diff is False):
-                try:
-                    from_line, to_line, found_diff = next(line_pair_iterator)
-                except StopIteration:
-                    return
-                i = index % context
-                contextLines[i] = (from_line, to_line, found_diff)
-                index += 1
-            # Yield lines that we have collected so far, but first yield
-            # the user's separator.
-            if index > context:
-                yield None, None, None
-                lines_to_write = context
-            else:
-                lines_to_write = index
-                index = 0
-            while(lines_to_write):
-                i = index % context
-                index += 1
-                yield contextLines[i]
-                lines_to_write -= 1
-            # Now yield the context lines after the change
-            lines_to_write = context-1
+    context += 1
+    lines_to_write = 0
+    while True:
+        # Store lines up until we find a difference, note use of a
+        # circular queue because we only need to keep around what
+        # we need for context.
+        index, contextLines = 0, [None]*(context)
+        found_diff = False
+        while(found_diff is False):
             try:
-                while(lines_to_write):
-                    from_line, to_line, found_diff = next(line_pair_iterator)
-                    # If another change within the context, extend the context
-                    if found_diff:
-                        lines_to_write = context-1
-                    else:
-                        lines_to_write -= 1
-                    yield from_line, to_line, found_diff
+                from_line, to_line, found_diff = next(line_pair_iterator)
             except StopIteration:
-                # Catch exception from next() and return normally
                 return
+            i = index % context
+            contextLines[i] = (from_line, to_line, found_diff)
+            index += 1
+        # Yield lines that we have collected so far, but first yield
+        # the user's separator.
+        if index > context:
+            yield None, None, None
+            lines_to_write = context
+        else:
+            lines_to_write = index
+            index = 0
+        while(lines_to_write):
+            i = index % context
+            index += 1
+            yield contextLines[i]
+            lines_to_write -= 1
+        # Now yield the context lines after the change
+        lines_to_write = context-1
+        try:
+            while(lines_to_write):
+                from_line, to_line, found_diff = next(line_pair_iterator)
+                # If another change within the context, extend the context
+                if found_diff:
+                    lines_to_write = context-1
+                else:
+                    lines_to_write -= 1
+                yield from_line, to_line, found_diff
+        except StopIteration:
+            # Catch exception from next() and return normally
+            return
+
+# the name used by difflib
+_mdiff = side_by_side
 
 
 _file_template = """
@@ -1708,6 +5682,154 @@ _legend = """
                   </table></td> </tr>
     </table>"""
 
+cdef inline void _append_ascii(vector[Py_UCS4]& out, const char* s) noexcept:
+    while s[0]:
+        out.push_back(<Py_UCS4>s[0])
+        s += 1
+
+cdef inline str _from_ucs4(const vector[Py_UCS4]& out):
+    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, out.data(), out.size())
+
+cdef str _expand_tabs(str line, Py_ssize_t tabsize):
+    """Expand tabs into tab characters and strip trailing newlines.
+
+    Same as hiding the spaces of line, calling line.expandtabs(tabsize) and
+    replacing the spaces from expanded tabs with tab characters.  Like in
+    difflib null characters end up as spaces.
+    """
+    cdef vector[Py_UCS4] out
+    cdef Py_ssize_t column = 0, fill
+    cdef Py_UCS4 ch
+    if '\t' not in line and '\0' not in line:
+        return line.rstrip('\n')
+
+    out.reserve(<size_t>len(line))
+    for ch in line:
+        if ch == '\t':
+            if tabsize > 0:
+                fill = tabsize - column % tabsize
+                column += fill
+                out.insert(out.end(), <size_t>fill, <Py_UCS4>'\t')
+        else:
+            if ch == '\n' or ch == '\r':
+                column = 0
+            else:
+                column += 1
+            out.push_back(<Py_UCS4>' ' if ch == '\0' else ch)
+    while not out.empty() and out.back() == '\n':
+        out.pop_back()
+    return _from_ucs4(out)
+
+cdef str _escape_html(str text):
+    """text.replace("&","&amp;").replace(">","&gt;").replace("<","&lt;").replace(" ","&nbsp;")"""
+    cdef vector[Py_UCS4] out
+    cdef Py_UCS4 ch
+    for ch in text:
+        if ch == '&' or ch == '>' or ch == '<' or ch == ' ':
+            break
+    else:
+        return text
+
+    out.reserve(<size_t>len(text) * 2)
+    for ch in text:
+        if ch == '&':
+            _append_ascii(out, b"&amp;")
+        elif ch == '>':
+            _append_ascii(out, b"&gt;")
+        elif ch == '<':
+            _append_ascii(out, b"&lt;")
+        elif ch == ' ':
+            _append_ascii(out, b"&nbsp;")
+        else:
+            out.push_back(ch)
+    return _from_ucs4(out)
+
+cdef str _replace_markers(str text):
+    """Replace the change markers of _mdiff and the tabs with their HTML markup"""
+    cdef vector[Py_UCS4] out
+    cdef Py_ssize_t i = 0, size = len(text)
+    cdef Py_UCS4 ch, key
+    for ch in text:
+        if ch == '\0' or ch == '\1' or ch == '\t':
+            break
+    else:
+        return text
+
+    out.reserve(<size_t>size * 2)
+    while i < size:
+        ch = text[i]
+        i += 1
+        if ch == '\0' and i < size:
+            key = text[i]
+            if key == '+':
+                _append_ascii(out, b'<span class="diff_add">')
+            elif key == '-':
+                _append_ascii(out, b'<span class="diff_sub">')
+            elif key == '^':
+                _append_ascii(out, b'<span class="diff_chg">')
+            else:
+                out.push_back(ch)
+                continue
+            i += 1
+        elif ch == '\1':
+            _append_ascii(out, b'</span>')
+        elif ch == '\t':
+            _append_ascii(out, b'&nbsp;')
+        else:
+            out.push_back(ch)
+    return _from_ucs4(out)
+
+cdef tuple _wrap_point(str text, Py_ssize_t max):
+    """Returns the index where text is wrapped after max visible characters
+    and the marker which is open at this point (or '')
+    """
+    cdef Py_ssize_t i = 0, n = 0, size = len(text)
+    cdef Py_UCS4 ch
+    mark = ''
+    while n < max and i < size:
+        ch = text[i]
+        if ch == '\0':
+            i += 1
+            mark = text[i]
+            i += 1
+        elif ch == '\1':
+            i += 1
+            mark = ''
+        else:
+            i += 1
+            n += 1
+    return i, mark
+
+
+class _HeldRows:
+    """HTML rows held back by HtmlDiff until the link in the first is final.
+
+    The rows are kept in memory up to a limit and in a temporary file
+    afterwards.
+    """
+
+    max_size = 1 << 20
+
+    def __init__(self, render, first):
+        self._render = render
+        self._first = first
+        self._file = _SpooledTemporaryFile(self.max_size, mode='w+', encoding='utf-8',
+                                           errors='surrogatepass', newline='')
+
+    def append(self, text):
+        self._file.write(text)
+
+    def release(self):
+        yield self._render(self._first)
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(1 << 16)
+            if not chunk:
+                break
+            yield chunk
+        self._file.close()
+
+
 class HtmlDiff(object):
     """For producing HTML side by side comparison with change highlights.
 
@@ -1720,6 +5842,8 @@ class HtmlDiff(object):
 
     make_table -- generates HTML for a single side by side table
     make_file -- generates complete HTML file with a single side by side table
+    iter_table -- generates HTML for a single side by side table in pieces
+    write_file -- writes complete HTML file with a single side by side table
 
     See tools/scripts/diff.py for an example usage of this class.
     """
@@ -1774,6 +5898,32 @@ class HtmlDiff(object):
             charset=charset
         )).encode(charset, 'xmlcharrefreplace').decode(charset)
 
+    def write_file(self, fp, fromlines, tolines, fromdesc='', todesc='',
+                   context=False, numlines=5, *, charset='utf-8'):
+        """Writes HTML file of side by side comparison to a text file
+
+        fp is a file-like object opened in text mode, and the remaining
+        arguments are the same as for make_file().  The document is written
+        in pieces while the lines are compared, so unlike make_file() it is
+        never held in memory as a whole.  The written text is the same as
+        returned by make_file().
+        """
+
+        def write(text):
+            fp.write(text.encode(charset, 'xmlcharrefreplace').decode(charset))
+
+        values = dict(styles=self._styles, legend=self._legend, charset=charset)
+        head,sep,tail = self._file_template.partition('%(table)s')
+        if not sep:
+            write(self.make_file(fromlines, tolines, fromdesc, todesc,
+                                 context=context, numlines=numlines, charset=charset))
+            return
+        write(head % values)
+        for piece in self.iter_table(fromlines, tolines, fromdesc, todesc,
+                                     context=context, numlines=numlines):
+            write(piece)
+        write(tail % values)
+
     def _tab_newline_replace(self,fromlines,tolines):
         """Returns from/to line lists with tabs expanded and newlines removed.
 
@@ -1784,7 +5934,10 @@ class HtmlDiff(object):
         spaces and vice versa.  At the end of the HTML generation, the tab
         characters will be replaced with a nonbreakable space.
         """
+        tabsize = self._tabsize
         def expand_tabs(line):
+            if type(line) is str:
+                return _expand_tabs(line, tabsize)
             # hide real spaces
             line = line.replace(' ','\0')
             # expand tabs into spaces
@@ -1806,51 +5959,39 @@ class HtmlDiff(object):
         text line list.  This function is used recursively to handle
         the second part of the split line to further split it.
         """
-        # if blank line or context separator, just add it to the output list
-        if not line_num:
-            data_list.append((line_num,text))
-            return
-
-        # if line text doesn't need wrapping, just add it to the output list
-        size = len(text)
         max = self._wrapcolumn
-        if (size <= max) or ((size -(text.count('\0')*3)) <= max):
-            data_list.append((line_num,text))
-            return
+        while True:
+            # if blank line or context separator, just add it to the output list
+            if not line_num:
+                data_list.append((line_num,text))
+                return
 
-        # scan text looking for the wrap point, keeping track if the wrap
-        # point is inside markers
-        i = 0
-        n = 0
-        mark = ''
-        while n < max and i < size:
-            if text[i] == '\0':
-                i += 1
-                mark = text[i]
-                i += 1
-            elif text[i] == '\1':
-                i += 1
-                mark = ''
-            else:
-                i += 1
-                n += 1
+            # if line text doesn't need wrapping, just add it to the output list
+            size = len(text)
+            if (size <= max) or ((size -(text.count('\0')*3)) <= max):
+                data_list.append((line_num,text))
+                return
 
-        # wrap point is inside text, break it up into separate lines
-        line1 = text[:i]
-        line2 = text[i:]
+            # scan text looking for the wrap point, keeping track if the wrap
+            # point is inside markers
+            i, mark = _wrap_point(text, max)
 
-        # if wrap point is inside markers, place end marker at end of first
-        # line and start marker at beginning of second line because each
-        # line will have its own table tag markup around it.
-        if mark:
-            line1 = line1 + '\1'
-            line2 = '\0' + mark + line2
+            # wrap point is inside text, break it up into separate lines
+            line1 = text[:i]
+            line2 = text[i:]
 
-        # tack on first line onto the output list
-        data_list.append((line_num,line1))
+            # if wrap point is inside markers, place end marker at end of first
+            # line and start marker at beginning of second line because each
+            # line will have its own table tag markup around it.
+            if mark:
+                line1 = line1 + '\1'
+                line2 = '\0' + mark + line2
 
-        # use this routine again to wrap the remaining text
-        self._split_line(data_list,'>',line2)
+            # tack on first line onto the output list
+            data_list.append((line_num,line1))
+
+            # wrap the remaining text
+            line_num, text = '>', line2
 
     def _line_wrapper(self,diffs):
         """Returns iterator that splits (wraps) mdiff text lines"""
@@ -1880,27 +6021,6 @@ class HtmlDiff(object):
                     todata = ('',' ')
                 yield fromdata,todata,flag
 
-    def _collect_lines(self,diffs):
-        """Collects mdiff output into separate lists
-
-        Before storing the mdiff from/to data into a list, it is converted
-        into a single line of text with HTML markup.
-        """
-
-        fromlist,tolist,flaglist = [],[],[]
-        # pull from/to data and flags from mdiff style iterator
-        for fromdata,todata,flag in diffs:
-            try:
-                # store HTML markup of the lines into the lists
-                fromlist.append(self._format_line(0,flag,*fromdata))
-                tolist.append(self._format_line(1,flag,*todata))
-            except TypeError:
-                # exceptions occur for lines where context separators go
-                fromlist.append(None)
-                tolist.append(None)
-            flaglist.append(flag)
-        return fromlist,tolist,flaglist
-
     def _format_line(self,side,flag,linenum,text):
         """Returns HTML markup of "from" / "to" text lines
 
@@ -1916,10 +6036,9 @@ class HtmlDiff(object):
             # handle blank lines where linenum is '>' or ''
             id = ''
         # replace those things that would get confused with HTML symbols
-        text=text.replace("&","&amp;").replace(">","&gt;").replace("<","&lt;")
-
-        # make space non-breakable so they don't get compressed or line wrapped
-        text = text.replace(' ','&nbsp;').rstrip()
+        # and make space non-breakable so they don't get compressed or line
+        # wrapped
+        text = _escape_html(text).rstrip()
 
         return '<td class="diff_header"%s>%s</td><td nowrap="nowrap">%s</td>' \
                % (id,linenum,text)
@@ -1935,69 +6054,112 @@ class HtmlDiff(object):
         # store prefixes so line format method has access
         self._prefix = [fromprefix,toprefix]
 
-    def _convert_flags(self,fromlist,tolist,flaglist,context,numlines):
-        """Makes list of "next" links"""
+    def _iter_rows(self,diffs,context,numlines):
+        """Yields the HTML rows of the table for the mdiff style iterator
 
-        # all anchor names will be generated using the unique "to" prefix
+        The rows get the same anchors and "next" links as if the whole table
+        was built at once.  Anchors are placed numlines rows before a change,
+        so the last numlines rows are kept in a window.  The "next" link of
+        the last change turns into a link to the top, so rows following a
+        change are held back (in a temporary file once they grow large)
+        until the next change starts.
+        """
         toprefix = self._prefix[1]
+        fmt = '            <tr><td class="diff_next"%s>%s</td>%s' + \
+              '<td class="diff_next">%s</td>%s</tr>\n'
+        top_link = '<a href="#difflib_chg_%s_top">t</a>' % (toprefix)
+        numlines = max(numlines, 0)
 
-        # process change flags, generating middle column of next anchors/links
-        next_id = ['']*len(flaglist)
-        next_href = ['']*len(flaglist)
+        def render(row):
+            index,flag,next_id,next_href,fromtext,totext = row
+            if flag is None:
+                # mdiff yields None on separator lines skip the bogus ones
+                # generated for the first line
+                if index > 0:
+                    return '        </tbody>        \n        <tbody>\n'
+                return ''
+            return _replace_markers(fmt % (next_id,next_href,fromtext,
+                                           next_href,totext))
+
+        # window holds [index, flag, next_id, next_href, from, to] rows
+        # which may still get an anchor.  last is the row whose link is
+        # replaced by the link to the top if no other change follows.
+        # Once it left the window all rows are held back in held
+        window = _deque()
+        last = None
+        held = None
         num_chg, in_change = 0, False
-        last = 0
-        for i,flag in enumerate(flaglist):
+        index = -1
+        for index,(fromdata,todata,flag) in enumerate(diffs):
+            try:
+                # store HTML markup of the lines
+                fromtext = self._format_line(0,flag,*fromdata)
+                totext = self._format_line(1,flag,*todata)
+            except TypeError:
+                # exceptions occur for lines where context separators go
+                fromtext = totext = None
+            row = [index,flag,'','',fromtext,totext]
+            window.append(row)
+            if index == 0:
+                last = row
+                # if not a change on first line, drop a link
+                if not flag:
+                    row[3] = '<a href="#difflib_chg_%s_0">f</a>' % toprefix
+
             if flag:
                 if not in_change:
                     in_change = True
-                    last = i
                     # at the beginning of a change, drop an anchor a few lines
                     # (the context lines) before the change for the previous
                     # link
-                    i = max([0,i-numlines])
-                    next_id[i] = ' id="difflib_chg_%s_%d"' % (toprefix,num_chg)
+                    anchor = window[max(0,index-numlines) - window[0][0]]
+                    anchor[2] = ' id="difflib_chg_%s_%d"' % (toprefix,num_chg)
                     # at the beginning of a change, drop a link to the next
                     # change
                     num_chg += 1
-                    next_href[last] = '<a href="#difflib_chg_%s_%d">n</a>' % (
+                    row[3] = '<a href="#difflib_chg_%s_%d">n</a>' % (
                          toprefix,num_chg)
+                    # the link of the previous change is final now
+                    last = row
+                    if held is not None:
+                        yield from held.release()
+                        held = None
             else:
                 in_change = False
-        # check for cases where there is no content to avoid exceptions
-        if not flaglist:
-            flaglist = [False]
-            next_id = ['']
-            next_href = ['']
-            last = 0
+
+            while window and window[0][0] <= index - numlines:
+                done = window.popleft()
+                if held is not None:
+                    held.append(render(done))
+                elif done is last:
+                    held = _HeldRows(render, done)
+                else:
+                    yield render(done)
+
+        # check for cases where there is no content
+        if index == -1:
             if context:
-                fromlist = ['<td></td><td>&nbsp;No Differences Found&nbsp;</td>']
-                tolist = fromlist
+                fromtext = totext = '<td></td><td>&nbsp;No Differences Found&nbsp;</td>'
             else:
-                fromlist = tolist = ['<td></td><td>&nbsp;Empty File&nbsp;</td>']
-        # if not a change on first line, drop a link
-        if not flaglist[0]:
-            next_href[0] = '<a href="#difflib_chg_%s_0">f</a>' % toprefix
-        # redo the last link to link to the top
-        next_href[last] = '<a href="#difflib_chg_%s_top">t</a>' % (toprefix)
+                fromtext = totext = '<td></td><td>&nbsp;Empty File&nbsp;</td>'
+            last = [0,False,'','',fromtext,totext]
+            window.append(last)
 
-        return fromlist,tolist,flaglist,next_href,next_id
+        # redo the last link to link to the top
+        last[3] = top_link
+        if held is not None:
+            yield from held.release()
+        for row in window:
+            yield render(row)
 
-    def make_table(self,fromlines,tolines,fromdesc='',todesc='',context=False,
+    def iter_table(self,fromlines,tolines,fromdesc='',todesc='',context=False,
                    numlines=5):
-        """Returns HTML table of side by side comparison with change highlights
+        """Yields HTML table of side by side comparison in pieces
 
-        Arguments:
-        fromlines -- list of "from" lines
-        tolines -- list of "to" lines
-        fromdesc -- "from" file column header string
-        todesc -- "to" file column header string
-        context -- set to True for contextual differences (defaults to False
-            which shows full differences).
-        numlines -- number of context lines.  When context is set True,
-            controls number of lines displayed before and after the change.
-            When context is False, controls the number of lines to place
-            the "next" link anchors before the next change (so click of
-            "next" link jumps to just before the change).
+        Takes the same arguments as make_table() and ''.join() of the pieces
+        is the table returned by make_table().  The rows are generated while
+        the lines are compared, so the table is never held in memory as a
+        whole.
         """
 
         # make unique anchor prefixes so that multiple tables may exist
@@ -2013,32 +6175,13 @@ class HtmlDiff(object):
             context_lines = numlines
         else:
             context_lines = None
-        diffs = _mdiff(fromlines,tolines,context_lines,linejunk=self._linejunk,
-                      charjunk=self._charjunk)
+        diffs = side_by_side(fromlines,tolines,context_lines,linejunk=self._linejunk,
+                             charjunk=self._charjunk)
 
         # set up iterator to wrap lines that exceed desired width
         if self._wrapcolumn:
             diffs = self._line_wrapper(diffs)
 
-        # collect up from/to lines and flags into lists (also format the lines)
-        fromlist,tolist,flaglist = self._collect_lines(diffs)
-
-        # process change flags, generating middle column of next anchors/links
-        fromlist,tolist,flaglist,next_href,next_id = self._convert_flags(
-            fromlist,tolist,flaglist,context,numlines)
-
-        s = []
-        fmt = '            <tr><td class="diff_next"%s>%s</td>%s' + \
-              '<td class="diff_next">%s</td>%s</tr>\n'
-        for i in range(len(flaglist)):
-            if flaglist[i] is None:
-                # mdiff yields None on separator lines skip the bogus ones
-                # generated for the first line
-                if i > 0:
-                    s.append('        </tbody>        \n        <tbody>\n')
-            else:
-                s.append( fmt % (next_id[i],next_href[i],fromlist[i],
-                                           next_href[i],tolist[i]))
         if fromdesc or todesc:
             header_row = '<thead><tr>%s%s%s%s</tr></thead>' % (
                 '<th class="diff_next"><br /></th>',
@@ -2048,16 +6191,37 @@ class HtmlDiff(object):
         else:
             header_row = ''
 
-        table = self._table_template % dict(
-            data_rows=''.join(s),
-            header_row=header_row,
-            prefix=self._prefix[1])
+        values = dict(header_row=header_row, prefix=self._prefix[1])
+        rows = self._iter_rows(diffs,context,numlines)
+        head,sep,tail = self._table_template.partition('%(data_rows)s')
+        if not sep:
+            values['data_rows'] = ''.join(rows)
+            yield _replace_markers(self._table_template % values)
+            return
+        yield _replace_markers(head % values)
+        yield from rows
+        yield _replace_markers(tail % values)
 
-        return table.replace('\0+','<span class="diff_add">'). \
-                     replace('\0-','<span class="diff_sub">'). \
-                     replace('\0^','<span class="diff_chg">'). \
-                     replace('\1','</span>'). \
-                     replace('\t','&nbsp;')
+    def make_table(self,fromlines,tolines,fromdesc='',todesc='',context=False,
+                   numlines=5):
+        """Returns HTML table of side by side comparison with change highlights
+
+        Arguments:
+        fromlines -- list of "from" lines
+        tolines -- list of "to" lines
+        fromdesc -- "from" file column header string
+        todesc -- "to" file column header string
+        context -- set to True for contextual differences (defaults to False
+            which shows full differences).
+        numlines -- number of context lines.  When context is set True,
+            controls number of lines displayed before and after the change.
+            When context is False, controls the number of lines to place
+            the "next" link anchors before the next change (so click of
+            "next" link jumps to just before the change).
+        """
+
+        return ''.join(self.iter_table(fromlines,tolines,fromdesc,todesc,
+                                       context=context,numlines=numlines))
 
 del re
 
@@ -2095,3 +6259,180 @@ def restore(delta, which):
     for line in delta:
         if line[:2] in prefixes:
             yield line[2:]
+
+########################################################################
+###  Applying Unified Diffs
+########################################################################
+
+cdef list _split_newlines(text):
+    """Split a document or patch given as one str or bytes object after
+    every newline.  Unlike splitlines() no other line boundaries are used.
+    """
+    cdef Py_ssize_t start = 0, end
+    newline = '\n' if isinstance(text, str) else b'\n'
+    lines = []
+    while True:
+        end = text.find(newline, start)
+        if end < 0:
+            break
+        lines.append(text[start:end + 1])
+        start = end + 1
+    if start < len(text):
+        lines.append(text[start:])
+    return lines
+
+cdef tuple _parse_range_unified(str text, line):
+    'Convert a range in the "ed" format of unified diffs to (start, length)'
+    start, sep, length = text.partition(',')
+    if not sep:
+        length = '1'
+    if not (start.isascii() and start.isdigit() and length.isascii() and length.isdigit()):
+        raise ValueError('invalid hunk header: %r' % (line,))
+    start, length = int(start), int(length)
+    if length:
+        if not start:
+            raise ValueError('invalid hunk header: %r' % (line,))
+        start -= 1
+    return start, length
+
+cdef tuple _parse_hunk_header(line):
+    """Returns the ranges (start1, length1, start2, length2) of a hunk
+    header or None if line is no hunk header"""
+    if isinstance(line, (bytes, bytearray)):
+        if not line.startswith(b'@@ -'):
+            return None
+        text = line.decode('latin-1')
+    elif isinstance(line, str):
+        if not line.startswith('@@ -'):
+            return None
+        text = line
+    else:
+        raise TypeError('patch lines must be str or bytes, not %s (%r)' %
+                        (type(line).__name__, line))
+    end = text.find(' @@', 4)
+    ranges = text[4:end].split(' +')
+    if end < 0 or len(ranges) != 2:
+        raise ValueError('invalid hunk header: %r' % (line,))
+    return _parse_range_unified(ranges[0], line) + _parse_range_unified(ranges[1], line)
+
+cdef inline bint _is_patch_line(patch_line, line):
+    """patch_line is line with a one character prefix"""
+    return len(patch_line) == len(line) + 1 and patch_line.endswith(line)
+
+def _apply_unified_diff(lines, patch, bint reverse):
+    cdef Py_ssize_t pos = 0, nlines, hunks = 0
+    cdef Py_ssize_t start1, length1, start2, length2
+    # lines of the current hunk, which are still expected
+    cdef Py_ssize_t remove = 0, add = 0
+
+    if isinstance(patch, (str, bytes, bytearray)):
+        patch = _split_newlines(patch)
+    if type(lines) is not list:
+        lines = list(lines)
+    nlines = len(lines)
+    result = []
+    space = old = new = None
+
+    for line in patch:
+        if remove or add:
+            tag = line[:1]
+            if tag == space and remove and add:
+                if pos >= nlines or not _is_patch_line(line, lines[pos]):
+                    raise ValueError('hunk %d does not apply at line %d' % (hunks, pos + 1))
+                result.append(lines[pos])
+                pos += 1
+                remove -= 1
+                add -= 1
+            elif tag == old and remove:
+                if pos >= nlines or not _is_patch_line(line, lines[pos]):
+                    raise ValueError('hunk %d does not apply at line %d' % (hunks, pos + 1))
+                pos += 1
+                remove -= 1
+            elif tag == new and add:
+                result.append(line[1:])
+                add -= 1
+            else:
+                raise ValueError('unexpected line in hunk %d: %r' % (hunks, line))
+            continue
+
+        ranges = _parse_hunk_header(line)
+        if ranges is None:
+            # the file names and anything else in front of the first hunk
+            # are skipped
+            if hunks:
+                raise ValueError('expected hunk header after hunk %d: %r' % (hunks, line))
+            continue
+        hunks += 1
+        if space is None:
+            if isinstance(line, str):
+                space, old, new = ' ', '-', '+'
+            else:
+                space, old, new = b' ', b'-', b'+'
+            if lines and isinstance(lines[0], str) != isinstance(line, str):
+                raise TypeError('lines and patch must both be str or bytes')
+            if reverse:
+                old, new = new, old
+
+        start1, length1, start2, length2 = ranges
+        if reverse:
+            start1, length1, start2, length2 = start2, length2, start1, length1
+        # the hunks have to follow each other and both ranges have to be at
+        # the same offset the previous hunks left
+        if (start1 < pos or start1 + length1 > nlines or
+                start2 - start1 != len(result) - pos):
+            raise ValueError('hunk %d does not apply at line %d' % (hunks, start1 + 1))
+        result.extend(lines[pos:start1])
+        pos = start1
+        remove, add = length1, length2
+
+    if remove or add:
+        raise ValueError('hunk %d is incomplete' % hunks)
+    result.extend(lines[pos:])
+    return result
+
+def apply_unified_diff(a, patch):
+    r"""
+    Apply a unified diff to the lines it was created from; return the lines
+    of the other sequence as list.
+
+    `patch` is the output of unified_diff(a, b, ...) as sequence of lines
+    or of format_unified_diff(a, b, ...) as one str or bytes object, which
+    is split after every newline (so it requires lines ending in newlines).
+    Lines in front of the first hunk, like the file names, are skipped.
+
+    The hunks are applied in one pass over `a` and the patch.  They are not
+    searched at other offsets like patch(1) does: every context and removed
+    line has to equal the line of `a` at the position in its hunk header,
+    otherwise a ValueError is raised.
+
+    Example:
+
+    >>> a = 'one\ntwo\nthree\nfour\n'.splitlines(keepends=True)
+    >>> b = 'zero\none\ntree\nfour\n'.splitlines(keepends=True)
+    >>> patch = format_unified_diff(a, b, 'Original', 'Current')
+    >>> apply_unified_diff(a, patch) == b
+    True
+    >>> apply_unified_diff(b, patch)
+    Traceback (most recent call last):
+      ...
+    ValueError: hunk 1 does not apply at line 1
+    """
+    return _apply_unified_diff(a, patch, False)
+
+def revert_unified_diff(b, patch):
+    r"""
+    Revert a unified diff on the lines it produces; return the lines it
+    was created from as list.
+
+    This is the inverse of apply_unified_diff(): the removed lines of the
+    patch are added and the added lines are removed.
+
+    Example:
+
+    >>> a = 'one\ntwo\nthree\nfour\n'.splitlines(keepends=True)
+    >>> b = 'zero\none\ntree\nfour\n'.splitlines(keepends=True)
+    >>> patch = list(unified_diff(a, b))
+    >>> revert_unified_diff(b, patch) == a
+    True
+    """
+    return _apply_unified_diff(b, patch, True)
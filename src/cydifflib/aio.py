@@ -0,0 +1,151 @@
+"""
+asyncio versions of the diff generators of cydifflib.
+
+The functions are async generators, which yield the same lines as their
+counterparts in cydifflib:
+
+    async for line in cydifflib.aio.unified_diff(a, b):
+        await response.write(line.encode())
+
+The search for matching blocks runs in the default executor of the event
+loop, so it does not block the loop, and the output is only formatted when
+the next line is requested.  Cancelling the task or closing the generator
+while the search runs cancels the search as well.
+"""
+
+from __future__ import annotations
+
+import asyncio
+
+from ._initialize import (
+    IS_CHARACTER_JUNK,
+    Differ,
+    SequenceMatcher,
+    _check_types,
+    _context_diff_lines,
+    _hashable_lines,
+    _unified_diff_lines,
+)
+
+__all__ = ["context_diff", "ndiff", "unified_diff"]
+
+# number of lines yielded before the event loop gets control back
+_LINES_PER_STEP = 256
+
+
+async def _run(matcher, func, *args):
+    """Run func(*args) in the default executor, where func searches the
+    matching blocks of matcher.  matcher is cancelled if the caller is.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except BaseException:
+        matcher.cancel()
+        raise
+
+
+def _matcher(isjunk, algorithm, max_cost, timeout):
+    # only searches with a work budget can be cancelled, so a search
+    # without timeout gets one which never runs out
+    return SequenceMatcher(
+        isjunk, algorithm=algorithm, max_cost=max_cost, timeout=float("inf") if timeout is None else timeout
+    )
+
+
+def _grouped_opcodes(matcher, a, b, n):
+    matcher.set_seqs(a, b)
+    matcher.get_opcodes()
+    return matcher.get_grouped_opcodes(n)
+
+
+def _fancy_replace(differ, a, alo, ahi, b, blo, bhi):
+    return list(differ._fancy_replace(a, alo, ahi, b, blo, bhi))
+
+
+async def _iterate(lines):
+    # give the event loop a chance to run while a long output is consumed
+    for count, line in enumerate(lines, 1):
+        yield line
+        if count % _LINES_PER_STEP == 0:
+            await asyncio.sleep(0)
+
+
+async def unified_diff(
+    a,
+    b,
+    fromfile="",
+    tofile="",
+    fromfiledate="",
+    tofiledate="",
+    n=3,
+    lineterm="\n",
+    *,
+    algorithm="gestalt",
+    max_cost=None,
+    timeout=None,
+):
+    """Same as cydifflib.unified_diff(), see the module docstring"""
+    fromfile, tofile, fromfiledate, tofiledate, lineterm = _check_types(
+        a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm
+    )
+    a, b = _hashable_lines(a), _hashable_lines(b)
+    matcher = _matcher(None, algorithm, max_cost, timeout)
+    groups = await _run(matcher, _grouped_opcodes, matcher, a, b, n)
+    async for line in _iterate(_unified_diff_lines(a, b, groups, fromfile, tofile, fromfiledate, tofiledate, lineterm)):
+        yield line
+
+
+async def context_diff(
+    a,
+    b,
+    fromfile="",
+    tofile="",
+    fromfiledate="",
+    tofiledate="",
+    n=3,
+    lineterm="\n",
+    *,
+    algorithm="gestalt",
+    max_cost=None,
+    timeout=None,
+):
+    """Same as cydifflib.context_diff(), see the module docstring"""
+    fromfile, tofile, fromfiledate, tofiledate, lineterm = _check_types(
+        a, b, fromfile, tofile, fromfiledate, tofiledate, lineterm
+    )
+    a, b = _hashable_lines(a), _hashable_lines(b)
+    matcher = _matcher(None, algorithm, max_cost, timeout)
+    groups = await _run(matcher, _grouped_opcodes, matcher, a, b, n)
+    async for line in _iterate(_context_diff_lines(a, b, groups, fromfile, tofile, fromfiledate, tofiledate, lineterm)):
+        yield line
+
+
+async def ndiff(a, b, linejunk=None, charjunk=IS_CHARACTER_JUNK, *, algorithm="gestalt", max_cost=None, timeout=None):
+    """Same as cydifflib.ndiff(), see the module docstring.
+
+    The intraline comparisons of every replaced block run in the executor
+    as well.  They are not interrupted by a cancellation, but no further
+    block is compared afterwards.
+    """
+    differ = Differ(linejunk, charjunk)
+    matcher = _matcher(linejunk, algorithm, max_cost, timeout)
+
+    def get_opcodes():
+        matcher.set_seqs(a, b)
+        return matcher.get_opcodes()
+
+    for tag, alo, ahi, blo, bhi in await _run(matcher, get_opcodes):
+        if tag == "replace":
+            lines = await asyncio.get_running_loop().run_in_executor(
+                None, _fancy_replace, differ, a, alo, ahi, b, blo, bhi
+            )
+        elif tag == "delete":
+            lines = differ._dump("-", a, alo, ahi)
+        elif tag == "insert":
+            lines = differ._dump("+", b, blo, bhi)
+        else:
+            lines = differ._dump(" ", a, alo, ahi)
+        async for line in _iterate(lines):
+            yield line
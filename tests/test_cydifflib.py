@@ -1,11 +1,31 @@
 from __future__ import annotations
 
+import array
+import asyncio
+import copy
 import doctest
+import importlib
+import io
 import os
+import pickle
+import random
 import sys
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import cydifflib
+import cydifflib.aio
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyximport
+except ImportError:
+    pyximport = None
 
 
 class TestWithAscii(unittest.TestCase):
@@ -42,6 +62,39 @@ class TestWithAscii(unittest.TestCase):
         )
         self.assertEqual(sm.bjunk, {" ", "b"})
 
+    def test_b2j(self):
+        sm = cydifflib.SequenceMatcher(isjunk=lambda x: x == " ", a="abc", b="ab c ab")
+        self.assertEqual(sm.b2j, {"a": [0, 5], "b": [1, 6], "c": [3]})
+
+        sm = cydifflib.SequenceMatcher(None, "a", "a" * 40 + "b" * 200)
+        self.assertEqual(sm.bpopular, {"a", "b"})
+        self.assertEqual(sm.b2j, {})
+
+    def test_score_cutoff(self):
+        sm = cydifflib.SequenceMatcher(None, "private Thread currentThread;", "private volatile Thread currentThread;")
+        ratio = sm.ratio()
+        quick_ratio = sm.quick_ratio()
+        for algorithm in ("gestalt", "myers"):
+            sm = cydifflib.SequenceMatcher(None, sm.a, sm.b, algorithm=algorithm)
+            self.assertEqual(sm.ratio(score_cutoff=ratio), ratio)
+            self.assertEqual(sm.ratio(score_cutoff=ratio + 0.01), 0.0)
+            self.assertEqual(sm.ratio(), ratio)
+            self.assertEqual(sm.ratio(score_cutoff=0.99), 0.0)
+        self.assertEqual(sm.quick_ratio(score_cutoff=quick_ratio), quick_ratio)
+        self.assertEqual(sm.quick_ratio(score_cutoff=quick_ratio + 0.01), 0.0)
+
+    def test_quick_ratio(self):
+        sm = cydifflib.SequenceMatcher(None, "abbcx", "bbbca")
+        self.assertEqual(sm.quick_ratio(), 0.8)
+        self.assertEqual(sm.fullbcount, {"b": 3, "c": 1, "a": 1})
+        # more distinct elements than fit the counting array
+        a = list(range(0, 1000, 2)) * 2
+        b = list(range(1000))
+        sm = cydifflib.SequenceMatcher(None, a[:300], b)
+        self.assertEqual(sm.quick_ratio(), 2 * 300 / 1300)
+        sm.set_seq1(a)
+        self.assertEqual(sm.quick_ratio(), 2 * 500 / 2000)
+
 
 class TestAutojunk(unittest.TestCase):
     """Tests for the autojunk parameter added in 2.7"""
@@ -62,6 +115,630 @@ class TestAutojunk(unittest.TestCase):
         self.assertEqual(sm.bpopular, set())
 
 
+class TestSequenceTypes(unittest.TestCase):
+    def test_str(self):
+        for a, b in [("abxcd", "abcd"), ("\u0100bxcd", "\u0100bcd"), ("😀bxcd", "😀bcd")]:
+            sm = cydifflib.SequenceMatcher(None, a, b)
+            self.assertEqual(
+                sm.get_matching_blocks(), cydifflib.SequenceMatcher(None, list(a), list(b)).get_matching_blocks()
+            )
+            self.assertEqual(
+                sm.get_matching_blocks(), cydifflib.SequenceMatcher(None, list(a), b).get_matching_blocks()
+            )
+            self.assertEqual(
+                sm.get_matching_blocks(), cydifflib.SequenceMatcher(None, a, list(b)).get_matching_blocks()
+            )
+
+    def test_str_junk(self):
+        sm = cydifflib.SequenceMatcher(lambda x: x == " ", " abcd", "abcd abcd")
+        self.assertEqual(sm.bjunk, {" "})
+        self.assertEqual(sm.find_longest_match(0, 5, 0, 9), (1, 0, 4))
+
+    def test_bytes(self):
+        a = b"private Thread currentThread;"
+        b = b"private volatile Thread currentThread;"
+        expected = cydifflib.SequenceMatcher(None, list(a), list(b)).get_opcodes()
+        for seq1, seq2 in [(a, b), (bytearray(a), b), (memoryview(a), memoryview(b)), (list(a), b)]:
+            self.assertEqual(cydifflib.SequenceMatcher(None, seq1, seq2).get_opcodes(), expected)
+
+        sm = cydifflib.SequenceMatcher(lambda x: x == ord(" "), a, b)
+        self.assertEqual(sm.bjunk, {ord(" ")})
+
+    def test_integer_buffer(self):
+        a = [1, 5, 2, 7, 7, 3, 1, 2]
+        b = [1, 2, 7, 3, 9, 1, 2, 5]
+        expected = cydifflib.SequenceMatcher(None, a, b).get_opcodes()
+        for typecode in "bBhHiIlLqQ":
+            seq1 = array.array(typecode, a)
+            seq2 = array.array(typecode, b)
+            self.assertEqual(cydifflib.SequenceMatcher(None, seq1, seq2).get_opcodes(), expected)
+            self.assertEqual(cydifflib.SequenceMatcher(None, seq1, b).get_opcodes(), expected)
+            self.assertEqual(cydifflib.SequenceMatcher(None, memoryview(seq1), seq2).get_opcodes(), expected)
+
+        self.assertEqual(cydifflib.SequenceMatcher(None, array.array("q", a), array.array("b", a)).ratio(), 1.0)
+        self.assertEqual(cydifflib.SequenceMatcher(None, array.array("Q", [2**64 - 1]), [-1]).ratio(), 0.0)
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_numpy(self):
+        a = np.array([1, 5, 2, 7, 7, 3, 1, 2], dtype=np.int32)
+        b = np.array([1, 2, 7, 3, 9, 1, 2, 5], dtype=np.int64)
+        expected = cydifflib.SequenceMatcher(None, a.tolist(), b.tolist()).get_opcodes()
+        self.assertEqual(cydifflib.SequenceMatcher(None, a, b).get_opcodes(), expected)
+        self.assertEqual(cydifflib.SequenceMatcher(None, a[::2], b[::2]).ratio(), 0.5)
+
+    def test_mixed_types(self):
+        self.assertEqual(cydifflib.SequenceMatcher(None, "abc", b"abc").ratio(), 0.0)
+        self.assertEqual(cydifflib.SequenceMatcher(None, b"abc", [97, 98, 99]).ratio(), 1.0)
+
+
+class TestResultTypes(unittest.TestCase):
+    def test_matching_blocks(self):
+        blocks = cydifflib.SequenceMatcher(None, "abxcd", "abcd").get_matching_blocks()
+        self.assertIsInstance(blocks, cydifflib.MatchingBlocks)
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual(blocks[-1], cydifflib.Match(5, 4, 0))
+        self.assertEqual(blocks[:2], [(0, 0, 2), (3, 2, 2)])
+        self.assertEqual(blocks, [(0, 0, 2), (3, 2, 2), (5, 4, 0)])
+        self.assertEqual(memoryview(blocks).tolist(), [[0, 0, 2], [3, 2, 2], [5, 4, 0]])
+        self.assertEqual(pickle.loads(pickle.dumps(blocks)), blocks)
+        with self.assertRaises(IndexError):
+            blocks[3]
+
+    def test_opcodes(self):
+        opcodes = cydifflib.SequenceMatcher(None, "qabxcd", "abycdf").get_opcodes()
+        self.assertIsInstance(opcodes, cydifflib.Opcodes)
+        self.assertEqual(opcodes[2], ("replace", 3, 4, 2, 3))
+        view = memoryview(opcodes)
+        self.assertEqual(view.shape, (5, 5))
+        self.assertEqual([cydifflib.Opcodes.tags[row[0]] for row in view.tolist()], [op[0] for op in opcodes])
+        self.assertEqual(pickle.loads(pickle.dumps(opcodes)), opcodes)
+
+    def test_reinit_while_exported(self):
+        blocks = cydifflib.MatchingBlocks([(7, 7, 7)])
+        opcodes = cydifflib.Opcodes([("equal", 0, 1, 0, 1)])
+        with memoryview(blocks) as view, memoryview(opcodes):
+            with self.assertRaises(BufferError):
+                blocks.__init__([(i, i, 1) for i in range(1000)])
+            with self.assertRaises(BufferError):
+                opcodes.__init__()
+            self.assertEqual(view.tolist(), [[7, 7, 7]])
+        blocks.__init__([(1, 2, 3)])
+        self.assertEqual(blocks, [(1, 2, 3)])
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_as_numpy(self):
+        opcodes = cydifflib.SequenceMatcher(None, "qabxcd", "abycdf").get_opcodes()
+        arr = opcodes.as_numpy()
+        self.assertEqual(arr.shape, (5, 5))
+        self.assertEqual(arr[2].tolist(), [0, 3, 4, 2, 3])
+        self.assertEqual(cydifflib.SequenceMatcher(None, "", "").get_matching_blocks().as_numpy().shape, (1, 3))
+
+
+class TestThreads(unittest.TestCase):
+    def test_shared_seq2(self):
+        b = "abcd" * 100 + "x" * 50
+        seqs = ["abxd" * (i + 1) for i in range(64)]
+        expected = [cydifflib.SequenceMatcher(None, a, b).get_matching_blocks() for a in seqs]
+
+        base = cydifflib.SequenceMatcher(None, "", b)
+
+        def run(a):
+            sm = copy.copy(base)
+            sm.set_seq1(a)
+            return sm.get_matching_blocks()
+
+        with ThreadPoolExecutor(8) as executor:
+            self.assertEqual(list(executor.map(run, seqs)), expected)
+        self.assertEqual(base.a, "")
+
+
+class TestReplace(unittest.TestCase):
+    def test_same_as_set_seq(self):
+        rng = random.Random(0)
+        for isjunk, autojunk in [(None, True), (lambda x: x == " ", False)]:
+            a = [rng.choice("abc d") for _ in range(300)]
+            b = [rng.choice("abc d") for _ in range(300)]
+            sm = cydifflib.SequenceMatcher(isjunk, a, b, autojunk)
+            shared = copy.copy(sm)
+            sm.get_matching_blocks()
+            for _ in range(40):
+                lo = rng.randrange(len(sm.b))
+                hi = lo + rng.randrange(3)
+                items = [rng.choice("abc dx") for _ in range(rng.randrange(3))]
+                if rng.random() < 0.5:
+                    sm.replace_a(lo, min(hi, len(sm.a)), items)
+                else:
+                    sm.replace_b(lo, hi, items)
+                expected = cydifflib.SequenceMatcher(isjunk, sm.a, sm.b, autojunk)
+                self.assertEqual(sm.get_matching_blocks(), expected.get_matching_blocks())
+                self.assertEqual((sm.bjunk, sm.bpopular), (expected.bjunk, expected.bpopular))
+                self.assertEqual(sm.b2j, expected.b2j)
+                self.assertEqual(sm.fullbcount, expected.fullbcount)
+            # copies sharing the index are not affected
+            self.assertEqual(shared.b, b)
+            self.assertEqual(shared.get_opcodes(), cydifflib.SequenceMatcher(isjunk, a, b, autojunk).get_opcodes())
+
+    def test_sibling_edits(self):
+        # indexes derived from the same index share their elements
+        sm = cydifflib.SequenceMatcher(None, ["a", "b", "c"], ["a", "b", "c"])
+        other = copy.copy(sm)
+        sm.get_opcodes()
+        other.get_opcodes()
+        sm.replace_b(1, 2, ["x"])
+        other.replace_b(1, 2, ["y"])
+        sm.replace_a(0, 1, ["y", "x"])
+        other.replace_a(0, 1, ["y", "x"])
+        for matcher in [sm, other]:
+            expected = cydifflib.SequenceMatcher(None, matcher.a, matcher.b)
+            self.assertEqual(matcher.get_opcodes(), expected.get_opcodes())
+            self.assertEqual(matcher.b2j, expected.b2j)
+            self.assertEqual(matcher.fullbcount, expected.fullbcount)
+
+    def test_sequence_types(self):
+        sm = cydifflib.SequenceMatcher(None, "abxcd", b"abcd")
+        sm.replace_a(2, 3, "")
+        sm.replace_b(0, 0, b"ab")
+        self.assertEqual((sm.a, sm.b), ("abcd", b"ababcd"))
+        self.assertEqual(sm.ratio(), 0.0)
+        sm = cydifflib.SequenceMatcher(None, (1, 2, 3), array.array("i", [1, 2, 3]))
+        sm.replace_a(1, 2, (5,))
+        sm.replace_b(1, 2, array.array("i", [5]))
+        self.assertEqual(sm.ratio(), 1.0)
+        with self.assertRaises(IndexError):
+            sm.replace_b(2, 4, array.array("i"))
+        with self.assertRaises(TypeError):
+            sm.replace_a(0, 0, [1])
+        sm = cydifflib.SequenceMatcher(None, memoryview(b"ab"), "")
+        with self.assertRaises(TypeError):
+            sm.replace_a(0, 0, b"")
+
+
+class TestPreparedSequence(unittest.TestCase):
+    def test_same_as_sequence(self):
+        a = "private Thread currentThread;" * 10
+        for b in [
+            "private volatile Thread currentThread;" * 10,
+            b"abcab" * 50,
+            ["a", 1, ("b",)] * 80,
+            array.array("q", [1, -2, 2**40] * 80),
+            "",
+        ]:
+            prepared = cydifflib.PreparedSequence(b)
+            self.assertEqual(len(prepared), len(b))
+            expected = cydifflib.SequenceMatcher(None, a, b)
+            sm = cydifflib.SequenceMatcher(None, a, prepared)
+            self.assertIs(sm.b, b)
+            self.assertEqual(sm.get_opcodes(), expected.get_opcodes())
+            self.assertEqual((sm.bjunk, sm.bpopular), (expected.bjunk, expected.bpopular))
+            self.assertEqual(sm.b2j, expected.b2j)
+
+    def test_pickle(self):
+        a = "abxcd" * 50
+        for b, isjunk in [
+            ("abcd" * 60, lambda x: x == "c"),
+            (b"abcd" * 60, None),
+            (list("abcd" * 60), None),
+            (array.array("i", [1, 2] * 9), None),
+        ]:
+            prepared = cydifflib.PreparedSequence(b, isjunk)
+            expected = cydifflib.SequenceMatcher(None, a, prepared)
+            for proto in range(pickle.HIGHEST_PROTOCOL + 1):
+                restored = pickle.loads(pickle.dumps(prepared, proto))
+                sm = cydifflib.SequenceMatcher(None, a, restored)
+                self.assertEqual(sm.get_opcodes(), expected.get_opcodes())
+                self.assertEqual((sm.bjunk, sm.bpopular), (expected.bjunk, expected.bpopular))
+                self.assertEqual(sm.fullbcount, expected.fullbcount)
+            buffers = []
+            data = pickle.dumps(prepared, 5, buffer_callback=buffers.append)
+            self.assertEqual(len(buffers), 1)
+            # unaligned buffers are copied
+            raw = bytearray(1) + buffers[0].raw()
+            restored = pickle.loads(data, buffers=[memoryview(raw)[1:]])
+            sm = cydifflib.SequenceMatcher(None, a, restored)
+            sm.replace_b(0, 2, b[:1])
+            expected.replace_b(0, 2, b[:1])
+            self.assertEqual(sm.get_opcodes(), expected.get_opcodes())
+        with self.assertRaises(ValueError):
+            pickle.loads(data, buffers=[b"abc"])
+
+    def test_replace_keeps_junk_rules(self):
+        # edits use isjunk and autojunk of the prepared sequence, not the ones of the matcher
+        a = "ab zcd" * 60
+        for b, isjunk, autojunk in [("ab cd", lambda x: x in " z", True), ("x" * 300 + "y", None, False)]:
+            sm = cydifflib.SequenceMatcher(None, a, cydifflib.PreparedSequence(b, isjunk, autojunk))
+            sm.get_opcodes()
+            for lo, hi, items in [(2, 3, "z"), (0, 1, "x"), (1, 1, "q" * 5)]:
+                sm.replace_b(lo, hi, items)
+                expected = cydifflib.SequenceMatcher(isjunk, a, sm.b, autojunk)
+                self.assertEqual((sm.bjunk, sm.bpopular), (expected.bjunk, expected.bpopular))
+                self.assertEqual(sm.get_opcodes(), expected.get_opcodes())
+            # unpickled indexes don't know isjunk, so they can't judge new elements
+            restored = pickle.loads(pickle.dumps(cydifflib.PreparedSequence(b, isjunk, autojunk)))
+            sm = cydifflib.SequenceMatcher(None, a, restored)
+            sm.replace_b(0, 1, b[1])
+            if isjunk is None:
+                sm.replace_b(0, 1, "w")
+                self.assertEqual(sm.bpopular, cydifflib.SequenceMatcher(None, a, sm.b, autojunk).bpopular)
+            else:
+                with self.assertRaises(ValueError):
+                    sm.replace_b(0, 1, "w")
+
+
+class TestAlgorithms(unittest.TestCase):
+    a = ["a\n", "b\n", "c\n", "a\n", "b\n", "b\n", "a\n"]
+    b = ["c\n", "b\n", "a\n", "b\n", "a\n", "c\n"]
+
+    def check_opcodes(self, a, b, opcodes):
+        self.assertEqual((opcodes[0][1], opcodes[0][3]), (0, 0))
+        self.assertEqual((opcodes[-1][2], opcodes[-1][4]), (len(a), len(b)))
+        for (_, _, i2, _, j2), (_, i1, _, j1, _) in zip(opcodes, opcodes[1:]):
+            self.assertEqual((i2, j2), (i1, j1))
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                self.assertEqual(a[i1:i2], b[j1:j2])
+
+    def test_myers(self):
+        sm = cydifflib.SequenceMatcher(None, self.a, self.b, algorithm="myers")
+        self.assertEqual(sm.algorithm, "myers")
+        self.check_opcodes(self.a, self.b, sm.get_opcodes())
+        # Myers finds a longest common subsequence
+        self.assertEqual(sum(block.size for block in sm.get_matching_blocks()), 4)
+
+    def test_histogram(self):
+        a = "abcabba" * 20 + "xyz" * 5
+        b = "cbabac" * 20 + "xyz" * 5
+        sm = cydifflib.SequenceMatcher(None, a, b, algorithm="histogram")
+        self.check_opcodes(a, b, sm.get_opcodes())
+        self.assertEqual(cydifflib.SequenceMatcher(None, "abc", "abc", algorithm="histogram").ratio(), 1.0)
+
+    def test_diff_functions(self):
+        for algorithm in ("myers", "histogram"):
+            diff = list(cydifflib.unified_diff(self.a, self.b, algorithm=algorithm))
+            self.assertEqual(diff[:3], ["--- \n", "+++ \n", "@@ -1,7 +1,6 @@\n"])
+            self.assertTrue(list(cydifflib.context_diff(self.a, self.b, algorithm=algorithm)))
+            self.assertEqual(list(cydifflib.restore(cydifflib.ndiff(self.a, self.b, algorithm=algorithm), 2)), self.b)
+
+    def test_invalid_algorithm(self):
+        with self.assertRaises(ValueError):
+            cydifflib.SequenceMatcher(None, "a", "b", algorithm="patience")
+        with self.assertRaises(ValueError):
+            cydifflib.Differ(algorithm="patience")
+
+    def test_budget(self):
+        # repeated tokens make the search for the longest match quadratic
+        a = "aab" * 60
+        b = "abb" * 60
+        for algorithm in ("gestalt", "myers", "histogram"):
+            full = cydifflib.SequenceMatcher(None, a, b, False, algorithm=algorithm).get_opcodes()
+            self.assertFalse(full.budget_exceeded)
+            sm = cydifflib.SequenceMatcher(None, a, b, False, algorithm=algorithm, max_cost=100)
+            self.assertEqual(sm.max_cost, 100)
+            opcodes = sm.get_opcodes()
+            self.assertTrue(opcodes.budget_exceeded)
+            self.assertTrue(sm.get_matching_blocks().budget_exceeded)
+            self.check_opcodes(a, b, opcodes)
+            self.assertLessEqual(sm.ratio(), cydifflib.SequenceMatcher(None, a, b, False).ratio())
+            sm = cydifflib.SequenceMatcher(None, a, b, False, algorithm=algorithm, max_cost=10**9, timeout=60)
+            self.assertEqual(sm.get_opcodes(), full)
+            self.assertFalse(sm.get_opcodes().budget_exceeded)
+        self.assertTrue(pickle.loads(pickle.dumps(opcodes)).budget_exceeded)
+        diff = list(cydifflib.ndiff(self.a, self.b, max_cost=0))
+        self.assertEqual(list(cydifflib.restore(diff, 2)), self.b)
+
+    def test_invalid_budget(self):
+        with self.assertRaises(ValueError):
+            cydifflib.SequenceMatcher(None, "a", "b", max_cost=-1)
+        with self.assertRaises(ValueError):
+            cydifflib.SequenceMatcher(None, "a", "b", timeout=-1.0)
+        with self.assertRaises(ValueError):
+            cydifflib.Differ(timeout=float("nan"))
+
+
+class TestStats(unittest.TestCase):
+    def tearDown(self):
+        cydifflib.disable_stats()
+
+    def test_records(self):
+        self.assertIsNone(cydifflib.get_stats())
+        records = []
+        cydifflib.enable_stats(records.append)
+        a = ["x\n"] * 250 + ["y\n", " \n"]
+        b = ["x\n"] * 250 + ["z\n", " \n"]
+        sm = cydifflib.SequenceMatcher(lambda x: x == " \n", a, b)
+        sm.get_opcodes()
+        cydifflib.SequenceMatcher(None, "abxcd", "abcd", algorithm="myers").ratio()
+        self.assertEqual([record["event"] for record in records], ["index", "match", "index", "match"])
+        self.assertEqual(records[0]["junk"], 1)
+        self.assertEqual(records[0]["popular"], 250)
+        self.assertEqual(records[1]["la"], len(a))
+        self.assertGreater(records[1]["find_longest_match_calls"], 0)
+        self.assertEqual(records[3]["algorithm"], "myers")
+        self.assertEqual(records[3]["find_longest_match_calls"], 0)
+
+        stats = cydifflib.get_stats()
+        self.assertEqual((stats["index_calls"], stats["match_calls"]), (2, 2))
+        self.assertEqual(stats["candidates"], records[1]["candidates"])
+        cydifflib.reset_stats()
+        self.assertEqual(cydifflib.get_stats()["match_calls"], 0)
+        # the cutoff search of ratio is recorded as well
+        cydifflib.SequenceMatcher(None, "abxcd", "abcd").ratio(score_cutoff=0.5)
+        self.assertEqual(cydifflib.get_stats()["find_longest_match_calls"], 2)
+        cydifflib.disable_stats()
+        cydifflib.SequenceMatcher(None, "abxcd", "abcd").ratio()
+        self.assertEqual(len(records), 6)
+        self.assertIsNone(cydifflib.get_stats())
+
+
+class TestIntralineCache(unittest.TestCase):
+    def tearDown(self):
+        cydifflib.set_intraline_cache_size(0)
+        cydifflib.intraline_cache_clear()
+
+    def test_same_results(self):
+        rng = random.Random(0)
+        a = ["".join(rng.choice("abc  ") for _ in range(30)) + "\n" for _ in range(40)]
+        b = ["".join(c if rng.random() < 0.9 else "x" for c in line) for line in a]
+        expected = list(cydifflib.ndiff(a, b))
+        expected_sbs = list(cydifflib.side_by_side(a, b))
+        cydifflib.set_intraline_cache_size(10000)
+        self.assertEqual(list(cydifflib.ndiff(a, b)), expected)
+        info = cydifflib.intraline_cache_info()
+        self.assertGreater(info.misses, 0)
+        self.assertEqual(info.maxsize, 10000)
+        self.assertEqual(list(cydifflib.side_by_side(a, b)), expected_sbs)
+        self.assertEqual(list(cydifflib.Differ(charjunk=cydifflib.IS_CHARACTER_JUNK).compare(a, b)), expected)
+        self.assertGreater(cydifflib.intraline_cache_info().hits, info.hits)
+
+        cydifflib.set_intraline_cache_size(5)
+        self.assertEqual(cydifflib.intraline_cache_info().currsize, 5)
+        self.assertEqual(list(cydifflib.ndiff(a, b)), expected)
+        self.assertLessEqual(cydifflib.intraline_cache_info().currsize, 5)
+        cydifflib.intraline_cache_clear()
+        self.assertEqual(cydifflib.intraline_cache_info(), (0, 0, 5, 0))
+        with self.assertRaises(ValueError):
+            cydifflib.set_intraline_cache_size(-1)
+
+
+class TestCApi(unittest.TestCase):
+    consumer = """
+# distutils: language=c++
+from libc.stdint cimport int64_t
+from libcpp.vector cimport vector
+from cydifflib cimport CMatch, COpcode, DiffIndex, diff_index_new, diff_index_free
+from cydifflib cimport diff_matching_blocks, diff_opcodes, diff_ratio
+
+def compare(list a_, list b_, Py_ssize_t size):
+    cdef vector[int64_t] a = a_
+    cdef vector[int64_t] b = b_
+    cdef vector[CMatch] blocks = vector[CMatch](max(size, 0))
+    cdef vector[COpcode] opcodes = vector[COpcode](max(size, 0))
+    cdef DiffIndex* index = diff_index_new(b.data(), b.size(), NULL, NULL, True)
+    try:
+        nblocks = diff_matching_blocks(index, a.data(), a.size(), blocks.data(), size)
+        nopcodes = diff_opcodes(index, a.data(), a.size(), opcodes.data(), size)
+        ratio = diff_ratio(index, a.data(), a.size(), 0.0)
+    finally:
+        diff_index_free(index)
+    return (nblocks, [(blocks[i].a, blocks[i].b, blocks[i].size) for i in range(min(size, nblocks))],
+            nopcodes, [(opcodes[i].tag, opcodes[i].i1, opcodes[i].i2, opcodes[i].j1, opcodes[i].j2)
+                       for i in range(min(size, nopcodes))], ratio)
+"""
+
+    def test_exported(self):
+        # the functions of cydifflib/__init__.pxd are exported by the extension
+        capi = cydifflib._initialize.__pyx_capi__
+        for name in ("diff_index_new", "diff_index_free", "diff_matching_blocks", "diff_opcodes", "diff_ratio"):
+            self.assertIn(name, capi)
+
+    @unittest.skipIf(pyximport is None, "Cython not installed")
+    def test_cimport(self):
+        a = [1, 2, 9, 4, 5]
+        b = [1, 2, 3, 4, 5]
+        expected = cydifflib.SequenceMatcher(None, a, b)
+        blocks = [tuple(m) for m in expected.get_matching_blocks()]
+        opcodes = [(cydifflib.Opcodes.tags.index(tag), *rest) for tag, *rest in expected.get_opcodes()]
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "capi_consumer.pyx"), "w") as f:
+                f.write(self.consumer)
+            importers = pyximport.install(build_dir=tmp, language_level=3)
+            sys.path.insert(0, tmp)
+            try:
+                consumer = importlib.import_module("capi_consumer")
+            finally:
+                sys.path.remove(tmp)
+                pyximport.uninstall(*importers)
+                sys.modules.pop("capi_consumer", None)
+            self.assertEqual(consumer.compare(a, b, 10), (3, blocks, 3, opcodes, expected.ratio()))
+            # results which don't fit are only counted
+            self.assertEqual(consumer.compare(a, b, 1), (3, blocks[:1], 3, opcodes[:1], expected.ratio()))
+            with self.assertRaises(ValueError):
+                consumer.compare(a, b, -1)
+
+
+class TestCloseMatcher(unittest.TestCase):
+    possibilities = ["ape", "apple", "peach", "puppy", "appel", "apply", "", "a" * 250]
+
+    def test_same_as_get_close_matches(self):
+        matcher = cydifflib.CloseMatcher(self.possibilities)
+        self.assertEqual(len(matcher), len(self.possibilities))
+        for word in ["appel", "ape", "", "pea", "xyz", "a" * 240]:
+            for n in (1, 3, 10):
+                for cutoff in (0.0, 0.6, 1.0):
+                    self.assertEqual(
+                        matcher.get_close_matches(word, n, cutoff),
+                        cydifflib.get_close_matches(word, self.possibilities, n, cutoff),
+                    )
+
+    def test_random_words(self):
+        rng = random.Random(7)
+        words = ["".join(rng.choices("abcdefghij", k=rng.randrange(1, 9))) for _ in range(2000)]
+        matcher = cydifflib.CloseMatcher(words)
+        for word in rng.sample(words, 10) + ["".join(rng.choices("abcdefghijk", k=6)) for _ in range(10)]:
+            for cutoff in (0.3, 0.6, 0.8):
+                self.assertEqual(
+                    matcher.get_close_matches(word, 5, cutoff), cydifflib.get_close_matches(word, words, 5, cutoff)
+                )
+
+    def test_invalid_arguments(self):
+        matcher = cydifflib.CloseMatcher(self.possibilities)
+        with self.assertRaises(ValueError):
+            matcher.get_close_matches("ape", n=0)
+        with self.assertRaises(ValueError):
+            matcher.get_close_matches("ape", cutoff=1.5)
+
+
+@unittest.skipIf(np is None, "numpy not installed")
+class TestCdist(unittest.TestCase):
+    queries = ["abcd", "bcde", "", "x" * 250, list("abce")]
+    choices = ["bcde", "xyz", "", "ab" * 150]
+
+    def expected(self, scorer, score_cutoff=0.0):
+        result = np.zeros((len(self.queries), len(self.choices)))
+        for i, query in enumerate(self.queries):
+            for j, choice in enumerate(self.choices):
+                score = getattr(cydifflib.SequenceMatcher(None, query, choice), scorer)()
+                result[i, j] = score if score >= score_cutoff else 0.0
+        return result
+
+    def test_scorers(self):
+        for scorer in ("ratio", "quick_ratio", "real_quick_ratio"):
+            for score_cutoff in (None, 0.5):
+                for workers in (1, 2):
+                    result = cydifflib.cdist(
+                        self.queries, self.choices, scorer=scorer, score_cutoff=score_cutoff, workers=workers
+                    )
+                    self.assertEqual(result.dtype, np.float64)
+                    self.assertEqual(result.tolist(), self.expected(scorer, score_cutoff or 0.0).tolist())
+
+    def test_dtype(self):
+        result = cydifflib.cdist(self.queries, self.choices, dtype=np.float32)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertEqual(result.tolist(), self.expected("ratio").astype(np.float32).tolist())
+        self.assertEqual(cydifflib.cdist([], self.choices).shape, (0, 4))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            cydifflib.cdist(self.queries, self.choices, scorer="partial_ratio")
+        with self.assertRaises(ValueError):
+            cydifflib.cdist(self.queries, self.choices, score_cutoff=2.0)
+        with self.assertRaises(ValueError):
+            cydifflib.cdist(self.queries, self.choices, dtype=np.int32)
+        with self.assertRaises(ValueError):
+            cydifflib.cdist(self.queries, self.choices, workers=0)
+
+
+class TestDiffMany(unittest.TestCase):
+    pairs = [
+        ("one\ntwo\nthree\n", "one\n2\nthree\n"),
+        (["a\n", "b\n"] * 30, ["a\n", "c\n"] * 20),
+        ("same\n", "same\n"),
+        (b"x\ny\n", b"x\nz\n", b"old", b"new"),
+        ([b"same\n"], [b"same\n"]),
+        ("page\x0cbreak\x85\n", "page\x0cbreak\x85!\n"),
+    ] * 3
+
+    @staticmethod
+    def split(doc):
+        # documents are only split after newlines
+        if isinstance(doc, str):
+            return io.StringIO(doc, newline="").readlines()
+        if isinstance(doc, bytes):
+            return io.BytesIO(doc).readlines()
+        return doc
+
+    def test_kinds(self):
+        for workers in (1, 2):
+            result = cydifflib.diff_many(self.pairs, workers=workers, chunksize=2, n=1)
+            for pair, diff in zip(self.pairs, result):
+                a, b = self.split(pair[0]), self.split(pair[1])
+                names = dict(zip(("fromfile", "tofile"), pair[2:]))
+                empty = b"" if isinstance((a + b)[0], bytes) else ""
+                self.assertIs(type(diff), type(empty))
+                self.assertEqual(diff, empty.join(cydifflib.unified_diff(a, b, n=1, **names)))
+            self.assertEqual(result[-1].count("\n"), 5)
+            result = cydifflib.diff_many(self.pairs, "opcodes", workers=workers, algorithm="myers")
+            expected = [
+                cydifflib.SequenceMatcher(None, a, b, algorithm="myers").get_opcodes() for a, b, *_ in self.pairs
+            ]
+            self.assertEqual(result, expected)
+            self.assertIsInstance(result[0], cydifflib.Opcodes)
+            result = cydifflib.diff_many(self.pairs, "ratio", workers=workers, as_completed=True)
+            expected = [cydifflib.SequenceMatcher(None, a, b).ratio() for a, b, *_ in self.pairs]
+            self.assertEqual(sorted(result), list(enumerate(expected)))
+        self.assertEqual(cydifflib.diff_many([]), [])
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            cydifflib.diff_many(self.pairs, "ndiff")
+        with self.assertRaises(ValueError):
+            cydifflib.diff_many(self.pairs, workers=0)
+        with self.assertRaises(ValueError):
+            cydifflib.diff_many(self.pairs, chunksize=0)
+
+
+class TestAio(unittest.TestCase):
+    a = ["one\n", "two\n", "three\n", "four\n"] * 200
+    b = ["one\n", "2\n", "three\n", "four\n", "five\n"] * 180
+
+    @staticmethod
+    async def collect_async(gen):
+        return [line async for line in gen]
+
+    def collect(self, gen):
+        return asyncio.run(self.collect_async(gen))
+
+    def test_same_output(self):
+        self.assertEqual(
+            self.collect(cydifflib.aio.unified_diff(self.a, self.b, "a", "b", n=1)),
+            list(cydifflib.unified_diff(self.a, self.b, "a", "b", n=1)),
+        )
+        self.assertEqual(
+            self.collect(cydifflib.aio.context_diff(self.a, self.b, algorithm="myers")),
+            list(cydifflib.context_diff(self.a, self.b, algorithm="myers")),
+        )
+        a = ["abcDefghiJkl\n", "same\n", "x\n"]
+        b = ["abcdefGhijkl\n", "same\n", "y\n", "z\n"]
+        self.assertEqual(self.collect(cydifflib.aio.ndiff(a, b)), list(cydifflib.ndiff(a, b)))
+        a, b = [b"x\n", b"y\n"], [b"x\n", b"z\n"]
+        self.assertEqual(
+            self.collect(cydifflib.aio.unified_diff(a, b, b"a", b"b")), list(cydifflib.unified_diff(a, b, b"a", b"b"))
+        )
+        with self.assertRaises(TypeError):
+            self.collect(cydifflib.aio.unified_diff(a, b, "a", 1))
+
+    def test_cancel(self):
+        rng = random.Random(24)
+        a = [rng.choice("ab") for _ in range(100000)]
+        b = [rng.choice("ab") for _ in range(100000)]
+
+        async def main():
+            task = asyncio.ensure_future(self.collect_async(cydifflib.aio.unified_diff(a, b, algorithm="myers")))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+
+    def test_matcher_cancel(self):
+        rng = random.Random(24)
+        a = [rng.choice("ab") for _ in range(20000)]
+        b = [rng.choice("ab") for _ in range(20000)]
+        sm = cydifflib.SequenceMatcher(None, a, b, algorithm="myers", timeout=float("inf"))
+        sm.cancel()
+        self.assertTrue(sm.get_matching_blocks().budget_exceeded)
+        # later searches stay cancelled until a sequence changes
+        self.assertTrue(sm.get_matching_blocks().budget_exceeded)
+        sm.replace_a(0, 1, [])
+        self.assertFalse(sm.get_matching_blocks().budget_exceeded)
+        sm.cancel()
+        sm.replace_b(0, 1, [])
+        self.assertFalse(sm.get_matching_blocks().budget_exceeded)
+        sm.cancel()
+        sm.set_seq2(b[:100])
+        self.assertFalse(sm.get_matching_blocks().budget_exceeded)
+
+
 class TestSFbugs(unittest.TestCase):
     def test_ratio_for_null_seqn(self):
         # Check clearing of SF bug 763023
@@ -103,12 +780,43 @@ class TestSFbugs(unittest.TestCase):
         self.assertEqual("+ \t \t \t^\n", diff[1])
         self.assertEqual("? \t \t \t +\n", diff[2])
 
-    # def test_mdiff_catch_stop_iteration(self):
-    #    # Issue #33224
-    #    self.assertEqual(
-    #        list(cydifflib._mdiff(["2"], ["3"], 1)),
-    #        [((1, '\x00-2\x01'), (1, '\x00+3\x01'), True)],
-    #    )
+    def test_fancy_replace_native_search(self):
+        # str lines are compared in C, other lines by the Python loop
+        class Line(str):
+            pass
+
+        a = ["abcDefghiJkl\n", "same line\n", "x" * 70 + "\n", "unrelated\n", "private Thread currentThread;\n"]
+        b = ["abcdefGhijkl\n", "y" * 3 + "x" * 70 + "\n", "same line\n", "private volatile Thread currentThread;\n"]
+        expected = list(cydifflib.Differ().compare([Line(x) for x in a], [Line(x) for x in b]))
+        self.assertEqual(list(cydifflib.Differ().compare(a, b)), expected)
+        self.assertEqual(
+            list(cydifflib.Differ(charjunk=cydifflib.IS_CHARACTER_JUNK).compare(a, b)),
+            list(
+                cydifflib.Differ(charjunk=cydifflib.IS_CHARACTER_JUNK).compare(
+                    [Line(x) for x in a], [Line(x) for x in b]
+                )
+            ),
+        )
+
+    def test_mdiff_catch_stop_iteration(self):
+        # Issue #33224
+        self.assertEqual(
+            list(cydifflib.side_by_side(["2"], ["3"], 1)),
+            [((1, "\x00-2\x01"), (1, "\x00+3\x01"), True)],
+        )
+
+    def test_side_by_side(self):
+        a = ["one\n", "two\n", "three\n", "same\n", "four\n"]
+        b = ["ore\n", "tree\n", "emu\n", "same\n"]
+        changes = [
+            ((1, "o\x00^n\x01e\n"), (1, "o\x00^r\x01e\n"), True),
+            ((2, "\x00-two\n\x01"), ("", "\n"), True),
+            ((3, "t\x00-h\x01ree\n"), (2, "tree\n"), True),
+            (("", "\n"), (3, "\x00+emu\n\x01"), True),
+        ]
+        last = ((5, "\x00-four\n\x01"), ("", "\n"), True)
+        self.assertEqual(list(cydifflib.side_by_side(a, b)), [*changes, ((4, "same\n"), (4, "same\n"), False), last])
+        self.assertEqual(list(cydifflib.side_by_side(a, b, 0)), [*changes, (None, None, None), last])
 
     def test_issue3(self):
         a = "计算:[小题]根号81+-273+-3分之22;[小题]-273+根号9-4分之1×根号0.16."
@@ -281,6 +989,30 @@ class TestSFpatches(unittest.TestCase):
         self.assertIn('content="text/html; charset=us-ascii"', output)
         self.assertIn("&#305;mpl&#305;c&#305;t", output)
 
+    def test_iter_table(self):
+        f = (patch914575_from1 + "123\n" * 10) * 3
+        t = (patch914575_to1 + "123\n" * 10) * 3
+        for args in [(f.splitlines(), t.splitlines()), ([], [])]:
+            for context in (False, True):
+                html_diff = cydifflib.HtmlDiff(wrapcolumn=14)
+                cydifflib.HtmlDiff._default_prefix = 0
+                expected = html_diff.make_table(*args, "from", "to", context=context, numlines=2)
+                cydifflib.HtmlDiff._default_prefix = 0
+                pieces = list(html_diff.iter_table(*args, "from", "to", context=context, numlines=2))
+                self.assertGreater(len(pieces), 1)
+                self.assertEqual("".join(pieces), expected)
+
+    def test_write_file(self):
+        f = patch914575_nonascii_from1.splitlines() * 50
+        t = patch914575_nonascii_to1.splitlines() * 50
+        html_diff = cydifflib.HtmlDiff()
+        cydifflib.HtmlDiff._default_prefix = 0
+        expected = html_diff.make_file(f, t, context=True, charset="us-ascii")
+        cydifflib.HtmlDiff._default_prefix = 0
+        fp = io.StringIO()
+        html_diff.write_file(fp, f, t, context=True, charset="us-ascii")
+        self.assertEqual(fp.getvalue(), expected)
+
 
 class TestOutputFormat(unittest.TestCase):
     def test_tab_delimiter(self):
@@ -340,6 +1072,128 @@ class TestOutputFormat(unittest.TestCase):
     #    self.assertEqual(fmt(0,0), '0')
 
 
+class TestPatches(unittest.TestCase):
+    a = ["a\n", "b\n", "c\n", "d\n", "e\n", "f\n", "g\n", "h\n", "i\n"]
+    b = ["a\n", "B\n", "c\n", "d\n", "e\n", "f\n", "g\n", "H\n", "i\n", "€\n"]
+
+    def test_format_same_as_generators(self):
+        rng = random.Random(25)
+        for _ in range(50):
+            a = rng.choices(["x\n", "y\n", "\xe9\n", "\U0001f600\n", "z"], k=rng.randrange(30))
+            b = rng.choices(["x\n", "y\n", "\xe9\n", "\U0001f600\n", "z"], k=rng.randrange(30))
+            for lineterm in ("\n", ""):
+                args = (a, b, "a", "b", "date", "", rng.randrange(4), lineterm)
+                self.assertEqual(cydifflib.format_unified_diff(*args), "".join(cydifflib.unified_diff(*args)))
+                self.assertEqual(cydifflib.format_context_diff(*args), "".join(cydifflib.context_diff(*args)))
+            a = [line.encode() for line in a]
+            b = [line.encode() for line in b]
+            self.assertEqual(cydifflib.format_unified_diff(a, b), b"".join(cydifflib.unified_diff(a, b)))
+            self.assertEqual(cydifflib.format_context_diff(a, b), b"".join(cydifflib.context_diff(a, b)))
+
+    def test_format_to_file(self):
+        file = io.StringIO()
+        self.assertIsNone(cydifflib.format_unified_diff(self.a, self.b, n=1, file=file))
+        self.assertEqual(file.getvalue(), "".join(cydifflib.unified_diff(self.a, self.b, n=1)))
+
+        class Writer:
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, chunk):
+                self.chunks.append(chunk)
+
+        writer = Writer()
+        cydifflib.format_context_diff(self.a, self.b, n=1, file=writer)
+        self.assertEqual(len(writer.chunks), 2)
+        self.assertEqual("".join(writer.chunks), "".join(cydifflib.context_diff(self.a, self.b, n=1)))
+        with self.assertRaises(TypeError):
+            cydifflib.format_unified_diff(["a\n", 1], ["b\n"])
+
+    def test_apply(self):
+        for n in range(4):
+            patch = cydifflib.format_unified_diff(self.a, self.b, n=n)
+            self.assertEqual(cydifflib.apply_unified_diff(self.a, patch), self.b)
+            self.assertEqual(cydifflib.revert_unified_diff(self.b, patch), self.a)
+            patch = list(cydifflib.unified_diff(self.a[:-1] + ["i"], self.b, n=n, lineterm=""))
+            self.assertEqual(cydifflib.apply_unified_diff(self.a[:-1] + ["i"], patch), self.b)
+            self.assertEqual(cydifflib.revert_unified_diff(self.b, patch), self.a[:-1] + ["i"])
+        a = [line.encode() for line in self.a]
+        b = [line.encode() for line in self.b]
+        patch = cydifflib.format_unified_diff(a, b, "a", "b")
+        self.assertEqual(cydifflib.apply_unified_diff(a, patch), b)
+        self.assertEqual(cydifflib.revert_unified_diff(b, patch), a)
+        self.assertEqual(cydifflib.apply_unified_diff(self.a, []), self.a)
+        self.assertEqual(cydifflib.apply_unified_diff([], cydifflib.format_unified_diff([], self.b)), self.b)
+
+    def test_reject(self):
+        patch = list(cydifflib.unified_diff(self.a, self.b, n=1))
+        invalid = [
+            (self.a[1:], patch),
+            (self.a[:5], patch),
+            (self.b, patch),
+            (self.a, patch[:-1]),
+            (self.a, patch[:3] + ["?a\n"] + patch[4:]),
+            (self.a, patch[:2] + ["@@ -x +1 @@\n"] + patch[3:]),
+            (self.a, patch + ["junk\n"]),
+            (self.a, patch[:2] + patch[7:] + patch[2:7]),
+        ]
+        for a, patch_lines in invalid:
+            with self.assertRaises(ValueError):
+                cydifflib.apply_unified_diff(a, patch_lines)
+        with self.assertRaises(TypeError):
+            cydifflib.apply_unified_diff([line.encode() for line in self.a], patch)
+
+
+class TestDiffFiles(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path_a = os.path.join(tmpdir.name, "a.txt")
+        self.path_b = os.path.join(tmpdir.name, "b.txt")
+
+    def write(self, a, b):
+        with open(self.path_a, "wb") as fp:
+            fp.write(a)
+        with open(self.path_b, "wb") as fp:
+            fp.write(b)
+
+    def check(self, encoding=None, errors=None, **kwargs):
+        with open(self.path_a, encoding=encoding, errors=errors) as fp:
+            a = fp.readlines()
+        with open(self.path_b, encoding=encoding, errors=errors) as fp:
+            b = fp.readlines()
+        for dfunc, ffunc in [
+            (cydifflib.unified_diff, cydifflib.unified_diff_files),
+            (cydifflib.context_diff, cydifflib.context_diff_files),
+        ]:
+            expected = list(dfunc(a, b, "a.txt", "b.txt", **kwargs))
+            actual = list(ffunc(self.path_a, self.path_b, "a.txt", "b.txt", encoding=encoding, errors=errors, **kwargs))
+            self.assertEqual(actual, expected)
+
+    def test_newlines(self):
+        a = "one\ntwo\r\nthree\rfour\n\nsix\r\n\rlast".encode()
+        b = "one\r\ntwo\nthree\r\nFOUR\n\r\nsix\nlast\n".encode()
+        self.write(a, b)
+        for n in (0, 1, 3):
+            self.check(encoding="utf-8", n=n)
+        self.write(a, b"")
+        self.check(encoding="utf-8")
+        self.write(b"", b"")
+        self.check(encoding="utf-8")
+
+    def test_encodings(self):
+        a = "caf\u00e9\nna\u00efve\n\u20ac\n"
+        b = "cafe\nna\u00efve\n\u00a3\n"
+        self.write(a.encode("utf-16"), b.encode("utf-16"))
+        self.check(encoding="utf-16")
+        self.write(a.encode("utf-8") + b"\xff\n", b.encode("utf-8") + b"\xfe\n")
+        self.check(encoding="utf-8", errors="surrogateescape")
+        self.check(encoding="utf-8", errors="replace")
+        self.check(encoding="latin-1")
+        with self.assertRaises(UnicodeDecodeError):
+            list(cydifflib.unified_diff_files(self.path_a, self.path_b, encoding="utf-8"))
+
+
 class TestBytes(unittest.TestCase):
     # don't really care about the content of the output, just the fact
     # that it's bytes and we don't crash
@@ -428,6 +1282,34 @@ class TestBytes(unittest.TestCase):
         actual = cydifflib.diff_bytes(unified, a, b, fna, fnb, datea, dateb, lineterm=b"")
         assertDiff(expect, actual)
 
+    def test_native_byte_content(self):
+        a = [b"hello\n", b"andr\xe9\n"]
+        b = [b"hello\n", b"andr\xc3\xa9\n"]
+        for dfunc in (cydifflib.unified_diff, cydifflib.context_diff):
+            expect = list(cydifflib.diff_bytes(lambda *args: dfunc(*args), a, b, b"a", b"b", b"2005"))
+            self.assertEqual(list(dfunc(a, b, b"a", b"b", b"2005")), expect)
+            # str arguments are accepted if they are ASCII
+            self.assertEqual(list(dfunc(a, b, "a", "b", "2005")), expect)
+            self._assert_type_error("all arguments must be bytes, not str ('\xe9')", dfunc, a, b, "\xe9")
+
+        self.assertEqual(
+            list(cydifflib.unified_diff(a, b)),
+            [b"--- \n", b"+++ \n", b"@@ -1,2 +1,2 @@\n", b" hello\n", b"-andr\xe9\n", b"+andr\xc3\xa9\n"],
+        )
+
+    def test_bytearray_content(self):
+        # bytearray lines are compared like bytes
+        a = [bytearray(b"a\n")]
+        b = [b"b\n"]
+        expect = [b"--- \n", b"+++ \n", b"@@ -1 +1 @@\n", b"-a\n", b"+b\n"]
+        self.assertEqual(list(cydifflib.diff_bytes(cydifflib.unified_diff, a, b)), expect)
+        self.assertEqual(list(cydifflib.unified_diff(a, b)), expect)
+        self.assertEqual(cydifflib.format_unified_diff(a, b), b"".join(expect))
+        self.assertEqual(list(cydifflib.context_diff(a, b)), list(cydifflib.context_diff([b"a\n"], b)))
+        self.assertEqual(
+            list(cydifflib.diff_bytes(cydifflib.context_diff, b, a)), list(cydifflib.context_diff(b, [b"a\n"]))
+        )
+
     def test_mixed_types_content(self):
         # type of input content must be consistent: all str or all bytes
         a = [b"hello"]